@@ -1,12 +1,7 @@
 import math
 import random
 import numpy
-import qConstants as qc
 import qUtilities as qu
-import qBitStrings as qb
-import qGates as qg
-import qMeasurement as qm
-import qAlgorithms as qa
 
 # It is conventional to have a main() function. Change it to do whatever you want. On Day 06 you could put your entanglement experiment in here.
 def main():
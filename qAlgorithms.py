@@ -1,154 +1,343 @@
 import math
 import random
+import time
 import numpy
 import qConstants as qc
 import qUtilities as qu
 import qBitStrings as qb
 import qGates as qg
 import qMeasurement as qm
-import qAlgorithms as qa
+import qCircuits as qci
+import qCache as qca
 
 
-def bennett():
-    '''Runs one iteration of the core algorithm of Bennett (1992). Returns a tuple of three items --- |alpha>, |beta>, |gamma> --- each of which is either |0> or |1>.'''
+def bennett(rng=None):
+    '''Runs one iteration of the core algorithm of Bennett (1992). Returns a tuple of three items --- |alpha>, |beta>, |gamma> --- each of which is either |0> or |1>. rng is as in qUtilities.draw.'''
+    # Draw everything from one Generator, since a seed passed to each draw separately would give the same number each time.
+    if rng is not None:
+        rng = qu.generator(rng)
     #Alice and Bob randomly select a classical bit by flipping a coin.
-    Alice = random.randint(0,1)
-    Bob = random.randint(0,1)
+    Alice = int(qu.draw(rng) < 0.5)
+    Bob = int(qu.draw(rng) < 0.5)
     
     if Alice == 0:
         ketAlpha = qc.ket0
         ketPsi = qc.ket0
         if Bob == 0:
             ketBeta = qc.ket0
-            measurement = qm.first(qg.tensor(ketPsi, qc.ket0))
+            measurement = qm.first(qg.tensor(ketPsi, qc.ket0), rng)
             ketGamma = measurement[0]
         else:
             ketBeta = qc.ket1
-            measurement = qm.first(qg.tensor(qg.application(qc.h, ketPsi), qc.ket0))
+            measurement = qm.first(qg.tensor(qg.application(qc.h, ketPsi), qc.ket0), rng)
             ketGamma = measurement[0]
     else:
         ketAlpha = qc.ket1
         ketPsi = qc.ketPlus
         if Bob == 0:
             ketBeta = qc.ket0
-            measurement = qm.first(qg.tensor(ketPsi, qc.ket0))
+            measurement = qm.first(qg.tensor(ketPsi, qc.ket0), rng)
             ketGamma = measurement[0]
         else:
             ketBeta = qc.ket1
-            measurement = qm.first(qg.tensor(qg.application(qc.h, ketPsi), qc.ket0))
+            measurement = qm.first(qg.tensor(qg.application(qc.h, ketPsi), qc.ket0), rng)
             ketGamma = measurement[0]
     return (ketAlpha, ketBeta, ketGamma)
+
+
+def bennettBatch(m, rng=None):
+    '''Runs m independent rounds of the core algorithm of Bennett (1992) at
+    once. Returns a tuple of three NumPy arrays of m bits each --- alpha, beta,
+    gamma --- where bit 0 stands for |0> and bit 1 for |1>, as in bennett.
+    rng is as in qUtilities.generator.'''
+    # Work out the probability of gamma = 1 for each of Alice's and Bob's choices, from the same states that bennett measures.
+    ones = numpy.zeros((2, 2))
+    for alice, ketPsi in ((0, qc.ket0), (1, qc.ketPlus)):
+        ones[alice, 0] = qm.marginal(qg.tensor(ketPsi, qc.ket0), [0])[1]
+        ones[alice, 1] = qm.marginal(qg.tensor(qg.application(qc.h, ketPsi), qc.ket0), [0])[1]
+    generator = qu.generator(rng)
+    alpha = generator.integers(0, 2, m, dtype=numpy.uint8)
+    beta = generator.integers(0, 2, m, dtype=numpy.uint8)
+    gamma = (generator.random(m) < ones[alpha, beta]).astype(numpy.uint8)
+    return (alpha, beta, gamma)
+
+
+def bennettStream(chunk, m=None, rng=None):
+    '''Returns an iterator over the results of bennettBatch(chunk), over and
+    over, for feeding a key-sifting pipeline. If m is given, stops after m
+    rounds in total; the last chunk may then be shorter. Raises ValueError if
+    chunk < 1 or m < 0. rng is as in qUtilities.generator.'''
+    if chunk < 1:
+        raise ValueError("chunk must be at least 1, not " + str(chunk))
+    if m is not None and m < 0:
+        raise ValueError("m must not be negative, not " + str(m))
+    generator = qu.generator(rng)
+    # The batches come from an inner generator, so that the checks above happen at the call rather than at the first batch.
+    def batches(m):
+        while m is None or m > 0:
+            size = chunk if m is None else min(chunk, m)
+            yield bennettBatch(size, generator)
+            if m is not None:
+                m -= size
+    return batches(m)
    
 
-def deutsch(f):
-    '''Implements the algorithm of Deutsch (1985). That is, given a two-qbit gate F representing a function f : {0, 1} -> {0, 1}, returns |1> if f is constant, and |0> if f is not constant.'''
-    firstState = qg.tensor(qc.ket1, qc.ket1)
-    hTensorh = qg.tensor(qc.h, qc.h)
-    superposition = qg.application(hTensorh, firstState)
-    applyF = qg.application(f, superposition)
-    finalState = qg.application(hTensorh, applyF)
-    measurement = qm.first(finalState)
-    return measurement[0]
+def kets(bits):
+    '''Converts a sequence of bits to the corresponding list of classical one-qbit states |0> and |1>.'''
+    return [qc.ket1 if bit else qc.ket0 for bit in bits]
+
+
+def deutschCircuit(f):
+    '''Returns the circuit of deutsch for the two-qbit gate F, as a qCircuits.Circuit. It measures the first qbit.'''
+    circuit = qci.Circuit(2)
+    circuit.layer(qc.x, range(2))
+    circuit.layer(qc.h, range(2))
+    circuit.oracle(f)
+    circuit.layer(qc.h, range(2))
+    return circuit.measure([0])
+
+
+def deutsch(f, rng=None, backend=None):
+    '''Implements the algorithm of Deutsch (1985). That is, given a two-qbit gate F representing a function f : {0, 1} -> {0, 1}, returns |1> if f is constant, and |0> if f is not constant. rng is as in qUtilities.generator. backend is as in qCircuits.Circuit.run; 'auto' runs Clifford oracles on qStabilizers' tableau, at the cost of checking whether they are Clifford.'''
+    bits = deutschCircuit(f).compile().run(backend=backend, rng=rng)[1]
+    return kets(bits)[0]
+
 
+def bernsteinVaziraniCircuit(n, f):
+    '''Returns the circuit of bernsteinVazirani for the (n + 1)-qbit gate F. It measures the first n qbits.'''
+    circuit = qci.Circuit(n + 1)
+    circuit.gate(qc.x, (n,))
+    circuit.layer(qc.h, range(n + 1))
+    circuit.oracle(f)
+    circuit.layer(qc.h, range(n + 1))
+    return circuit.measure(range(n))
 
-def bernsteinVazirani(n, f):
+
+def bernsteinVazirani(n, f, rng=None, backend=None):
     '''Given n >= 1 and an (n + 1)-qbit gate F representing a function f : {0, 1}^n -> {0, 1} defined by mod-2 dot product with an unknown delta in {0, 1}^n, returns the list or tuple of n classical one-qbit states (each
-    |0> or |1>) corresponding to delta.'''
-    inputRegister = qg.power(qc.ket0, n)
-    outputRegister = qc.ket1
-    state = qg.tensor(inputRegister, outputRegister)
-    hadamardLayer = qg.tensor(qg.power(qc.h, n), qc.h)
-    superposition = qg.application(hadamardLayer, state)
-    applyF = qg.application(f, superposition)
-    finalState = qg.application(hadamardLayer, applyF)
-    deltaList = []
-    for i in range(n):
-        measurement = qm.first(finalState)
-        deltaList.append(measurement[0])
-        finalState = measurement[1]
-    return deltaList
+    |0> or |1>) corresponding to delta. rng is as in qUtilities.generator. backend is as in deutsch; with 'auto', a
+    qGates.Affine oracle lets n run to hundreds.'''
+    bits = bernsteinVaziraniCircuit(n, f).compile().run(backend=backend, rng=rng)[1]
+    return kets(bits)
     
 
-def simon(n, f):
+def simonCircuit(n, f):
+    '''Returns the circuit of simon for the (n + (n - 1))-qbit gate F. It
+    measures the output register and then the input register.'''
+    circuit = qci.Circuit(2 * n - 1)
+    circuit.layer(qc.h, range(n))
+    #Applying the big F gate
+    circuit.oracle(f)
+    #Measuring the output register after the big F gate is applied. 
+    circuit.measure(range(n, 2 * n - 1))
+    circuit.layer(qc.h, range(n))
+    #Measuring the input register
+    return circuit.measure(range(n))
+
+
+def simon(n, f, rng=None, backend=None):
     '''The inputs are an integer n >= 2 and an (n + (n - 1))-qbit gate F
     representing a function f: {0, 1}^n -> {0, 1}^(n - 1) hiding an n-bit
     string delta as in the Simon (1994) problem. Returns a list or tuple of n
     classical one-qbit states (each |0> or |1>) corresponding to a uniformly
-    random bit string gamma that is perpendicular to delta.'''
-    inputRegister = qg.power(qc.ket0, n)
-    outputRegister = qg.power(qc.ket0, n-1)
-    hadamardLayer = qg.power(qc.h, n)
-    superposition = qg.application(hadamardLayer, inputRegister)
-    state = qg.tensor(superposition, outputRegister)
+    random bit string gamma that is perpendicular to delta. rng is as in
+    qUtilities.generator. backend is as in bernsteinVazirani.'''
+    bits = simonCircuit(n, f).compile().run(backend=backend, rng=rng)[1]
+    return kets(bits[n - 1:])
+    
+
+def solveSimon(n, f, rng=None, limit=None):
+    '''Assumes n >= 2. Given f : {0, 1}^n -> {0, 1}^(n - 1) hiding a non-zero
+    delta as in simon, either as an Oracle or in any form qGates.truthTable
+    accepts, recovers delta. The oracle and the pre-measurement state are built
+    once; then gammas perpendicular to delta are measured one at a time, each
+    reduced against the equations kept so far, until n - 1 independent ones are
+    known. Returns a pair consisting of delta, as an n-bit string, and the
+    number of measurements it took. Raises ValueError after limit measurements
+    (by default 4 n + 16, which almost never runs out when f meets the
+    promise), as happens when f does not hide a delta. rng is as in
+    qUtilities.generator.'''
+    if not isinstance(f, qg.Oracle):
+        f = qg.oracle(n, n - 1, f)
+    circuit = qci.Circuit(2 * n - 1)
+    circuit.layer(qc.h, range(n))
+    circuit.oracle(f)
+    circuit.layer(qc.h, range(n))
+    # Measuring the output register before the second Hadamard layer does not change the input register's distribution.
+    cumulative = numpy.cumsum(qm.marginal(circuit.compile().run()[0], range(n)))
+    generator = qu.generator(rng)
+    # The equations kept so far, as integers, keyed by their leading bit. Each has a leading bit no other has.
+    basis = {}
+    samples = 0
+    if limit is None:
+        limit = 4 * n + 16
+    while len(basis) < n - 1:
+        if samples == limit:
+            raise ValueError("no delta found in " + str(limit) + " measurements; f does not meet Simon's promise")
+        gamma = int(numpy.searchsorted(cumulative, generator.random() * cumulative[-1], side='right'))
+        samples += 1
+        for lead in sorted(basis, reverse=True):
+            if gamma >> lead & 1:
+                gamma ^= basis[lead]
+        if gamma != 0:
+            basis[gamma.bit_length() - 1] = gamma
+    # The null space of the n - 1 independent equations is {0, delta}.
+    equations = qb.binaryMatrix(qb.bitArray(numpy.array(list(basis.values())), n))
+    return (equations.nullSpace().tuples()[0], samples)
+
+
+def shorCircuit(n, f):
+    '''Returns the circuit of shor for the (n + n)-qbit gate F. It measures
+    the output register and then the input register.'''
+    circuit = qci.Circuit(2 * n)
+    circuit.layer(qc.h, range(n))
     #Applying the big F gate
-    state = qg.application(f, state)
+    circuit.oracle(f)
     #Measuring the output register after the big F gate is applied. 
-    for i in range(n - 1):
-        state = qm.last(state)[0]
-    state = qg.application(hadamardLayer, state)
+    circuit.measure(range(n, 2 * n))
+    circuit.fourier(range(n))
     #Measuring the input register
-    deltaList = []
-    for i in range(n):
-        measurement = qm.first(state)
-        deltaList.append(measurement[0])
-        state = measurement[1]
-    return deltaList
-    
+    return circuit.measure(range(n))
+
 
-def shor(n, f):
+def shor(n, f, rng=None):
     '''Assumes n >= 1. Given an (n + n)-qbit gate F representing a function
     f: {0, 1}^n -> {0, 1}^n of the form f(l) = k^l % m, returns a list or tuple
     of n classical one-qbit states (|0> or |1>) corresponding to the output of
-    Shor’s quantum circuit.'''
-    inputRegister = qg.power(qc.ket0, n)
-    outputRegister = qg.power(qc.ket0, n)
-    hadamardLayer = qg.power(qc.h, n)
-    identityLayer = qg.power(qc.i, n)
-    superposition = qg.application(hadamardLayer, inputRegister)
-    outputRegister = qg.application(outputRegister, identityLayer)
-    state = qg.tensor(superposition, outputRegister)
-    #Applying the big F gate
-    state = qg.application(f, state)
-    #Measuring the output register after the big F gate is applied. 
-    for i in range(n):
-        state = qm.last(state)[0]
-    state = qg.application(qg.fourier(n), state)
-    #Measuring the input register
-    stateList = []
-    for i in range(n):
-        measurement = qm.first(state)
-        stateList.append(measurement[0])
-        state = measurement[1]
-    return stateList
+    Shor’s quantum circuit. rng is as in qUtilities.generator.'''
+    bits = shorCircuit(n, f).compile().run(rng=rng)[1]
+    return kets(bits[n:])
     
     
-def grover(n, k, f):
+def shorDistribution(n, k, m):
+    '''Assumes n >= 1 and k coprime to m. Returns the probability distribution,
+    as an array of length 2^n, of the input register that shor measures when F
+    represents f(l) = k^l % m. Measuring the output register first does not
+    change it, so the circuit is simulated once, without measurements. The
+    result is cached in qCache.gates.'''
+    def build():
+        F = qg.oracle(n, n, [qu.powerMod(k, l, m) for l in range(2**n)])
+        circuit = qci.Circuit(2 * n)
+        circuit.layer(qc.h, range(n))
+        circuit.oracle(F)
+        circuit.fourier(range(n))
+        state = circuit.compile().run()[0]
+        return qm.marginal(state, range(n))
+    return qca.gates.get(('shorDistribution', n, k, m, qc.one.dtype.str), build)
+
+
+def factor(m, shots=64, batch=8, attempts=20, rng=None):
+    '''Assumes m >= 4. Finds a non-trivial factorization m = p q using
+    Shor's algorithm. For each random base k it simulates the circuit once, via
+    shorDistribution, then draws measurements batch at a time (up to shots of
+    them) and tries to recover the period of k with continued fractions, until
+    a period gives a factor. Gives up after the given number of bases. Returns
+    a pair: the tuple (p, q), or None on failure, and a dictionary reporting the
+    bases tried, measurements drawn, and seconds spent in each stage. rng is
+    as in qUtilities.generator.'''
+    report = {'bases': [], 'samples': 0, 'simulate': 0.0, 'sample': 0.0, 'classical': 0.0}
+    if m % 2 == 0:
+        return ((2, m // 2), report)
+    # Shor's algorithm cannot split prime powers, but they are easy to recognize classically.
+    for e in range(2, m.bit_length() + 1):
+        root = round(m ** (1 / e))
+        for r in (root - 1, root, root + 1):
+            if r > 1 and r**e == m:
+                return ((r, m // r), report)
+    # Make the input register big enough that 2^n >= m^2.
+    n = 2 * m.bit_length()
+    generator = qu.generator(rng)
+    for attempt in range(attempts):
+        k = int(generator.integers(2, m - 1))
+        report['bases'].append(k)
+        start = time.perf_counter()
+        g = math.gcd(k, m)
+        report['classical'] += time.perf_counter() - start
+        if g != 1:
+            return ((g, m // g), report)
+        start = time.perf_counter()
+        distribution = shorDistribution(n, k, m)
+        report['simulate'] += time.perf_counter() - start
+        drawn = 0
+        while drawn < shots:
+            start = time.perf_counter()
+            bs = generator.choice(2**n, size=min(batch, shots - drawn), p=distribution)
+            report['sample'] += time.perf_counter() - start
+            drawn += len(bs)
+            report['samples'] += len(bs)
+            start = time.perf_counter()
+            period = None
+            for b in bs:
+                for r in qu.continuedFraction(int(b), 2**n, m):
+                    # The first convergent is always 1, which is the period only if k = 1 mod m.
+                    if r == 1 and k % m != 1:
+                        continue
+                    # A convergent may give a proper divisor of the period, so also try a few small multiples of it.
+                    for multiple in (r, 2 * r, 3 * r):
+                        if qu.powerMod(k, multiple, m) == 1:
+                            period = multiple
+                            break
+                    if period is not None:
+                        break
+                if period is not None:
+                    break
+            factors = None
+            if period is not None and period % 2 == 0:
+                half = qu.powerMod(k, period // 2, m)
+                if half != m - 1:
+                    p = math.gcd(half - 1, m)
+                    if 1 < p < m:
+                        factors = (p, m // p)
+            report['classical'] += time.perf_counter() - start
+            if factors is not None:
+                return (factors, report)
+            if period is not None:
+                # The true period is known and useless for this base, so more measurements would not help.
+                break
+    return (None, report)
+
+
+def groverCircuit(n, k, f, ancilla=True):
+    '''Returns the circuit of grover for f. It measures the first n qbits. With
+    the ancilla, f is the (n + 1)-qbit gate F. Without it, the circuit has only
+    n qbits and f is anything qGates.truthTable accepts, or an Oracle.'''
+    t = numpy.arcsin(math.sqrt(k) * 2**(n / -2))
+    rotations = int(round(numpy.pi/(4*t) - 0.5))
+    if ancilla:
+        circuit = qci.Circuit(n + 1)
+        circuit.gate(qc.x, (n,))
+        circuit.layer(qc.h, range(n + 1))
+        circuit.oracle(f)
+        for i in range(rotations):
+            circuit.oracle(f)
+            circuit.diffusion(range(n))
+    else:
+        if isinstance(f, qg.Oracle):
+            table = f.table
+        else:
+            table = qg.truthTable(n, 1, f)
+        marked = numpy.flatnonzero(table)
+        circuit = qci.Circuit(n)
+        circuit.layer(qc.h, range(n))
+        circuit.phase(marked, range(n))
+        for i in range(rotations):
+            circuit.phase(marked, range(n))
+            circuit.diffusion(range(n))
+    return circuit.measure(range(n))
+
+
+def grover(n, k, f, ancilla=True, rng=None):
     '''Assumes n >= 1, k >= 1. Assumes that k is small compared to 2^n.
     Implements the Grover core subroutine. The F parameter is an (n + 1)-qbit
     gate representing a function f : {0, 1}^n -> {0, 1} such that
     SUM_alpha f(alpha) = k. Returns a list or tuple of n classical one-qbit
     states (either |0> or |1>), such that the corresponding n-bit string delta
-    usually satisfies f(delta) = 1.'''  
-    inputRegister = qg.power(qc.ket0, n)
-    outputRegister = qc.ket1
-    hadamardLayer = qg.power(qc.h, n+1)
-    state = qg.tensor(inputRegister, outputRegister)
-    superposition = qg.application(hadamardLayer, state)
-    state = qg.application(f, superposition)  
-    ketRho = qg.power(qc.ketPlus, n)
-    identityLayer = qg.power(qc.i, n)
-    R = 2 * numpy.outer(ketRho.conjugate(), ketRho) - identityLayer
-    t = numpy.arcsin(math.sqrt(k) * 2**(n / -2))
-    rotations = int(round(numpy.pi/(4*t) - 0.5))
-    for i in range(rotations):
-        state = qg.application(f, state)
-        state = qg.application(qg.tensor(R, qc.i), state)
-    deltaList = []
-    for i in range(n):
-        measurement = qm.first(state)
-        deltaList.append(measurement[0])
-        state = measurement[1]
-    return deltaList
+    usually satisfies f(delta) = 1. If ancilla is False, the output qbit is
+    dropped and f is applied as a phase oracle; then F must be an Oracle, or f
+    given in any form that qGates.truthTable accepts. rng is as in
+    qUtilities.generator.'''  
+    bits = groverCircuit(n, k, f, ancilla).compile().run(rng=rng)[1]
+    return kets(bits)
     
     
      
@@ -163,13 +352,13 @@ def bennettTest(m):
     falseFail = 0
     for i in range(m):
         result = bennett()
-        if qu.equal(result[2], qc.ket1, 0.000001):
-            if qu.equal(result[0], result[1], 0.000001):
+        if qu.equal(result[2], qc.ket1, qc.epsilon):
+            if qu.equal(result[0], result[1], qc.epsilon):
                 falseSucc += 1
             else:
                 trueSucc += 1
         else:
-            if qu.equal(result[0], result[1], 0.000001):
+            if qu.equal(result[0], result[1], qc.epsilon):
                 trueFail += 1
             else:
                 falseFail += 1
@@ -182,11 +371,68 @@ def bennettTest(m):
     print("check bennettTest for true failure frequency about 0.5")
     print("    true failure frequency = ", str(trueFail / m))
 
+def bennettBatchTest(m, chunk):
+    # Like bennettTest, but runs the m rounds in chunks through bennettStream.
+    trueSucc = 0
+    trueFail = 0
+    falseSucc = 0
+    falseFail = 0
+    for alpha, beta, gamma in bennettStream(chunk, m):
+        same = (alpha == beta)
+        falseSucc += numpy.count_nonzero((gamma == 1) & same)
+        trueSucc += numpy.count_nonzero((gamma == 1) & ~same)
+        trueFail += numpy.count_nonzero((gamma == 0) & same)
+        falseFail += numpy.count_nonzero((gamma == 0) & ~same)
+    print("check bennettBatchTest for false success frequency exactly 0")
+    print("    false success frequency = ", str(falseSucc / m))
+    print("check bennettBatchTest for true success frequency about 0.25")
+    print("    true success frequency = ", str(trueSucc / m))
+    print("check bennettBatchTest for false failure frequency about 0.25")
+    print("    false failure frequency = ", str(falseFail / m))
+    print("check bennettBatchTest for true failure frequency about 0.5")
+    print("    true failure frequency = ", str(trueFail / m))
+
+def bennettStreamTest():
+    # Checks that bennettStream rejects bad sizes at once and stops after exactly m rounds.
+    errors = 0
+    for chunk, m in [(0, 10), (-1, None), (5, -1)]:
+        try:
+            bennettStream(chunk, m)
+        except ValueError:
+            errors += 1
+    sizes = [len(alpha) for alpha, beta, gamma in bennettStream(4, 10, rng=358)]
+    if errors == 3 and sizes == [4, 4, 2] and list(bennettStream(4, 0)) == []:
+        print("passed bennettStreamTest")
+    else:
+        print("failed bennettStreamTest")
+        print("    errors = " + str(errors) + ", sizes = " + str(sizes))
+
+def seedTest(n):
+    # Runs Bennett's batch and Grover's algorithm twice with the same seed, and checks that they repeat exactly.
+    a = bennettBatch(1000, rng=358)
+    b = bennettBatch(1000, rng=358)
+    fGate = qg.oracle(n, 1, lambda alpha: (alpha[0] & alpha[-1],))
+    c = [grover(n, 2**(n - 2), fGate, rng=seed) for seed in range(10)]
+    d = [grover(n, 2**(n - 2), fGate, rng=seed) for seed in range(10)]
+    if all((x == y).all() for x, y in zip(a, b)) and all(qu.equal(numpy.array(x), numpy.array(y), qc.epsilon) for x, y in zip(c, d)):
+        print("passed seedTest")
+    else:
+        print("failed seedTest")
+
+def bennettSeedTest(seeds):
+    # Runs bennett with each of the given seeds, and checks that Alice's and Bob's bits are not always equal.
+    choices = {(qu.bitValue(alpha), qu.bitValue(beta)) for alpha, beta, gamma in (bennett(rng=seed) for seed in range(seeds))}
+    if len(choices) == 4:
+        print("passed bennettSeedTest")
+    else:
+        print("failed bennettSeedTest")
+        print("    choices = " + str(sorted(choices)))
+
 def deutschTest():
     def fNot(x):
         return (1 - x[0],)
     resultNot = deutsch(qg.function(1, 1, fNot))
-    if qu.equal(resultNot, qc.ket0, 0.000001):
+    if qu.equal(resultNot, qc.ket0, qc.epsilon):
         print("passed deutschTest first part")
     else:
         print("failed deutschTest first part")
@@ -194,7 +440,7 @@ def deutschTest():
     def fId(x):
         return x
     resultId = deutsch(qg.function(1, 1, fId))
-    if qu.equal(resultId, qc.ket0, 0.000001):
+    if qu.equal(resultId, qc.ket0, qc.epsilon):
         print("passed deutschTest second part")
     else:
         print("failed deutschTest second part")
@@ -202,7 +448,7 @@ def deutschTest():
     def fZero(x):
         return (0,)
     resultZero = deutsch(qg.function(1, 1, fZero))
-    if qu.equal(resultZero, qc.ket1, 0.000001):
+    if qu.equal(resultZero, qc.ket1, qc.epsilon):
         print("passed deutschTest third part")
     else:
         print("failed deutschTest third part")
@@ -210,7 +456,7 @@ def deutschTest():
     def fOne(x):
         return (1,)
     resultOne = deutsch(qg.function(1, 1, fOne))
-    if qu.equal(resultOne, qc.ket1, 0.000001):
+    if qu.equal(resultOne, qc.ket1, qc.epsilon):
         print("passed deutschTest fourth part")
     else:
         print("failed deutschTest fourth part")
@@ -256,6 +502,32 @@ def simonTest(n):
         # print(" delta = " + str(delta))
         # print(" prediction = " + str(prediction))
 
+def solveSimonTest(n):
+    # Like simonTest, but recovers delta itself with solveSimon.
+    delta = qb.string(n, random.randrange(1, 2**n))
+    k = 0
+    while delta[k] == 0:
+        k += 1
+    m = numpy.identity(n, dtype=int)
+    m[:, k] = delta
+    def f(s):
+        full = numpy.dot(m, s) % 2
+        full = tuple([full[i] for i in range(len(full))])
+        return full[:k] + full[k + 1:]
+    prediction, samples = solveSimon(n, f)
+    if prediction == delta:
+        print("passed solveSimonTest in " + str(samples) + " samples")
+    else:
+        print("failed solveSimonTest")
+        print(" delta = " + str(delta))
+        print(" prediction = " + str(prediction))
+    # A constant f hides no delta, so every gamma is 0 and solveSimon must give up.
+    try:
+        solveSimon(n, numpy.zeros(2**n, dtype=int))
+        print("failed solveSimonTest for a constant f")
+    except ValueError:
+        print("passed solveSimonTest for a constant f")
+
 def shorTest(n, m):
     # Chooses a random k that is coprime to m
     k = 0
@@ -280,14 +552,26 @@ def shorTest(n, m):
         return string
     
     # Runs Shor’s quantum core subroutine on the corresponding gate F
-    F = qg.function(n, n, f)
+    F = qg.oracle(n, n, f)
     result = shor(n, F)
     # Interprets the output as an integer b
     b = qb.integer(listToString(result))
     print(b)
 
+
+def factorTest(m):
+    # Factors m with Shor's algorithm and checks the answer.
+    factors, report = factor(m)
+    if factors is not None and factors[0] * factors[1] == m and 1 < factors[0] < m:
+        print("passed factorTest: " + str(m) + " = " + str(factors[0]) + " * " + str(factors[1]))
+        print("    bases = " + str(report['bases']) + ", samples = " + str(report['samples']))
+        print("    seconds: simulate = %.4f, sample = %.4f, classical = %.4f" % (report['simulate'], report['sample'], report['classical']))
+    else:
+        print("failed factorTest")
+        print("    report = " + str(report))
+
     
-def groverTest(n, k):
+def groverTest(n, k, ancilla=True):
     # Pick k distinct deltas uniformly randomly.
     deltas = []
     while len(deltas) < k:
@@ -300,13 +584,13 @@ def groverTest(n, k):
             if alpha == delta:
                 return (1,)
         return (0,)
-    fGate = qg.function(n, 1, f)
+    fGate = qg.oracle(n, 1, f)
     # Run Grover’s algorithm up to 10 times.
-    qbits = grover(n, k, fGate)
+    qbits = grover(n, k, fGate, ancilla)
     bits = tuple(map(qu.bitValue, qbits))
     j = 1
     while (not bits in deltas) and (j < 10):
-        qbits = grover(n, k, fGate)
+        qbits = grover(n, k, fGate, ancilla)
         bits = tuple(map(qu.bitValue, qbits))
         j += 1
     if bits in deltas:
@@ -322,11 +606,20 @@ def groverTest(n, k):
 
 def main():
     bennettTest(100000)
+    bennettBatchTest(1000000, 300000)
+    bennettStreamTest()
+    seedTest(6)
+    bennettSeedTest(50)
     deutschTest()
     bernsteinVaziraniTest(4)
     simonTest(4)
+    solveSimonTest(4)
+    solveSimonTest(10)
     shorTest(5, 5)
+    factorTest(15)
+    factorTest(21)
     groverTest(5, 2)
+    groverTest(16, 3, ancilla=False)
 
     
 
@@ -0,0 +1,349 @@
+import os
+import sys
+import ast
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy
+import qConstants as qc
+import qUtilities as qu
+import qBitStrings as qb
+import qGates as qg
+import qMeasurement as qm
+import qAlgorithms as qa
+import qCache as qca
+
+# Benchmarks of the hot paths. Each case is timed over a sweep of qbit counts. A run records the best wall time of
+# several repeats, the peak memory that tracemalloc sees during one more repeat, and the throughput in amplitudes (or
+# matrix entries, or bits) per second, and can be written as JSON and compared against a stored baseline. Everything
+# runs offline on the CPU. A baseline of the default sweep is kept next to this file, as qBenchmarks.json, and
+# --baseline with no file compares against it. Startup is benchmarked too: each module must import within its budget,
+# and no module may be part of an import cycle. Run this file with --help for the command-line options.
+
+# The qbit counts that run sweeps by default. Cases that build dense gates stop at dense qbits.
+sizes = [4, 8, 12, 16]
+dense = 10
+# The import-time budget of each module in seconds, not counting NumPy. The light modules must stay light; the others
+# pull in the gate kernels.
+# The stored baseline that --baseline compares against when given no file.
+baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qBenchmarks.json')
+budgets = {'qConstants': 0.005, 'qBitStrings': 0.005, 'qUtilities': 0.005, 'qGates': 0.025, 'qMeasurement': 0.025,
+           'qCircuits': 0.03, 'qAlgorithms': 0.03}
+
+
+def cases():
+    '''Returns a dictionary mapping the name of each benchmark to a pair (prepare, limit). prepare(n) does the setup for
+    n qbits and returns a pair (thunk, items), where thunk() runs the operation once and items is how much data it
+    processes, or None if the benchmark has no instance with n qbits. Only n <= limit is run. Cached constructors clear
+    qCache.gates first, so that they are really timed; run gives them a cache of their own to clear.'''
+    def application(n):
+        u, ketPsi = qg.power(qc.h, n), qu.uniform(n)
+        return (lambda: qg.application(u, ketPsi), 4**n)
+    def targeted(n):
+        ketPsi = qu.uniform(n)
+        return (lambda: qg.targetedApplication(qc.cnot, ketPsi, (0, n - 1)), 2**n)
+    def tensor(n):
+        a, b = qg.power(qc.h, n // 2), qg.power(qc.h, n - n // 2)
+        return (lambda: qg.tensor(a, b), 4**n)
+    def kronecker(n):
+        u, ketPsi = qg.power(qc.h, n, lazy=True), qu.uniform(n)
+        return (lambda: qg.application(u, ketPsi), 2**n)
+    def power(n):
+        return (lambda: (qca.gates.clear(), qg.power(qc.h, n)), 4**n)
+    def function(n):
+        return (lambda: (qca.gates.clear(), qg.function(n - 1, 1, lambda alpha: (alpha[0],))), 4**n)
+    def oracle(n):
+        return (lambda: (qca.gates.clear(), qg.oracle(n - 1, 1, lambda alpha: (alpha[0],))), 2**n)
+    def fourier(n):
+        return (lambda: (qca.gates.clear(), qg.fourier(n)), 4**n)
+    def fourierApplication(n):
+        ketPsi = qu.uniform(n)
+        return (lambda: qg.fourierApplication(ketPsi), 2**n)
+    def first(n):
+        ketPsi = qu.uniform(n)
+        return (lambda: qm.first(ketPsi, rng=0), 2**n)
+    def last(n):
+        ketPsi = qu.uniform(n)
+        return (lambda: qm.last(ketPsi, rng=0), 2**n)
+    def uniform(n):
+        return (lambda: qu.uniform(n, rng=0), 2**n)
+    def reduction(n):
+        a = [qb.string(8 * n, random.getrandbits(8 * n)) for i in range(8 * n)]
+        return (lambda: qb.reduction(a), 64 * n**2)
+    def bennett(n):
+        return (lambda: qa.bennett(rng=0), 1)
+    def bennettBatch(n):
+        return (lambda: qa.bennettBatch(2**n, rng=0), 2**n)
+    def deutsch(n):
+        f = qg.oracle(1, 1, [0, 1])
+        return (lambda: qa.deutsch(f, rng=0), 4)
+    def bernsteinVazirani(n):
+        delta = qb.string(n - 1, random.randrange(2**(n - 1)))
+        f = qg.oracle(n - 1, 1, lambda alpha: (qb.dot(alpha, delta),))
+        return (lambda: qa.bernsteinVazirani(n - 1, f, rng=0), 2**n)
+    def simon(n):
+        k = (n + 1) // 2
+        f = qg.oracle(k, k - 1, lambda alpha: alpha[1:] if alpha[0] == 0 else qb.addition(alpha[1:], (k - 1) * (1,)))
+        return (lambda: qa.simon(k, f, rng=0), 2**(2 * k - 1))
+    def solveSimon(n):
+        k = (n + 1) // 2
+        f = qg.oracle(k, k - 1, lambda alpha: alpha[1:] if alpha[0] == 0 else qb.addition(alpha[1:], (k - 1) * (1,)))
+        return (lambda: qa.solveSimon(k, f, rng=0), 2**(2 * k - 1))
+    def shor(n):
+        k = n // 2
+        f = qg.oracle(k, k, numpy.array([pow(7, l, 15) for l in range(2**k)]) % 2**k)
+        return (lambda: qa.shor(k, f, rng=0), 4**k)
+    def grover(n):
+        table = numpy.zeros(2**(n - 1), dtype=numpy.intp)
+        table[1] = 1
+        f = qg.oracle(n - 1, 1, table)
+        return (lambda: qa.grover(n - 1, 1, f, rng=0), 2**n)
+    def factor(n):
+        # factor simulates 4 qbits per bit of m, so only some n have an m to factor. The seed makes the first base
+        # coprime to m, so that the circuit is really simulated rather than the factor found by gcd.
+        if n not in (16, 20):
+            return None
+        m = {16: 15, 20: 21}[n]
+        return (lambda: (qca.gates.clear(), qa.factor(m, rng=1)), 2**n)
+    return {'application': (application, dense), 'targetedApplication': (targeted, 24), 'tensor': (tensor, dense),
+            'power': (power, dense), 'kronecker': (kronecker, 24), 'function': (function, dense), 'oracle': (oracle, 20), 'fourier': (fourier, dense),
+            'fourierApplication': (fourierApplication, 24), 'first': (first, 24), 'last': (last, 24),
+            'uniform': (uniform, 24), 'reduction': (reduction, 16), 'bennett': (bennett, 4),
+            'bennettBatch': (bennettBatch, 24), 'deutsch': (deutsch, 4), 'bernsteinVazirani': (bernsteinVazirani, 20),
+            'simon': (simon, 20), 'solveSimon': (solveSimon, 20), 'shor': (shor, 20), 'factor': (factor, 20),
+            'grover': (grover, 16)}
+
+def measure(thunk, repeats):
+    '''Runs thunk repeats times and returns the best wall time in seconds, and then once more under tracemalloc and
+    returns the peak number of bytes allocated.'''
+    thunk()
+    seconds = math.inf
+    for r in range(repeats):
+        start = time.perf_counter()
+        thunk()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    thunk()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return (seconds, peak)
+
+def run(names=None, sweep=None, repeats=3, report=None):
+    '''Runs the named benchmarks (by default all of them) for each qbit count in sweep (by default sizes), and returns
+    a dictionary with the environment under 'environment' and, under 'results', a dictionary mapping 'name/n' to the
+    seconds, peak bytes and items per second. If report is given, it is called with each key and result as it is
+    done. The benchmarks run with an empty qCache.gates of their own, and the caller's is put back afterwards.'''
+    random.seed(358)
+    table = cases()
+    if names is None:
+        names = list(table)
+    results = {}
+    saved = qca.gates
+    qca.gates = qca.Cache(saved.budget)
+    try:
+        for name in names:
+            prepare, limit = table[name]
+            for n in (sizes if sweep is None else sweep):
+                prepared = prepare(n) if n <= limit else None
+                if prepared is None:
+                    continue
+                thunk, items = prepared
+                seconds, peak = measure(thunk, repeats)
+                results[name + '/' + str(n)] = {'seconds': seconds, 'peak': peak, 'throughput': items / seconds}
+                if report is not None:
+                    report(name + '/' + str(n), results[name + '/' + str(n)])
+    finally:
+        qca.gates = saved
+    environment = {'python': platform.python_version(), 'numpy': numpy.__version__, 'machine': platform.machine(),
+                   'processor': platform.processor(), 'dtype': qc.one.dtype.name, 'repeats': repeats}
+    return {'environment': environment, 'results': results}
+
+def save(benchmarks, path):
+    '''Writes the output of run to a JSON file.'''
+    with open(path, 'w') as file:
+        json.dump(benchmarks, file, indent=1, sort_keys=True)
+
+def load(path):
+    '''Reads benchmarks written by save.'''
+    with open(path) as file:
+        return json.load(file)
+
+def compare(benchmarks, baseline, threshold=0.25, memory=0.25):
+    '''Compares benchmarks against a baseline, both as returned by run. Returns the list of regressions, each a tuple
+    (key, metric, old, new): results whose time grew by more than the fraction threshold, or whose peak memory grew
+    by more than the fraction memory. Keys missing from either are skipped.'''
+    regressions = []
+    for key, new in benchmarks['results'].items():
+        if key not in baseline['results']:
+            continue
+        old = baseline['results'][key]
+        if new['seconds'] > old['seconds'] * (1 + threshold):
+            regressions.append((key, 'seconds', old['seconds'], new['seconds']))
+        if new['peak'] > old['peak'] * (1 + memory):
+            regressions.append((key, 'peak', old['peak'], new['peak']))
+    return regressions
+
+def importTimes(modules=None, repeats=5):
+    '''Returns a dictionary mapping each module (by default those in budgets) to the best of repeats times to import it
+    in a fresh interpreter that has already imported NumPy. The bytecode is cached first, as it is in normal use.'''
+    if modules is None:
+        modules = list(budgets)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    environment = {key: value for key, value in os.environ.items() if key != 'PYTHONDONTWRITEBYTECODE'}
+    times = {}
+    for module in modules:
+        subprocess.run([sys.executable, '-c', 'import ' + module], cwd=directory, env=environment, check=True)
+        code = "import time, numpy\nstart = time.perf_counter()\nimport " + module + "\nprint(time.perf_counter() - start)"
+        times[module] = min(float(subprocess.run([sys.executable, '-c', code], cwd=directory, env=environment, check=True,
+                                                 capture_output=True, text=True).stdout) for r in range(repeats))
+    return times
+
+def overBudget(times):
+    '''Returns the list of tuples (module, budget, seconds) for the modules in times that took longer than budgets
+    allows.'''
+    return [(module, budgets[module], seconds) for module, seconds in times.items()
+            if module in budgets and seconds > budgets[module]]
+
+def importGraph():
+    '''Returns a dictionary mapping each module of the simulator (each q*.py next to this file) to the set of the
+    simulator's modules that it imports at top level, read from its source. Imports made inside functions are left
+    out: they run only after both modules have loaded, so they cannot take part in a cycle at import time.'''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    names = {name[:-3] for name in os.listdir(directory) if name.startswith('q') and name.endswith('.py')}
+    graph = {}
+    for name in names:
+        with open(os.path.join(directory, name + '.py')) as file:
+            tree = ast.parse(file.read())
+        imported = set()
+        for node in tree.body:
+            if isinstance(node, ast.Import):
+                imported |= {alias.name for alias in node.names}
+            elif isinstance(node, ast.ImportFrom) and node.module is not None:
+                imported.add(node.module)
+        graph[name] = imported & names
+    return graph
+
+def cycles(graph):
+    '''Returns a list of cycles in graph, a dictionary as from importGraph, each as the list of modules around it with
+    the first repeated at the end. The list is empty exactly when there are none. A module that imports itself is a
+    cycle of length one.'''
+    found = []
+    finished = set()
+    def visit(module, path):
+        if module in path:
+            found.append(path[path.index(module):] + [module])
+        elif module not in finished:
+            for other in sorted(graph[module]):
+                visit(other, path + [module])
+            finished.add(module)
+    for module in sorted(graph):
+        visit(module, [])
+    return found
+
+
+
+### DEFINING SOME TESTS ###
+
+def compareTest():
+    # Checks that compare flags a slower and a hungrier result and nothing else.
+    baseline = {'results': {'a/4': {'seconds': 1.0, 'peak': 100}, 'b/4': {'seconds': 1.0, 'peak': 100},
+                            'c/4': {'seconds': 1.0, 'peak': 100}}}
+    benchmarks = {'results': {'a/4': {'seconds': 1.2, 'peak': 120}, 'b/4': {'seconds': 1.5, 'peak': 100},
+                              'c/4': {'seconds': 0.5, 'peak': 200}, 'd/4': {'seconds': 9.0, 'peak': 900}}}
+    regressions = compare(benchmarks, baseline)
+    if regressions == [('b/4', 'seconds', 1.0, 1.5), ('c/4', 'peak', 100, 200)]:
+        print("passed compareTest")
+    else:
+        print("failed compareTest")
+        print("    regressions = " + str(regressions))
+
+def runTest():
+    # Runs every benchmark once at a small size (factor has none below 16) and checks that each produced a sensible
+    # result, and that the caller's gate cache is left as it was.
+    gates, entries = qca.gates, qca.gates.statistics()['entries']
+    results = run(sweep=[4], repeats=1)['results']
+    results.update(run(['factor'], sweep=[16], repeats=1)['results'])
+    if (len(results) == len(cases()) and all(r['seconds'] > 0 and r['throughput'] > 0 for r in results.values())
+            and qca.gates is gates and gates.statistics()['entries'] == entries):
+        print("passed runTest")
+    else:
+        print("failed runTest")
+        print("    results = " + str(sorted(results)))
+
+def importTest():
+    # Checks that every module imports within its budget, and that the light modules do not import the rest.
+    times = importTimes()
+    over = overBudget(times)
+    code = "import sys, qUtilities, qBitStrings\nprint(sorted(name for name in sys.modules if name.startswith('q')))"
+    loaded = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+                            capture_output=True, text=True).stdout.strip()
+    if len(over) == 0 and loaded == str(['qBitStrings', 'qConstants', 'qUtilities']):
+        print("passed importTest")
+    else:
+        print("failed importTest")
+        print("    over budget = " + str(over) + ", loaded = " + loaded)
+
+
+def graphTest():
+    # Checks that cycles finds the cycles of a small graph, and that the simulator's modules have none.
+    graph = {'a': {'b'}, 'b': {'c'}, 'c': {'a', 'd'}, 'd': set(), 'e': {'e', 'd'}}
+    found = cycles(graph)
+    real = cycles(importGraph())
+    if found == [['a', 'b', 'c', 'a'], ['e', 'e']] and real == []:
+        print("passed graphTest")
+    else:
+        print("failed graphTest")
+        print("    found = " + str(found) + ", import cycles = " + str(real))
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the hot paths of the quantum simulator.")
+    parser.add_argument('names', nargs='*', help="benchmarks to run (default: all)")
+    parser.add_argument('--sizes', type=int, nargs='+', help="qbit counts to sweep (default: " + str(sizes) + ")")
+    parser.add_argument('--repeats', type=int, default=3, help="timed repeats per benchmark, of which the best counts")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', nargs='?', const=baseline, help="compare against this JSON file (default: the stored "
+                        + os.path.basename(baseline) + ") and exit with status 1 on regressions")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed fractional slowdown (default 0.25)")
+    parser.add_argument('--memory', type=float, default=0.25, help="allowed fractional growth in peak memory (default 0.25)")
+    parser.add_argument('--imports', action='store_true', help="check the import times against their budgets and look for import cycles instead, and exit with status 1 on either")
+    parser.add_argument('--test', action='store_true', help="run the self-tests instead")
+    arguments = parser.parse_args()
+    if arguments.test:
+        compareTest()
+        runTest()
+        importTest()
+        graphTest()
+        return
+    if arguments.imports:
+        times = importTimes()
+        for module, seconds in times.items():
+            print("%-24s %10.6fs (budget %.3fs)" % (module, seconds, budgets[module]))
+        loops = cycles(importGraph())
+        for loop in loops:
+            print("import cycle: " + " -> ".join(loop))
+        if len(overBudget(times)) > 0 or len(loops) > 0:
+            sys.exit(1)
+        return
+    def report(key, result):
+        print("%-24s %10.6fs %12d bytes %14.1f items/s" % (key, result['seconds'], result['peak'], result['throughput']))
+    benchmarks = run(arguments.names or None, arguments.sizes, arguments.repeats, report)
+    if arguments.output is not None:
+        save(benchmarks, arguments.output)
+    if arguments.baseline is not None:
+        regressions = compare(benchmarks, load(arguments.baseline), arguments.threshold, arguments.memory)
+        for key, metric, old, new in regressions:
+            print("regression in " + key + ": " + metric + " went from " + str(old) + " to " + str(new))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
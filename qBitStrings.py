@@ -3,29 +3,18 @@
 import math
 import random
 import numpy
-import qConstants as qc
-import qUtilities as qu
-import qBitStrings as qb
-import qGates as qg
-import qMeasurement as qm
-import qAlgorithms as qa
 
 
 def string(n, m):
     '''Converts a non-negative Python integer m to its corresponding bit string. As necessary, pads with leading 0s to bring the number of bits up to n.'''
-    s = ()
-    while m >= 1:
-        s = (m % 2,) + s
-        m = m // 2
-    s = (n - len(s)) * (0,) + s
-    return s
+    if m == 0:
+        return n * (0,)
+    return tuple(map(int, format(m, '0' + str(n) + 'b')))
 
 def integer(s):
-    '''Converts a bit string to its corresponding non-negative Python integer.'''
-    m = 0
-    for k in range(len(s)):
-        m = 2 * m + s[k]
-    return m
+    '''Converts a bit string to its corresponding non-negative Python integer. The bits may be any values that int
+    maps to 0 or 1, such as bools, NumPy integers or floats.'''
+    return int(''.join([str(int(b)) for b in s]), 2) if len(s) > 0 else 0
 
 def next(s):
     '''Given an n-bit string, returns the next n-bit string. The order is lexicographic, except that there is a string after 1...1, namely 0...0.'''
@@ -39,43 +28,182 @@ def next(s):
 
 def addition(s, t):
     '''Returns the mod-2 sum of two n-bit strings.'''
-    return tuple([(s[i] + t[i]) % 2 for i in range(len(s))])
+    return tuple([a ^ b for a, b in zip(s, t)])
 
 def dot(s, t):
     '''Returns the mod-2 dot product of two n-bit strings.'''
-    return sum([s[i] * t[i] for i in range(len(s))]) % 2
+    return sum([a & b for a, b in zip(s, t)]) % 2
+
+# An n-bit string can also be packed into a non-negative Python integer, with the first bit most significant, as by
+# integer and string. Then addition is XOR and dot is the parity of the bitwise AND. For many strings at once, the
+# batch functions below use NumPy arrays: either an array of integers (n <= 63) or, for any n, rows of bits packed
+# into unsigned 64-bit words, first bit most significant, with the unused low bits of the last word set to 0.
+
+def integerAddition(a, b):
+    '''Returns the mod-2 sum of two n-bit strings packed as integers.'''
+    return a ^ b
+
+def integerDot(a, b):
+    '''Returns the mod-2 dot product of two n-bit strings packed as integers.'''
+    return bin(a & b).count('1') % 2
+
+def strings(n):
+    '''Returns all 2^n n-bit strings, in the order of next starting from 0...0, as the rows of a 2^n x n NumPy array of bits.'''
+    return bitArray(numpy.arange(2**n), n)
+
+def bitArray(integers, n):
+    '''Given a NumPy array of non-negative integers less than 2^n, returns the corresponding n-bit strings as the rows of an array of bits.'''
+    shifts = numpy.arange(n - 1, -1, -1)
+    return ((numpy.asarray(integers)[..., None] >> shifts) & 1).astype(numpy.uint8)
+
+def integers(bits):
+    '''Given n-bit strings (n <= 63) as the rows of an array of bits, returns the array of corresponding integers.'''
+    bits = numpy.asarray(bits, dtype=numpy.int64)
+    n = bits.shape[-1]
+    return numpy.dot(bits, numpy.int64(1) << numpy.arange(n - 1, -1, -1, dtype=numpy.int64))
+
+def tuples(bits):
+    '''Given n-bit strings as the rows of an array of bits, returns them as a list of tuples, as in the rest of this module.'''
+    return [tuple(row) for row in numpy.asarray(bits).tolist()]
+
+def pack(bits):
+    '''Given n-bit strings as the rows of an array of bits, returns them packed into an array of unsigned 64-bit words, one row of ceil(n / 64) words per string.'''
+    bits = numpy.asarray(bits, dtype=numpy.uint8)
+    n = bits.shape[-1]
+    words = -(-n // 64)
+    packed = numpy.packbits(bits, axis=-1)
+    padding = numpy.zeros(bits.shape[:-1] + (8 * words - packed.shape[-1],), dtype=numpy.uint8)
+    packed = numpy.ascontiguousarray(numpy.concatenate([packed, padding], axis=-1))
+    return packed.view('>u8').astype(numpy.uint64)
+
+def unpack(words, n):
+    '''Inverse of pack: given strings packed into rows of 64-bit words, returns their first n bits as the rows of an array of bits.'''
+    words = numpy.ascontiguousarray(numpy.asarray(words, dtype=numpy.uint64).astype('>u8'))
+    return numpy.unpackbits(words.view(numpy.uint8), axis=-1)[..., :n]
+
+def batchAddition(a, b):
+    '''Returns the mod-2 sums of two arrays of bit strings, packed either as integers or as words. Broadcasts like NumPy.'''
+    return numpy.bitwise_xor(a, b)
+
+def batchDot(a, b, packed=True):
+    '''Returns the mod-2 dot products of two arrays of bit strings as an array of 0s and 1s, broadcasting like NumPy. If packed, the strings are rows of words, as from pack; otherwise each string is one integer.'''
+    x = numpy.bitwise_and(numpy.asarray(a, dtype=numpy.uint64), numpy.asarray(b, dtype=numpy.uint64))
+    if packed:
+        x = numpy.bitwise_xor.reduce(x, axis=-1)
+    return parity(x)
+
+def parity(words):
+    '''Returns the parity (number of 1 bits, mod 2) of each entry of an array of unsigned 64-bit words.'''
+    x = numpy.array(words, dtype=numpy.uint64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        x ^= x >> numpy.uint64(shift)
+    return (x & numpy.uint64(1)).astype(numpy.uint8)
+
+class BinaryMatrix:
+    '''An m x n matrix over GF(2), that is, m n-bit strings. The rows are kept
+    packed into unsigned 64-bit words, as by pack, so that adding one row to
+    another is a few word XORs, and adding one row to many rows at once is a
+    single NumPy operation.'''
+
+    def __init__(self, words, n):
+        self.words = words
+        self.n = n
+
+    def bits(self):
+        '''Returns the rows as an m x n array of bits.'''
+        return unpack(self.words, self.n)
+
+    def tuples(self):
+        '''Returns the rows as a list of bit strings, as in the rest of this module.'''
+        return tuples(self.bits())
+
+    def reduction(self):
+        '''Returns a pair: the reduced row-echelon form of this matrix, as a new
+        BinaryMatrix with its zero rows last, and the list of pivot columns.'''
+        words = numpy.array(self.words)
+        m = len(words)
+        rank = 0
+        pivots = []
+        for j in range(self.n):
+            if rank == m:
+                break
+            w = j // 64
+            mask = numpy.uint64(1 << (63 - j % 64))
+            candidates = numpy.flatnonzero(words[rank:, w] & mask)
+            if len(candidates) == 0:
+                continue
+            i = rank + candidates[0]
+            words[[rank, i]] = words[[i, rank]]
+            # Clear column j in every other row, above and below, with one XOR.
+            hits = (words[:, w] & mask) != 0
+            hits[rank] = False
+            words[hits] ^= words[rank]
+            pivots.append(j)
+            rank += 1
+        return (BinaryMatrix(words, self.n), pivots)
+
+    def rank(self):
+        '''Returns the rank of this matrix.'''
+        return len(self.reduction()[1])
+
+    def nullSpace(self):
+        '''Returns a BinaryMatrix whose rows are a basis of the null space: the
+        n-bit strings x with dot(row, x) == 0 for every row.'''
+        reduced, pivots = self.reduction()
+        free = [j for j in range(self.n) if j not in pivots]
+        r = reduced.bits()[:len(pivots)]
+        basis = numpy.zeros((len(free), self.n), dtype=numpy.uint8)
+        basis[numpy.arange(len(free)), free] = 1
+        basis[:, pivots] = numpy.transpose(r[:, free])
+        return binaryMatrix(basis, self.n)
+
+    def solve(self, b):
+        '''Given an m-bit string b, returns an n-bit string x such that
+        dot(row i, x) == b[i] for every row i, as a tuple, or None if there is
+        none. Free variables are set to 0.'''
+        augmented = numpy.concatenate([self.bits(), numpy.asarray(b, dtype=numpy.uint8)[:, None]], axis=1)
+        reduced, pivots = binaryMatrix(augmented, self.n + 1).reduction()
+        if self.n in pivots:
+            return None
+        x = numpy.zeros(self.n, dtype=numpy.uint8)
+        x[pivots] = reduced.bits()[:len(pivots), self.n]
+        return tuple(x.tolist())
+
+
+def binaryMatrix(a, n=None):
+    '''Given a non-empty list of n-bit strings, or an m x n array of bits, returns them as a BinaryMatrix. An empty list needs n.'''
+    bits = numpy.asarray(a, dtype=numpy.uint8)
+    if n is None:
+        n = bits.shape[1]
+    bits = numpy.reshape(bits, (-1, n))
+    return BinaryMatrix(pack(bits), n)
+
 
 def reduction(a):
     '''A is a list of m >= 1 bit strings of equal dimension n >= 1. In other words, A is a non-empty m x n binary matrix. Returns the reduced row-echelon form of A. A itself is left unaltered.'''
-    b = a.copy()
-    m = len(b)
-    n = len(b[0])
-    rank = 0
-    for j in range(n):
-        # Try to swap two rows to make b[rank, j] a leading 1.
-        i = rank
-        while i < m and b[i][j] == 0:
-            i += 1
-        if i != m:
-            # Perform the swap.
-            temp = b[i]
-            b[i] = b[rank]
-            b[rank] = temp
-            # Reduce all leading 1s below the one we just made.
-            for i in range(rank + 1, m):
-                if b[i][j] == 1:
-                    b[i] = addition(b[i], b[rank])
-            rank += 1
-    for j in range(n - 1, -1, -1):
-        # Try to find the leading 1 in column j.
-        i = m - 1
-        while i >= 0 and b[i][j] != 1:
-            i -= 1
-        if i >= 0:
-            # Use the leading 1 at b[i, j] to reduce 1s above it.
-            for k in range(i):
-                if b[k][j] == 1:
-                    b[k] = addition(b[k], b[i])
-    return b
+    return binaryMatrix(a).reduction()[0].tuples()
+
+
+
+### DEFINING SOME TESTS ###
+
+def integerTest():
+    # Converts bit strings whose bits are ints, bools, NumPy bools and integers, and floats, and checks the round trip through string.
+    cases = [((1, 0, 1), 5), ((True, False, True), 5), (tuple(numpy.array([1, 0, 1], dtype=bool)), 5),
+             (tuple(numpy.array([1, 0], dtype=numpy.uint8)), 2), ((1.0, 0.0), 2), ((), 0)]
+    values = [integer(s) for s, m in cases]
+    if values == [m for s, m in cases] and all(integer(string(7, m)) == m for m in range(128)):
+        print("passed integerTest")
+    else:
+        print("failed integerTest")
+        print("    values = " + str(values))
+
+
+
+### RUNNING THE TESTS ###
 
+def main():
+    integerTest()
 
+if __name__ == "__main__":
+    main()
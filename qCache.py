@@ -0,0 +1,163 @@
+import math
+import random
+import hashlib
+import collections
+import numpy
+import qConstants as qc
+
+
+class Cache:
+    '''A least-recently-used cache of gates, states and oracles, bounded by the
+    total number of bytes it holds. Everything it returns is read-only, because
+    it is shared by every caller that asks for the same thing. If store is set
+    to a qStore.Store, misses are looked up there before anything is built.
+    Values mapped from the store's files take up almost no memory of their own,
+    so they count as 0 bytes against the budget; instead, at most mappings of
+    them are kept, since each holds a mapping and a file open.'''
+
+    def __init__(self, budget, store=None, mappings=256):
+        self.budget = budget
+        self.store = store
+        self.mappings = mappings
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.mapped = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, build):
+        '''Returns the value cached under key. On a miss, calls build() to make
+        it, freezes it, and caches it unless it alone exceeds the budget.'''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        if self.store is not None:
+            value = self.store.get(key, build)
+        else:
+            value = build()
+        for array in arrays(value):
+            array.flags.writeable = False
+        size = sum(array.nbytes for array in arrays(value) if not mapped(array))
+        count = int(any(mapped(array) for array in arrays(value)))
+        if size <= self.budget and count <= self.mappings:
+            self.entries[key] = (value, size, count)
+            self.size += size
+            self.mapped += count
+            self.evict()
+        return value
+
+    def evict(self):
+        '''Drops least recently used entries until the cache fits its budget, and least recently used mapped entries
+        until it holds at most mappings of them.'''
+        while self.size > self.budget:
+            key, (value, size, count) = self.entries.popitem(last=False)
+            self.size -= size
+            self.mapped -= count
+            self.evictions += 1
+        while self.mapped > self.mappings:
+            key = next(key for key, (value, size, count) in self.entries.items() if count > 0)
+            del self.entries[key]
+            self.mapped -= 1
+            self.evictions += 1
+
+    def resize(self, budget, mappings=None):
+        '''Changes the byte budget, and the limit on mapped entries if given, evicting as necessary.'''
+        self.budget = budget
+        if mappings is not None:
+            self.mappings = mappings
+        self.evict()
+
+    def clear(self):
+        '''Empties the cache. The statistics are kept.'''
+        self.entries.clear()
+        self.size = 0
+        self.mapped = 0
+
+    def statistics(self):
+        '''Returns a dictionary of hit, miss and eviction counts and current usage.'''
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.size, 'budget': self.budget, 'mapped': self.mapped}
+
+
+def arrays(value):
+    '''Returns the list of NumPy arrays that make up a cached value: the value itself, or an Oracle's tables.'''
+    if hasattr(value, 'indices'):
+        return [value.table, value.indices]
+    return [value]
+
+
+def mapped(array):
+    '''Returns whether a NumPy array is a memmap or a view of one.'''
+    while isinstance(array, numpy.ndarray):
+        if isinstance(array, numpy.memmap):
+            return True
+        array = array.base
+    return False
+
+
+def fingerprint(array):
+    '''Returns a hashable key identifying the contents of a NumPy array.'''
+    array = numpy.ascontiguousarray(array)
+    return (array.shape, array.dtype.str, hashlib.sha1(array).hexdigest())
+
+
+# The cache used by the gate constructors in qGates. 256 MiB by default; call gates.resize to change it. qStore.enable
+# backs it with a store on disk.
+gates = Cache(2**28)
+
+
+
+### DEFINING SOME TESTS ###
+
+def cacheTest():
+    # Fills a small cache past its budget and checks hits, misses, evictions and read-only values.
+    cache = Cache(3 * 8 * 16)
+    def build(k):
+        return lambda: numpy.full(16, k, dtype=numpy.float64)
+    for k in range(4):
+        cache.get(('full', k), build(k))
+    cache.get(('full', 1), build(1))
+    value = cache.get(('full', 0), build(0))
+    stats = cache.statistics()
+    if stats == {'hits': 1, 'misses': 5, 'evictions': 2, 'entries': 3, 'bytes': 3 * 8 * 16, 'budget': 3 * 8 * 16, 'mapped': 0} and not value.flags.writeable:
+        print("passed cacheTest")
+    else:
+        print("failed cacheTest")
+        print("    statistics = " + str(stats))
+
+
+def mappedTest(m):
+    # Caches arrays mapped from files alongside ordinary ones, and checks that the mapped ones cost no bytes but are capped in number.
+    import tempfile
+    directory = tempfile.mkdtemp()
+    def build(k):
+        def memmap():
+            array = numpy.lib.format.open_memmap(directory + '/' + str(k) + '.npy', mode='w+', dtype=numpy.float64, shape=(16,))
+            array[:] = k
+            return array
+        return memmap
+    cache = Cache(8 * 16, mappings=m)
+    cache.get('resident', lambda: numpy.zeros(16))
+    for k in range(2 * m):
+        cache.get(('mapped', k), build(k))
+    stats = cache.statistics()
+    kept = [k for k in range(2 * m) if ('mapped', k) in cache.entries]
+    if stats['mapped'] == m and stats['bytes'] == 8 * 16 and 'resident' in cache.entries and kept == list(range(m, 2 * m)):
+        print("passed mappedTest")
+    else:
+        print("failed mappedTest")
+        print("    statistics = " + str(stats) + ", kept = " + str(kept))
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    cacheTest()
+    mappedTest(4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+import math
+import random
+import numpy
+import qConstants as qc
+import qUtilities as qu
+import qGates as qg
+import qMeasurement as qm
+import qMemmap as qmm
+
+# A circuit is a list of operations, each a tuple (kind, payload, targets). The kinds are 'gate' (payload is a k-qbit
+# matrix), 'oracle' (payload is a qGates.Oracle or a dense gate), 'fourier' (payload is True for the inverse transform),
+# 'diffusion' (payload is None), 'phase' (payload is the array of marked basis states) and 'measure' (payload is None).
+# Nothing is computed until the circuit is run.
+
+
+class StateVector:
+    '''The default backend. Holds the whole n-qbit state as a NumPy array and
+    applies each operation with the matrix-free routines in qGates. Every
+    backend is constructed with the Generator that its measurements use.'''
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def start(self, n, ketPsi):
+        if ketPsi is None:
+            ketPsi = numpy.zeros(2**n, dtype=qc.one.dtype)
+            ketPsi[0] = 1
+        return ketPsi
+
+    def gate(self, state, u, targets):
+        return qg.targetedApplication(u, state, targets)
+
+    def oracle(self, state, f, targets):
+        return qg.targetedApplication(f, state, targets)
+
+    def fourier(self, state, inverse, targets):
+        return qg.fourierApplication(state, targets, inverse)
+
+    def diffusion(self, state, payload, targets):
+        return qg.diffusion(state, targets)
+
+    def phase(self, state, marked, targets):
+        return qg.phase(marked, state, targets)
+
+    def measure(self, state, targets):
+        bits = qm.sample(state, targets, rng=self.rng)[0]
+        return (qm.collapse(state, targets, bits), list(bits))
+
+
+class Memmap(StateVector):
+    '''Like StateVector, but holds the state in a numpy.memmap on disk (see
+    qMemmap), so that it can be larger than memory. The operations are the
+    same; qGates and qMeasurement hand memmap states to qMemmap.'''
+
+    def start(self, n, ketPsi):
+        if ketPsi is None:
+            return qmm.basis(n)
+        return qmm.copy(ketPsi)
+
+
+def stabilizer(rng):
+    '''Makes a qStabilizers.Stabilizer backend. qStabilizers is imported only when a circuit first needs it.'''
+    import qStabilizers as qs
+    return qs.Stabilizer(rng)
+
+# The backends that run knows by name, and the one it uses when none is named. 'auto' picks 'stabilizer' for Clifford
+# circuits that start from |0...0> and the default backend otherwise (the state vector if the default is 'auto').
+backends = {'statevector': StateVector, 'memmap': Memmap, 'stabilizer': stabilizer}
+backend = 'statevector'
+
+def defaultBackend():
+    '''Returns the backend that run uses when none is named, qCircuits.backend. (Within run, the name backend is taken.)'''
+    return backend
+
+
+class Circuit:
+    '''An n-qbit circuit that records operations instead of executing them.
+    compile returns an optimized copy, and run executes it on a backend.'''
+
+    def __init__(self, n):
+        self.n = n
+        self.operations = []
+
+    def gate(self, u, targets):
+        '''Appends the k-qbit gate U acting on the k listed qbits. A
+        qGates.Kronecker gate is appended as one gate per factor.'''
+        targets = tuple(targets)
+        if isinstance(u, qg.Kronecker):
+            offset = 0
+            for factor, width in zip(u.factors, u.widths):
+                self.gate(factor, targets[offset:offset + width])
+                offset += width
+            return self
+        self.operations.append(('gate', u, targets))
+        return self
+
+    def layer(self, u, targets):
+        '''Appends the one-qbit gate U on each of the listed qbits.'''
+        for target in targets:
+            self.gate(u, (target,))
+        return self
+
+    def oracle(self, f, targets=None):
+        '''Appends the gate F (usually a qGates.Oracle) on the listed qbits, by default all of them.'''
+        if targets is None:
+            targets = range(self.n)
+        self.operations.append(('oracle', f, tuple(targets)))
+        return self
+
+    def fourier(self, targets, inverse=False):
+        '''Appends the quantum Fourier transform, or its inverse, on the listed qbits.'''
+        self.operations.append(('fourier', inverse, tuple(targets)))
+        return self
+
+    def diffusion(self, targets):
+        '''Appends Grover's diffusion gate 2 |rho><rho| - I on the listed qbits.'''
+        self.operations.append(('diffusion', None, tuple(targets)))
+        return self
+
+    def phase(self, marked, targets):
+        '''Appends the phase oracle negating the listed basis states of the listed qbits.'''
+        self.operations.append(('phase', numpy.asarray(marked), tuple(targets)))
+        return self
+
+    def measure(self, targets):
+        '''Appends a measurement of the listed qbits. Measured qbits stay in the circuit, collapsed.'''
+        self.operations.append(('measure', None, tuple(targets)))
+        return self
+
+    def compile(self, width=2):
+        '''Returns an equivalent circuit in which adjacent inverse pairs are
+        cancelled, identities are dropped, and each run of gates acting within
+        the same at most width qbits is fused into one small matrix.'''
+        compiled = Circuit(self.n)
+        operations = compiled.operations
+        for operation in self.operations:
+            kind, payload, targets = operation
+            if kind == 'gate' and isIdentity(payload):
+                continue
+            j = latest(operations, len(operations), targets)
+            if j >= 0 and operations[j][2] == targets and isInversePair(operations[j], operation):
+                del operations[j]
+                continue
+            operations.append(operation)
+            if kind == 'gate':
+                absorption(operations, len(operations) - 1, width)
+        return compiled
+
+    def run(self, ketPsi=None, backend=None, rng=None):
+        '''Runs the circuit on the named backend (by default qCircuits.backend),
+        starting from |psi> or by default from |0...0>. Returns a pair
+        consisting of the final state and the list of measured bits, in the
+        order in which they were measured. rng is as in qUtilities.generator.
+        backend may also be a function that makes a backend from a Generator.'''
+        if backend is None:
+            backend = defaultBackend()
+        if backend == 'auto':
+            import qStabilizers as qs
+            if ketPsi is None and qs.isClifford(self):
+                backend = 'stabilizer'
+            elif defaultBackend() != 'auto':
+                backend = defaultBackend()
+            else:
+                backend = 'statevector'
+        if isinstance(backend, str):
+            backend = backends[backend]
+        engine = backend(qu.generator(rng))
+        state = engine.start(self.n, ketPsi)
+        bits = []
+        for kind, payload, targets in self.operations:
+            if kind == 'measure':
+                state, measured = engine.measure(state, targets)
+                bits += measured
+            else:
+                state = getattr(engine, kind)(state, payload, targets)
+        return (state, bits)
+
+
+def latest(operations, j, targets):
+    '''Returns the index of the latest of the first j operations that touches
+    any of the listed qbits, or -1 if there is none. Everything after it
+    commutes with an operation on those qbits.'''
+    j -= 1
+    while j >= 0 and set(operations[j][2]).isdisjoint(targets):
+        j -= 1
+    return j
+
+
+def absorption(operations, j, width):
+    '''Repeatedly fuses the gate operation at index j into the latest earlier
+    gate touching its qbits, for as long as fusion allows. The fused gate takes
+    the earlier position, which is safe because nothing in between touches the
+    later gate's qbits. Pairs that fuse to the identity are dropped.'''
+    while True:
+        i = latest(operations, j, operations[j][2])
+        if i < 0 or operations[i][0] != 'gate':
+            return
+        fused = fusion(operations[i], operations[j], width)
+        if fused is None:
+            return
+        del operations[j]
+        if isIdentity(fused[1]):
+            del operations[i]
+            return
+        operations[i] = fused
+        j = i
+
+
+def isIdentity(u):
+    '''Returns whether the gate U is the identity, to within a small tolerance.'''
+    return numpy.allclose(u, numpy.identity(len(u)), rtol=0, atol=qc.epsilon)
+
+
+def isInversePair(a, b):
+    '''Given two operations on the same qbits, returns whether b undoes a. Oracles, phase oracles and diffusion are
+    their own inverses.'''
+    if a[0] == 'fourier' and b[0] == 'fourier':
+        return a[1] != b[1]
+    if a[0] == 'diffusion' and b[0] == 'diffusion':
+        return True
+    if a[0] == 'phase' and b[0] == 'phase':
+        return numpy.array_equal(a[1], b[1])
+    if a[0] == 'oracle' and b[0] == 'oracle':
+        if isinstance(a[1], qg.Oracle) and isinstance(b[1], qg.Oracle):
+            return numpy.array_equal(a[1].indices, b[1].indices)
+        return a[1] is b[1]
+    return False
+
+
+def fusion(a, b, width):
+    '''Given gate operations a and then b, where a is the latest operation
+    touching b's qbits, returns one gate operation doing both. Returns None if
+    their qbits differ and either neither contains the other or the larger
+    spans more than width qbits.'''
+    if a[2] == b[2]:
+        return ('gate', numpy.dot(b[1], a[1]), a[2])
+    if len(a[2]) > width or len(b[2]) > width:
+        return None
+    if set(a[2]) <= set(b[2]):
+        return ('gate', numpy.dot(b[1], embedding(a[1], a[2], b[2])), b[2])
+    if set(b[2]) <= set(a[2]):
+        return ('gate', numpy.dot(embedding(b[1], b[2], a[2]), a[1]), a[2])
+    return None
+
+
+def embedding(u, targets, within):
+    '''Given a gate U on the listed qbits, which are among the k qbits listed in
+    within, returns the k-qbit gate that applies U to them and the identity to
+    the rest, with qbits ordered as in within.'''
+    k = len(within)
+    positions = [within.index(target) for target in targets]
+    columns = [qg.targetedApplication(u, column, positions) for column in numpy.identity(2**k, dtype=qc.one.dtype)]
+    return numpy.transpose(numpy.array(columns))
+
+
+
+### DEFINING SOME TESTS ###
+
+def compileTest(n):
+    # Assumes n >= 2. Builds a circuit full of cancelling and fusable gates, and checks that compiling shrinks it without changing what it does.
+    circuit = Circuit(n)
+    circuit.layer(qc.h, range(n)).layer(qc.h, range(n))
+    circuit.gate(qc.i, (0,)).gate(qc.x, (0,)).gate(qc.z, (0,))
+    circuit.gate(qc.h, (1,)).gate(qc.cnot, (0, 1)).gate(qc.h, (1,))
+    circuit.fourier(range(n)).fourier(range(n), inverse=True)
+    compiled = circuit.compile()
+    ketPsi = qu.uniform(n)
+    a = circuit.run(ketPsi)[0]
+    b = compiled.run(ketPsi)[0]
+    if qu.equal(a, b, qc.epsilon) and len(compiled.operations) == 1:
+        print("passed compileTest")
+    else:
+        print("failed compileTest")
+        print("    operations = " + str([operation[0] for operation in compiled.operations]))
+        print("    a = " + str(a))
+        print("    b = " + str(b))
+
+def kroneckerTest(n):
+    # Assumes n >= 2. Appends a lazy H tensor ... tensor H twice, around a CNOT on other qbits, and checks that compiling cancels the Hadamards.
+    circuit = Circuit(n + 2).gate(qg.power(qc.h, n, lazy=True), range(n))
+    circuit.gate(qc.cnot, (n, n + 1)).gate(qg.power(qc.h, n, lazy=True), range(n))
+    compiled = circuit.compile()
+    ketPsi = qu.uniform(n + 2)
+    if qu.equal(circuit.run(ketPsi)[0], compiled.run(ketPsi)[0], qc.epsilon) and len(compiled.operations) == 1:
+        print("passed kroneckerTest")
+    else:
+        print("failed kroneckerTest")
+        print("    operations = " + str([operation[0] for operation in compiled.operations]))
+
+def measureTest(n):
+    # Assumes n >= 2. Prepares a GHZ state, measures one qbit, and checks that the others agree with it.
+    circuit = Circuit(n).gate(qc.h, (0,))
+    for k in range(1, n):
+        circuit.gate(qc.cnot, (0, k))
+    circuit.measure([n - 1]).measure(range(n - 1))
+    state, bits = circuit.compile().run()
+    if len(set(bits)) == 1 and abs(state[0 if bits[0] == 0 else -1]) > 0.999999:
+        print("passed measureTest")
+    else:
+        print("failed measureTest")
+        print("    bits = " + str(bits))
+
+def memmapTest(n):
+    # Assumes n >= 3. Runs the same circuit, with its ops on qbits outside a chunk, in memory and on disk with tiny chunks.
+    circuit = Circuit(n).layer(qc.h, range(n)).gate(qc.cnot, (0, n - 1)).fourier(range(n - 1))
+    circuit.oracle(qg.oracle(1, 1, [1, 0]), (0, 1)).diffusion(range(1, n)).phase([3], (n - 1, 0))
+    ketPsi = qu.uniform(n)
+    saved = qmm.chunk
+    qmm.chunk = 2**(n - 1)
+    a = circuit.run(ketPsi)[0]
+    b = circuit.run(ketPsi, backend='memmap')[0]
+    qmm.chunk = saved
+    if isinstance(b, numpy.memmap) and qu.equal(a, numpy.asarray(b), qc.epsilon):
+        print("passed memmapTest")
+    else:
+        print("failed memmapTest")
+        print("    a = " + str(a))
+        print("    b = " + str(b))
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    compileTest(3)
+    compileTest(4)
+    kroneckerTest(3)
+    measureTest(4)
+    memmapTest(6)
+
+if __name__ == "__main__":
+    main()
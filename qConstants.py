@@ -1,12 +1,6 @@
 import math
 import random
 import numpy
-import qConstants as qc
-import qUtilities as qu
-import qBitStrings as qb
-import qGates as qg
-import qMeasurement as qm
-import qAlgorithms as qa
 
 # In numpy, I think that the default complex dtype varies from platform to platform. If you want to explicitly use the default type in your code, use 'one.dtype' (where one is defined just below).
 
@@ -17,8 +11,8 @@ zero = numpy.array(0 + 0j)
 # Our favorite one-qbit states.
 ket0 = numpy.array([1 + 0j, 0 + 0j])
 ket1 = numpy.array([0 + 0j, 1 + 0j])
-ketPlus = numpy.array([1 / math.sqrt(2), 1 / math.sqrt(2)])
-ketMinus = numpy.array([1 / math.sqrt(2), -1 / math.sqrt(2)])
+ketPlus = numpy.array([1 / math.sqrt(2) + 0j, 1 / math.sqrt(2) + 0j])
+ketMinus = numpy.array([1 / math.sqrt(2) + 0j, -1 / math.sqrt(2) + 0j])
 
 # Our favorite one-qbit gates.
 i = numpy.array([
@@ -45,4 +39,24 @@ swap = numpy.array([
     [1 + 0j, 0 + 0j, 0 + 0j, 0 + 0j],
     [0 + 0j, 0 + 0j, 1 + 0j, 0 + 0j],
     [0 + 0j, 1 + 0j, 0 + 0j, 0 + 0j],
-    [0 + 0j, 0 + 0j, 0 + 0j, 1 + 0j]])
\ No newline at end of file
+    [0 + 0j, 0 + 0j, 0 + 0j, 1 + 0j]])
+
+# The precision policy. Every state and gate that the project builds uses the complex dtype of one, which setPrecision
+# changes for the whole project. Single precision (complex64) halves the memory of every state, at the cost of
+# accuracy, so tests should compare with tolerance epsilon rather than a fixed number.
+epsilon = 0.000001
+exact = {'one': one, 'zero': zero, 'ket0': ket0, 'ket1': ket1, 'ketPlus': ketPlus, 'ketMinus': ketMinus,
+         'i': i, 'x': x, 'y': y, 'z': z, 'h': h, 'cnot': cnot, 'swap': swap}
+
+def setPrecision(dtype):
+    '''Given numpy.complex128 (the default) or numpy.complex64, rebuilds the constants above in that dtype and sets epsilon to a matching tolerance. Code elsewhere reads one.dtype when it builds an array, so it follows along. Call this before building any states or gates, since those already built keep their dtype.'''
+    global epsilon
+    dtype = numpy.dtype(dtype)
+    if dtype == numpy.complex128:
+        epsilon = 0.000001
+    elif dtype == numpy.complex64:
+        epsilon = 0.0001
+    else:
+        raise ValueError("precision must be complex128 or complex64, not " + str(dtype))
+    for name, value in exact.items():
+        globals()[name] = value.astype(dtype)
@@ -1,79 +1,368 @@
 import math
 import random
+import functools
 import numpy
 import qConstants as qc
 import qUtilities as qu
 import qBitStrings as qb
-import qGates as qg
-import qMeasurement as qm
-import qAlgorithms as qa
+import qCache as qca
+
+
+class Oracle:
+    '''An (n + m)-qbit gate F representing a function f : {0, 1}^n -> {0, 1}^m,
+    stored as the permutation |alpha>|beta> -> |alpha>|beta + f(alpha)> of
+    basis states rather than as a 2^(n + m) x 2^(n + m) matrix. indices[j] is
+    the basis state that F sends to basis state j (F is its own inverse, so it
+    is also where F sends j), and table[alpha] is f(alpha) as an integer.
+    indices may be passed in, if already known, to skip computing it.'''
+
+    def __init__(self, n, m, table, indices=None):
+        self.n = n
+        self.m = m
+        self.table = numpy.asarray(table, dtype=numpy.intp)
+        if indices is None:
+            alphas = numpy.arange(2**n, dtype=numpy.intp)[:, None]
+            betas = numpy.arange(2**m, dtype=numpy.intp)[None, :]
+            indices = ((alphas << m) | (betas ^ self.table[:, None])).reshape(2**(n + m))
+        self.indices = numpy.asarray(indices, dtype=numpy.intp)
+
+    def matrix(self):
+        '''Returns F as an ordinary dense (n + m)-qbit gate. For tests only.'''
+        F = numpy.zeros((2**(self.n + self.m), 2**(self.n + self.m)), dtype=qc.one.dtype)
+        F[numpy.arange(2**(self.n + self.m)), self.indices] = 1
+        return F
+
+
+class Affine:
+    '''An (n + m)-qbit oracle gate F for an affine function f : {0, 1}^n ->
+    {0, 1}^m, f(alpha) = M alpha + c with arithmetic mod 2, stored as the m x n
+    bit matrix M and the m-bit offset c instead of as a truth table, so that n
+    can be large. It is a Clifford gate: one CNOT per 1 in M and one X per 1 in
+    c, which qStabilizers uses. oracle() converts it to an ordinary Oracle.'''
+
+    def __init__(self, matrix, offset=None):
+        self.matrix = numpy.array(matrix, dtype=numpy.uint8) % 2
+        self.m, self.n = self.matrix.shape
+        if offset is None:
+            offset = numpy.zeros(self.m, dtype=numpy.uint8)
+        self.offset = numpy.array(offset, dtype=numpy.uint8) % 2
+
+    def table(self):
+        '''Returns the truth table of f, as for truthTable. Needs memory linear in 2^n.'''
+        alphas = qb.bitArray(numpy.arange(2**self.n), self.n)
+        return qb.integers((numpy.dot(alphas, self.matrix.T) + self.offset) % 2)
+
+    def oracle(self):
+        '''Returns F as an Oracle.'''
+        return oracle(self.n, self.m, self.table())
+
+
+class Kronecker:
+    '''A gate U_1 tensor U_2 tensor ... tensor U_j stored as its list of
+    factors rather than as one big matrix. Applying it to a state applies the
+    factors one at a time to their own qbits, which costs O(2^n) per factor
+    instead of O(4^n). Kronecker gates compose with each other factor by
+    factor. matrix() builds the dense gate, as does numpy.asarray. ndim, shape
+    and size describe the dense gate without building it.'''
+
+    def __init__(self, factors):
+        self.factors = []
+        for factor in factors:
+            if isinstance(factor, Kronecker):
+                self.factors += factor.factors
+            else:
+                factor = numpy.asarray(factor, dtype=qc.one.dtype)
+                if factor.ndim != 2 or factor.shape[0] != factor.shape[1] or factor.shape[0] & (factor.shape[0] - 1) != 0:
+                    raise ValueError("a Kronecker factor must be a gate, not an array of shape " + str(factor.shape))
+                self.factors.append(factor)
+        self.widths = [len(factor).bit_length() - 1 for factor in self.factors]
+        self.n = sum(self.widths)
+        self.ndim = 2
+        self.shape = (2**self.n, 2**self.n)
+        self.size = 4**self.n
+
+    def __len__(self):
+        return 2**self.n
+
+    def apply(self, ketPsi, targets=None):
+        '''Applies the gate to the listed qbits of the state |psi> (by default its first n), factor by factor.'''
+        if targets is None:
+            targets = range(self.n)
+        targets = list(targets)
+        offset = 0
+        for factor, width in zip(self.factors, self.widths):
+            ketPsi = targetedApplication(factor, ketPsi, targets[offset:offset + width])
+            offset += width
+        return ketPsi
+
+    def compose(self, other):
+        '''Returns the Kronecker gate U V, which applies V and then U, for another Kronecker gate V on as many qbits.
+        Where the factors of U and V do not line up, adjacent factors are multiplied out until they do.'''
+        if self.n != other.n:
+            raise ValueError("cannot compose Kronecker gates on " + str(self.n) + " and " + str(other.n) + " qbits, with factor widths "
+                             + str(self.widths) + " and " + str(other.widths))
+        a, b = list(self.factors), list(other.factors)
+        factors = []
+        while len(a) > 0:
+            u, v = a.pop(0), b.pop(0)
+            while len(u) != len(v):
+                if len(u) < len(v):
+                    u = numpy.kron(u, a.pop(0))
+                else:
+                    v = numpy.kron(v, b.pop(0))
+            factors.append(numpy.dot(u, v))
+        return Kronecker(factors)
+
+    def __matmul__(self, other):
+        return self.compose(other)
+
+    def matrix(self):
+        '''Returns the gate as an ordinary dense matrix.'''
+        result = self.factors[0]
+        for factor in self.factors[1:]:
+            result = numpy.kron(result, factor)
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        return numpy.asarray(self.matrix(), dtype=dtype)
+
+
+# States that need their own kernels, such as memmaps and large states when threading is on, are handed over by
+# handlers. A handler is a function handler(operation, state) that returns the routine to use in place of the named one
+# of qGates or qMeasurement, called with the same arguments, or None to decline. qMemmap and qThreads register theirs
+# here when they are imported, so that this module does not import them.
+handlers = []
+
+def handled(operation, state):
+    '''Returns the first registered handler's routine for the named operation on the given state, or None.'''
+    for handler in handlers:
+        routine = handler(operation, state)
+        if routine is not None:
+            return routine
+    return None
 
 
 def application(u, ketPsi):
-    '''Assumes n >= 1. Applies the n-qbit gate U to the n-qbit state |psi>, returning the n-qbit state U |psi>.'''
-    return numpy.dot(u, ketPsi)
+    '''Assumes n >= 1. Applies the n-qbit gate U to the n-qbit state |psi>, returning the n-qbit state U |psi>. U may be an Oracle, an Affine oracle or a Kronecker gate.'''
+    if isinstance(u, Kronecker):
+        return u.apply(ketPsi)
+    if isinstance(u, Affine):
+        u = u.oracle()
+    if isinstance(u, Oracle):
+        routine = handled('oracle', ketPsi)
+        if routine is not None:
+            return routine(u, ketPsi, range(u.n + u.m))
+        return ketPsi[u.indices]
+    return numpy.dot(numpy.asarray(u, dtype=qc.one.dtype), numpy.asarray(ketPsi, dtype=qc.one.dtype))
+
+
+def targetedApplication(u, ketPsi, targets):
+    '''Assumes n >= k >= 1. Applies the k-qbit gate U to the qbits of the
+    n-qbit state |psi> listed in targets, in that order. Qbit 0 is the first
+    (leftmost) qbit. Returns the new n-qbit state. The state is viewed as a
+    tensor with n axes of length 2 and only the target axes are contracted, so
+    this costs O(2^n 4^k) time and O(2^n) memory instead of building a
+    2^n x 2^n gate. U may be an Oracle, an Affine oracle or a Kronecker gate.
+    A numpy.memmap state is handed to qMemmap, which works chunk by chunk, and
+    a large state to qThreads when threading is on, through their handlers.'''
+    if isinstance(u, Kronecker):
+        return u.apply(ketPsi, targets)
+    if isinstance(u, Affine):
+        u = u.oracle()
+    routine = handled('targetedApplication', ketPsi)
+    if routine is not None:
+        return routine(u, ketPsi, targets)
+    targets = list(targets)
+    k = len(targets)
+    n = len(ketPsi).bit_length() - 1
+    psi = numpy.reshape(numpy.asarray(ketPsi, dtype=qc.one.dtype), n * (2,))
+    if isinstance(u, Oracle):
+        # Gather along the target axes, which are moved to the end and flattened.
+        psi = numpy.moveaxis(psi, targets, list(range(n - k, n)))
+        shape = psi.shape
+        psi = numpy.reshape(psi, (2**(n - k), 2**k))[:, u.indices]
+        psi = numpy.moveaxis(numpy.reshape(psi, shape), list(range(n - k, n)), targets)
+        return numpy.reshape(psi, 2**n)
+    uTensor = numpy.reshape(numpy.asarray(u, dtype=qc.one.dtype), 2 * k * (2,))
+    # Contract the input axes of U with the target axes of psi. The k output axes of U come first in the result.
+    psi = numpy.tensordot(uTensor, psi, axes=(list(range(k, 2 * k)), targets))
+    psi = numpy.moveaxis(psi, list(range(k)), targets)
+    return numpy.reshape(psi, 2**n)
+
 
+def powerApplication(u, ketPsi, targets):
+    '''Assumes n >= 1. Applies the one-qbit gate U to each of the listed qbits
+    of the n-qbit state |psi>. Equivalent to applying a tensor power of U (with
+    identities on the other qbits), but never builds that big gate.'''
+    for target in targets:
+        ketPsi = targetedApplication(u, ketPsi, (target,))
+    return ketPsi
 
-def tensor(a, b):
-   return numpy.kron(a,b)
+
+def tensor(a, b, lazy=False):
+    '''Returns the tensor product of two states or two gates. For two gates,
+    if lazy is True or either is already a Kronecker gate, the product is
+    returned as a Kronecker gate instead of being multiplied out.'''
+    if lazy or isinstance(a, Kronecker) or isinstance(b, Kronecker):
+        if numpy.ndim(a) != 2 or numpy.ndim(b) != 2:
+            raise ValueError("a lazy tensor product needs two gates, not arrays of " + str(numpy.ndim(a)) + " and " + str(numpy.ndim(b)) + " dimensions")
+        return Kronecker([a, b])
+    return numpy.kron(numpy.asarray(a, dtype=qc.one.dtype), numpy.asarray(b, dtype=qc.one.dtype))
+
+
+def truthTable(n, m, f, vectorized=False, processes=None):
+    '''Assumes n, m >= 1. Returns the truth table of f : {0, 1}^n -> {0, 1}^m
+    as a NumPy integer array whose entry alpha is f(alpha) as an integer. f may
+    be a Python function on bit strings (as in qBitStrings.py), which is called
+    exactly once per input; a vectorized function mapping an integer array of
+    inputs to an integer array of outputs, if vectorized is True; or an
+    already-computed table, either as 2^n integers or as a 2^n x m array of
+    bits. If processes is given, a Python function f is evaluated in a pool of
+    that many processes, so f must be picklable.'''
+    if isinstance(f, (numpy.ndarray, list, tuple)):
+        table = numpy.asarray(f)
+        if table.ndim == 2:
+            # Rows are bit strings.
+            table = qb.integers(table)
+    elif vectorized:
+        table = numpy.asarray(f(numpy.arange(2**n)))
+    else:
+        alphas = qb.tuples(qb.strings(n))
+        if processes is None:
+            values = [f(alpha) for alpha in alphas]
+        else:
+            # multiprocessing is slow to import, and rarely needed.
+            import multiprocessing
+            with multiprocessing.Pool(processes) as pool:
+                values = pool.map(f, alphas, chunksize=max(1, 2**n // (4 * processes)))
+        table = numpy.array([qb.integer(value) for value in values])
+    table = table.astype(numpy.intp)
+    if table.shape != (2**n,) or table.min() < 0 or table.max() >= 2**m:
+        raise ValueError("f is not a function from {0, 1}^" + str(n) + " to {0, 1}^" + str(m))
+    return table
 
 
-def function(n, m, f):
+def function(n, m, f, vectorized=False, processes=None):
     '''Assumes n, m == 1. Given a Python function f : {0, 1}^n -> {0, 1}^m.
 That is, f takes as input an n-bit string and produces as output an m-bit
 string, as defined in qBitStrings.py. Returns the corresponding
-(n + m)-qbit gate F.'''
-    alpha = n * (0,)
-    beta = m * (0,)
-    F = numpy.zeros((2**(n+m), 2**(n+m)), dtype=numpy.array(0 + 0j).dtype)
-    #Helper function to convert bits to their corresponding quantum states
-    def g(bit):
-        if bit == 0:
-            return qc.ket0
-        else:
-            return qc.ket1
-    #Helper function to make state from string. 
-    def stringToState(alpha):
-        state = g(alpha[0])
-        for i in range(1, len(alpha)):
-            state = tensor(state, g(alpha[i]))
-        return state
-    #Looping over alpha and beta to make the big gate F.
-    for i in range(2**n):
-        ketAlpha = stringToState(alpha)
-        for j in range (2**m):
-            ketsum = stringToState(qb.addition(beta, f(alpha)))
-            ketGamma = tensor(ketAlpha, ketsum)
-            #Coverting bitstring to its corresponding integer. 
-            integer = qb.integer(alpha + beta)
-            #Making the columns of big F gate.
-            F[integer] = ketGamma
-            beta = qb.next(beta)
-        alpha = qb.next(alpha)
-    return F
-
-
-def power(stateOrGate, m):
+(n + m)-qbit gate F. f may also be given in any of the forms accepted by
+truthTable. The result is cached in qCache.gates, keyed by the truth table, and
+read-only.'''
+    F = oracle(n, m, f, vectorized, processes)
+    return qca.gates.get(('function', n, m, qc.one.dtype.str, qca.fingerprint(F.table)), F.matrix)
+
+
+def oracle(n, m, f, vectorized=False, processes=None):
+    '''Assumes n, m >= 1. Given f : {0, 1}^n -> {0, 1}^m in any of the forms
+    accepted by truthTable, returns the corresponding (n + m)-qbit gate F as an
+    Oracle. Evaluates f once per n-bit string and uses memory linear in
+    2^(n + m). The result is cached in qCache.gates, keyed by the truth table,
+    and its arrays are read-only.'''
+    table = truthTable(n, m, f, vectorized, processes)
+    return qca.gates.get(('oracle', n, m, qca.fingerprint(table)), lambda: Oracle(n, m, table))
+
+
+def power(stateOrGate, m, lazy=False):
     '''Assumes n >= 1. Given an n-qbit gate or state and m >= 1, returns the
     mth tensor power, which is an (n * m)-qbit gate or state. For the sake of
-    time and memory, m should be small.'''
+    time and memory, m should be small. For m >= 2 the result is cached in
+    qCache.gates and read-only. If lazy is True and a gate is given, instead
+    returns the power as a Kronecker gate of m factors, which any m is fine for.'''
+    if lazy and numpy.ndim(stateOrGate) == 2:
+        return Kronecker(m * [stateOrGate])
     if m == 1:
         return stateOrGate
     else:
-        temp = stateOrGate
-        for i in range(m-1):
-            temp = tensor(temp, stateOrGate)
-        return temp
+        def build():
+            temp = stateOrGate
+            for i in range(m-1):
+                temp = tensor(temp, stateOrGate)
+            return temp
+        return qca.gates.get(('power', qca.fingerprint(stateOrGate), m, qc.one.dtype.str), build)
+
+
+def diffusion(ketPsi, targets=None):
+    '''Assumes n >= k >= 1. Applies Grover's diffusion gate 2 |rho><rho| - I,
+    where |rho> is the uniform superposition, to the listed qbits of the n-qbit
+    state |psi> (by default all of them). On each slice of the other qbits this
+    is 2 <rho|psi> |rho> - |psi>, so it costs O(2^n) and never builds the gate.'''
+    n = len(ketPsi).bit_length() - 1
+    if targets is None:
+        targets = range(n)
+    routine = handled('diffusion', ketPsi)
+    if routine is not None:
+        return routine(ketPsi, targets)
+    targets = list(targets)
+    k = len(targets)
+    psi = numpy.moveaxis(numpy.reshape(ketPsi, n * (2,)), targets, list(range(n - k, n)))
+    shape = psi.shape
+    psi = numpy.reshape(psi, (2**(n - k), 2**k))
+    psi = 2 * numpy.mean(psi, axis=1, keepdims=True) - psi
+    psi = numpy.moveaxis(numpy.reshape(psi, shape), list(range(n - k, n)), targets)
+    return numpy.reshape(psi, 2**n)
+
+
+def phase(marked, ketPsi, targets=None):
+    '''Assumes n >= k >= 1. Applies the phase oracle that negates the basis
+    states |alpha> of the listed qbits (by default all n) for the alpha listed
+    in marked, which is an array of integers, to the n-qbit state |psi>. This is
+    the ancilla-free form of an oracle for f : {0, 1}^k -> {0, 1}, with marked
+    listing the alpha where f(alpha) = 1.'''
+    n = len(ketPsi).bit_length() - 1
+    if targets is None:
+        targets = range(n)
+    routine = handled('phase', ketPsi)
+    if routine is not None:
+        return routine(marked, ketPsi, targets)
+    targets = list(targets)
+    k = len(targets)
+    psi = numpy.moveaxis(numpy.reshape(ketPsi, n * (2,)), targets, list(range(n - k, n)))
+    shape = psi.shape
+    psi = numpy.array(numpy.reshape(psi, (2**(n - k), 2**k)))
+    psi[:, marked] *= -1
+    psi = numpy.moveaxis(numpy.reshape(psi, shape), list(range(n - k, n)), targets)
+    return numpy.reshape(psi, 2**n)
 
 
 def fourier(n):
-    '''Assumes n >= 1. Returns the n-qbit quantum Fourier transform gate T.'''
-    T = numpy.zeros((2**(n), 2**(n)), dtype=numpy.array(0 + 0j).dtype)
-    normalizationConstant = (1 / 2**(n / 2))
-    for alpha in range(2**n):
-        for beta in range(2**n):
-            T[alpha, beta] = numpy.exp(1j * 2 * numpy.pi * alpha * beta / 2**n)      
-    return  normalizationConstant * T
+    '''Assumes n >= 1. Returns the n-qbit quantum Fourier transform gate T.
+    The result is cached in qCache.gates and read-only. To apply T to a state,
+    fourierApplication is much faster.'''
+    def build():
+        alphas = numpy.arange(2**n)
+        # Reduce alpha * beta mod 2^n before scaling, so that the angles stay small and accurate.
+        T = numpy.exp(1j * 2 * numpy.pi * (numpy.outer(alphas, alphas) % 2**n) / 2**n)
+        return ((1 / 2**(n / 2)) * T).astype(qc.one.dtype)
+    return qca.gates.get(('fourier', n, qc.one.dtype.str), build)
+
+
+def fourierApplication(ketPsi, targets=None, inverse=False):
+    '''Assumes n >= k >= 1. Applies the k-qbit quantum Fourier transform T (or
+    its inverse) to the listed qbits of the n-qbit state |psi>, treating the
+    first listed qbit as the most significant. By default the targets are all
+    n qbits. Uses the FFT, so this costs O(2^n k) time instead of the O(4^k)
+    needed to build T and apply it densely. Agrees with fourier(k).'''
+    n = len(ketPsi).bit_length() - 1
+    if targets is None:
+        targets = range(n)
+    routine = handled('fourierApplication', ketPsi)
+    if routine is not None:
+        return routine(ketPsi, targets, inverse)
+    targets = list(targets)
+    k = len(targets)
+    # Move the register to the last axes, transform along it, and move it back.
+    psi = numpy.moveaxis(numpy.reshape(ketPsi, n * (2,)), targets, list(range(n - k, n)))
+    shape = psi.shape
+    psi = numpy.reshape(psi, (2**(n - k), 2**k))
+    # T has entries exp(+2 pi i alpha beta / 2^k) / 2^(k / 2), which is NumPy's orthonormal inverse FFT.
+    if inverse:
+        psi = numpy.fft.fft(psi, axis=1, norm="ortho")
+    else:
+        psi = numpy.fft.ifft(psi, axis=1, norm="ortho")
+    psi = psi.astype(qc.one.dtype, copy=False)
+    psi = numpy.moveaxis(numpy.reshape(psi, shape), list(range(n - k, n)), targets)
+    return numpy.reshape(psi, 2**n)
 
     
     
@@ -86,14 +375,14 @@ def fourier(n):
 def applicationTest():
     # These simple tests detect type errors but not much else.
     answer = application(qc.h, qc.ketMinus)
-    if qu.equal(answer, qc.ket1, 0.000001):
+    if qu.equal(answer, qc.ket1, qc.epsilon):
         print("passed applicationTest first part")
     else:
         print("FAILED applicationTest first part")
         print("    H |-> = " + str(answer))
     ketPsi = qu.uniform(2)
     answer = application(qc.swap, application(qc.swap, ketPsi))
-    if qu.equal(answer, ketPsi, 0.000001):
+    if qu.equal(answer, ketPsi, qc.epsilon):
         print("passed applicationTest second part")
     else:
         print("FAILED applicationTest second part")
@@ -101,6 +390,27 @@ def applicationTest():
         print("    answer = " + str(answer))
 
 
+def targetedApplicationTest(n):
+    # Assumes n >= 3. Applies CNOT with control qbit n - 1 and target qbit 1, then H to qbit 0, and compares against dense gates.
+    ketPsi = qu.uniform(n)
+    # Build the dense CNOT column by column, from its action on basis states.
+    cnotDense = numpy.zeros((2**n, 2**n), dtype=qc.one.dtype)
+    for a in range(2**n):
+        alpha = qb.string(n, a)
+        if alpha[n - 1] == 1:
+            alpha = alpha[:1] + (1 - alpha[1],) + alpha[2:]
+        cnotDense[qb.integer(alpha), a] = 1
+    hDense = tensor(qc.h, power(qc.i, n - 1))
+    a = application(hDense, application(cnotDense, ketPsi))
+    b = targetedApplication(qc.h, targetedApplication(qc.cnot, ketPsi, (n - 1, 1)), (0,))
+    if qu.equal(a, b, qc.epsilon):
+        print("passed targetedApplicationTest")
+    else:
+        print("FAILED targetedApplicationTest")
+        print("    a = " + str(a))
+        print("    b = " + str(b))
+
+
 def tensorTest():
     # Pick two gates and two states.
     u = qc.x
@@ -111,7 +421,7 @@ def tensorTest():
     a = tensor(application(u, ketChi), application(v, ketOmega))
     b = application(tensor(u, v), tensor(ketChi, ketOmega))
     # Compare.
-    if qu.equal(a, b, 0.000001):
+    if qu.equal(a, b, qc.epsilon):
         print("passed tensorTest")
     else:
         print("FAILED tensorTest")
@@ -119,6 +429,38 @@ def tensorTest():
         print("    b = " + str(b))
 
 
+def kroneckerTest(n):
+    # Builds H tensor ... tensor H and a mixed Kronecker gate lazily, and checks applying, composing, and targeting them against the dense matrices.
+    lazyH = power(qc.h, n, lazy=True)
+    mixed = tensor(tensor(qc.x, qc.cnot, lazy=True), power(qc.y, n - 3, lazy=True))
+    ketPsi = qu.uniform(n + 1)
+    a = application(lazyH @ mixed, ketPsi[:2**n] / numpy.linalg.norm(ketPsi[:2**n]))
+    b = application(numpy.dot(power(qc.h, n), numpy.asarray(mixed)), ketPsi[:2**n] / numpy.linalg.norm(ketPsi[:2**n]))
+    c = targetedApplication(mixed, ketPsi, list(range(n, 0, -1)))
+    d = targetedApplication(mixed.matrix(), ketPsi, list(range(n, 0, -1)))
+    if qu.equal(a, b, qc.epsilon) and qu.equal(c, d, qc.epsilon) and len(mixed.factors) == n - 1:
+        print("passed kroneckerTest")
+    else:
+        print("FAILED kroneckerTest")
+        print("    a = " + str(a))
+        print("    b = " + str(b))
+
+
+def kroneckerErrorTest(n):
+    # Checks that mismatched compositions and lazy tensor products of states raise ValueError.
+    errors = 0
+    for bad in [lambda: power(qc.h, n, lazy=True) @ power(qc.h, n + 1, lazy=True),
+                lambda: tensor(qc.ket0, qc.ket1, lazy=True), lambda: tensor(qc.h, qc.ket1, lazy=True)]:
+        try:
+            bad()
+        except ValueError:
+            errors += 1
+    if errors == 3:
+        print("passed kroneckerErrorTest")
+    else:
+        print("FAILED kroneckerErrorTest")
+
+
 def functionTest(n, m):
     # 2^n times, randomly pick an m-bit string.
     values = [qb.string(m, random.randrange(0, 2**m)) for k in range(2**n)]
@@ -152,7 +494,7 @@ def functionTest(n, m):
         ketBeta = ketFromBitString(beta)
         ketAlleged = application(ff, tensor(ketAlpha, ketBeta))
         # Compare.
-        if not qu.equal(ketCorrect, ketAlleged, 0.000001):
+        if not qu.equal(ketCorrect, ketAlleged, qc.epsilon):
             print("failed functionTest")
             print(" alpha = " + str(alpha))
             print(" beta = " + str(beta))
@@ -166,11 +508,45 @@ def functionTest(n, m):
     print("passed functionTest")
 
 
+def oracleTest(n, m):
+    # Builds the same random f as a dense gate and as an Oracle, and compares their action on a random state.
+    values = [qb.string(m, random.randrange(0, 2**m)) for k in range(2**n)]
+    def f(alpha):
+        return values[qb.integer(alpha)]
+    ketPsi = qu.uniform(n + m)
+    a = application(function(n, m, f), ketPsi)
+    ff = oracle(n, m, f)
+    b = application(ff, ketPsi)
+    if qu.equal(a, b, qc.epsilon) and qu.equal(ff.matrix(), function(n, m, f), qc.epsilon):
+        print("passed oracleTest")
+    else:
+        print("failed oracleTest")
+        print(" a = " + str(a))
+        print(" b = " + str(b))
+
+
+def truthTableTest(n):
+    # Builds the same oracle from a Python function, a vectorized function, a table of integers, a table of bits, and a process pool.
+    delta = qb.string(n, random.randrange(0, 2**n))
+    d = qb.integer(delta)
+    fromFunction = oracle(n, n, functools.partial(qb.addition, delta))
+    fromVectorized = oracle(n, n, lambda alphas: alphas ^ d, vectorized=True)
+    fromIntegers = oracle(n, n, [alpha ^ d for alpha in range(2**n)])
+    fromBits = oracle(n, n, numpy.array([qb.addition(qb.string(n, alpha), delta) for alpha in range(2**n)]))
+    fromPool = oracle(n, n, functools.partial(qb.addition, delta), processes=2)
+    others = [fromVectorized, fromIntegers, fromBits, fromPool]
+    if all((other.indices == fromFunction.indices).all() for other in others):
+        print("passed truthTableTest")
+    else:
+        print("failed truthTableTest")
+        print(" delta = " + str(delta))
+
+
 def fourierTest(n):
     if n == 1:
         # Explicitly check the answer.
         t = fourier(1)
-        if qu.equal(t, qc.h, 0.000001):
+        if qu.equal(t, qc.h, qc.epsilon):
             print("passed fourierTest")
         else:
             print("failed fourierTest")
@@ -181,13 +557,13 @@ def fourierTest(n):
         # Check the first row and column.
         const = pow(2, -n / 2) + 0j
         for j in range(2**n):
-            if not qu.equal(t[0, j], const, 0.000001):
+            if not qu.equal(t[0, j], const, qc.epsilon):
                 print("failed fourierTest first part")
                 print(" t = ")
                 print(t)
                 return
         for i in range(2**n):
-            if not qu.equal(t[i, 0], const, 0.000001):
+            if not qu.equal(t[i, 0], const, qc.epsilon):
                 print("failed fourierTest first part")
                 print(" t = ")
                 print(t)
@@ -197,22 +573,126 @@ def fourierTest(n):
     tStar = numpy.conj(numpy.transpose(t))
     tStarT = numpy.matmul(tStar, t)
     id = numpy.identity(2**n, dtype=qc.one.dtype)
-    if qu.equal(tStarT, id, 0.000001):
+    if qu.equal(tStarT, id, qc.epsilon):
         print("passed fourierTest second part")
     else:
         print("failed fourierTest second part")
         print(" T^* T = ...")
         print(tStarT)
 
+def fourierApplicationTest(n, k):
+    # Assumes n > k >= 1. Applies the QFT to the last k qbits, in reverse order, of a random n-qbit state, densely and by FFT.
+    ketPsi = qu.uniform(n)
+    targets = list(range(n - 1, n - k - 1, -1))
+    a = targetedApplication(fourier(k), ketPsi, targets)
+    b = fourierApplication(ketPsi, targets)
+    if qu.equal(a, b, qc.epsilon):
+        print("passed fourierApplicationTest first part")
+    else:
+        print("failed fourierApplicationTest first part")
+        print(" a = " + str(a))
+        print(" b = " + str(b))
+    c = fourierApplication(b, targets, inverse=True)
+    if qu.equal(c, ketPsi, qc.epsilon):
+        print("passed fourierApplicationTest second part")
+    else:
+        print("failed fourierApplicationTest second part")
+        print(" c = " + str(c))
+
+def diffusionTest(n):
+    # Assumes n >= 2. Compares diffusion and phase on the first n of n + 1 qbits against the dense gates.
+    ketPsi = qu.uniform(n + 1)
+    ketRho = power(qc.ketPlus, n)
+    R = 2 * numpy.outer(ketRho, ketRho) - power(qc.i, n)
+    a = application(tensor(R, qc.i), ketPsi)
+    b = diffusion(ketPsi, range(n))
+    marked = numpy.array([0, 2**n - 1])
+    P = numpy.identity(2**n, dtype=qc.one.dtype)
+    P[marked, marked] = -1
+    c = application(tensor(P, qc.i), ketPsi)
+    d = phase(marked, ketPsi, range(n))
+    if qu.equal(a, b, qc.epsilon) and qu.equal(c, d, qc.epsilon):
+        print("passed diffusionTest")
+    else:
+        print("failed diffusionTest")
+        print(" a = " + str(a))
+        print(" b = " + str(b))
+
+def precisionTest(n):
+    # Switches to single precision, checks that gate routines neither upcast nor lose too much accuracy, and switches back.
+    # The power of a real gate is cached in double precision first, which single precision must not be served.
+    real = numpy.array([[0.0, 1.0], [1.0, 0.0]])
+    power(real, 2)
+    qc.setPrecision(numpy.complex64)
+    ketPsi = qu.uniform(n)
+    results = [ketPsi, application(qc.h, qu.uniform(1)), tensor(qc.ket0, ketPsi), targetedApplication(qc.cnot, ketPsi, (1, 0)),
+               powerApplication(qc.h, ketPsi, range(n)), fourierApplication(ketPsi), diffusion(ketPsi), fourier(n),
+               application(oracle(n - 1, 1, lambda alpha: (alpha[0],)), ketPsi), function(1, 1, lambda alpha: alpha), power(real, 2)]
+    dtypes = [result.dtype for result in results]
+    roundTrip = fourierApplication(fourierApplication(ketPsi), inverse=True)
+    accurate = qu.equal(roundTrip, ketPsi, qc.epsilon)
+    qc.setPrecision(numpy.complex128)
+    if all(dtype == numpy.complex64 for dtype in dtypes) and accurate and qc.one.dtype == numpy.complex128:
+        print("passed precisionTest")
+    else:
+        print("failed precisionTest")
+        print(" dtypes = " + str(dtypes))
+
+def gateCacheTest(n):
+    # Builds the same gates twice and checks that the second time hits the cache.
+    a = power(qc.h, n)
+    c = fourier(n)
+    e = oracle(n, 1, lambda alpha: (alpha[0],))
+    before = qca.gates.statistics()['hits']
+    b = power(qc.h, n)
+    d = fourier(n)
+    f = oracle(n, 1, lambda alpha: (alpha[0],))
+    if a is b and c is d and e is f and qca.gates.statistics()['hits'] - before == 3:
+        print("passed gateCacheTest")
+    else:
+        print("failed gateCacheTest")
+        print("    statistics = " + str(qca.gates.statistics()))
+
+def handlerTest(n):
+    # Registers a handler that takes over diffusion for one particular state, and checks that it is used for that state only.
+    special = qu.uniform(n)
+    calls = []
+    def handler(operation, state):
+        if operation == 'diffusion' and state is special:
+            return lambda ketPsi, targets: calls.append(list(targets)) or ketPsi
+        return None
+    handlers.append(handler)
+    try:
+        a = diffusion(special, (0, 1))
+        b = diffusion(qu.uniform(n), (0, 1))
+        c = phase([1], special)
+    finally:
+        handlers.remove(handler)
+    if a is special and calls == [[0, 1]] and b is not special and len(c) == 2**n:
+        print("passed handlerTest")
+    else:
+        print("failed handlerTest")
+        print("    calls = " + str(calls))
+
 ### RUNNING THE TESTS ###
 
 def main():
     applicationTest()
     applicationTest()
+    targetedApplicationTest(4)
     tensorTest()
     tensorTest()
+    kroneckerErrorTest(4)
+    kroneckerTest(5)
     functionTest(3, 3)
+    oracleTest(3, 2)
+    truthTableTest(4)
     fourierTest(4)
+    fourierApplicationTest(5, 3)
+    diffusionTest(4)
+    precisionTest(6)
+    gateCacheTest(4)
+    handlerTest(4)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,254 @@
+import os
+import json
+import math
+import time
+import random
+import inspect
+import tempfile
+import threading
+import functools
+import contextlib
+import numpy
+import qConstants as qc
+import qUtilities as qu
+import qGates as qg
+import qCache as qca
+import qMeasurement as qm
+import qAlgorithms as qa
+
+# Opt-in instrumentation of the hot paths. enable replaces the public functions of qGates, qMeasurement and
+# qAlgorithms with wrappers that record how often each is called, the wall time it takes, the bytes of the arrays it
+# returns (not its temporaries, which are not measured) and an estimate of its floating-point operations. The wrappers replace the functions in the modules' globals,
+# where every call looks them up, so nested calls are recorded too. disable puts the original functions back, so when
+# instrumentation is off it costs nothing at all.
+
+# The statistics so far: a dictionary mapping each qualified function name to a dictionary of totals.
+statistics = {}
+# Functions called with a record dictionary after every instrumented call. See addHook.
+hooks = []
+# The Chrome trace events recorded since startTrace, or None if not tracing.
+events = None
+# The original functions, by (module, name), while instrumentation is enabled.
+originals = {}
+local = threading.local()
+origin = time.perf_counter()
+
+
+def dimension(array):
+    '''Returns the number of qbits of a state or gate, or 0 for anything else.'''
+    if isinstance(array, numpy.ndarray) and array.ndim >= 1:
+        return len(array).bit_length() - 1
+    return 0
+
+def multiplies(u, length):
+    '''Returns the complex multiply-adds of applying the gate U to a state of the given length: the length times the
+    dimension of U for a dense gate, the length times the sum of the factors' dimensions for a Kronecker gate, which is
+    applied factor by factor, and 0 for an oracle, which only moves amplitudes.'''
+    if isinstance(u, (qg.Oracle, qg.Affine)):
+        return 0
+    if isinstance(u, qg.Kronecker):
+        return length * sum(2**width for width in u.widths)
+    return length * len(u)
+
+# Estimators of floating-point operations, keyed by qualified name. Each takes the arguments and the result of a call.
+# A complex multiply-add counts as 8 operations. Anything missing counts as 0.
+estimators = {
+    'qGates.application': lambda args, kwargs, result: 8 * multiplies(args[0], len(args[1])),
+    'qGates.targetedApplication': lambda args, kwargs, result: 8 * multiplies(args[0], len(args[1])),
+    'qGates.powerApplication': lambda args, kwargs, result: 16 * len(args[1]) * len(list(args[2])),
+    'qGates.tensor': lambda args, kwargs, result: 0 if isinstance(result, qg.Kronecker) else 6 * numpy.size(result),
+    'qGates.power': lambda args, kwargs, result: 0 if isinstance(result, qg.Kronecker) else 6 * numpy.size(result),
+    'qGates.fourier': lambda args, kwargs, result: 20 * numpy.size(result),
+    'qGates.fourierApplication': lambda args, kwargs, result: 5 * len(result) * dimension(result),
+    'qGates.diffusion': lambda args, kwargs, result: 4 * len(result),
+    'qGates.phase': lambda args, kwargs, result: len(result),
+    'qMeasurement.first': lambda args, kwargs, result: 4 * len(args[0]),
+    'qMeasurement.last': lambda args, kwargs, result: 4 * len(args[0]),
+    'qMeasurement.marginal': lambda args, kwargs, result: 4 * len(args[0]),
+    'qMeasurement.collapse': lambda args, kwargs, result: 4 * len(args[0]),
+}
+
+
+def returned(result):
+    '''Returns the total bytes of the NumPy arrays in a result, including an Oracle's tables, looking one level into
+    tuples and lists. Memory allocated and freed during the call is not included.'''
+    items = list(result) if isinstance(result, (tuple, list)) else [result]
+    return sum(array.nbytes for item in items for array in qca.arrays(item) if isinstance(array, numpy.ndarray))
+
+def record(name, depth, start, seconds, result, args, kwargs):
+    '''Adds one call to the statistics, the trace and the hooks.'''
+    estimator = estimators.get(name)
+    flops = estimator(args, kwargs, result) if estimator is not None else 0
+    size = returned(result)
+    totals = statistics.setdefault(name, {'calls': 0, 'seconds': 0.0, 'returned': 0, 'flops': 0})
+    totals['calls'] += 1
+    totals['seconds'] += seconds
+    totals['returned'] += size
+    totals['flops'] += flops
+    entry = {'name': name, 'start': start, 'seconds': seconds, 'returned': size, 'flops': flops,
+             'depth': depth}
+    if events is not None:
+        events.append({'name': name, 'ph': 'X', 'ts': (start - origin) * 1e6, 'dur': seconds * 1e6, 'pid': os.getpid(),
+                       'tid': threading.get_ident(), 'args': {'returned': size, 'flops': flops}})
+    for hook in hooks:
+        hook(entry)
+
+def wrap(name, f):
+    '''Returns f wrapped to record each call under the given name.'''
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        depth = local.depth = getattr(local, 'depth', 0) + 1
+        start = time.perf_counter()
+        try:
+            result = f(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            local.depth -= 1
+        record(name, depth, start, seconds, result, args, kwargs)
+        return result
+    return wrapper
+
+
+def enable(modules=None):
+    '''Instruments the public functions of the given modules, by default qGates, qMeasurement and qAlgorithms. Tests
+    and main are left alone. Enabling twice has no further effect.'''
+    if modules is None:
+        modules = [qg, qm, qa]
+    for module in modules:
+        for name, f in list(vars(module).items()):
+            if (module, name) in originals or not inspect.isfunction(f) or f.__module__ != module.__name__:
+                continue
+            if name == 'main' or name.endswith('Test') or name.startswith('_'):
+                continue
+            originals[(module, name)] = f
+            setattr(module, name, wrap(module.__name__ + '.' + name, f))
+
+def disable():
+    '''Restores the original functions.'''
+    for (module, name), f in originals.items():
+        setattr(module, name, f)
+    originals.clear()
+
+@contextlib.contextmanager
+def instrumented(modules=None):
+    '''A context manager that enables instrumentation for the duration of a with block.'''
+    enable(modules)
+    try:
+        yield statistics
+    finally:
+        disable()
+
+def reset():
+    '''Clears the statistics.'''
+    statistics.clear()
+
+def addHook(hook):
+    '''Registers hook to be called after every instrumented call with a dictionary of its name, start (in
+    time.perf_counter seconds), seconds, returned (the bytes of the arrays returned), estimated flops and nesting depth
+    (1 for outermost calls). Use it to forward measurements to another metrics system. Returns hook, so removeHook can
+    be given it later.'''
+    hooks.append(hook)
+    return hook
+
+def removeHook(hook):
+    hooks.remove(hook)
+
+def report():
+    '''Returns a string tabulating the statistics, the most time-consuming first. Times include nested calls. The bytes
+    are those of the arrays returned, not the peak memory used.'''
+    lines = ["%-36s %8s %12s %14s %14s" % ('function', 'calls', 'seconds', 'bytes returned', 'flops')]
+    for name, totals in sorted(statistics.items(), key=lambda item: -item[1]['seconds']):
+        lines.append("%-36s %8d %12.6f %14d %14d" % (name, totals['calls'], totals['seconds'], totals['returned'], totals['flops']))
+    return "\n".join(lines)
+
+def startTrace():
+    '''Starts recording a trace of every instrumented call.'''
+    global events
+    events = []
+
+def stopTrace(path=None):
+    '''Stops recording, and returns the trace in the Chrome trace-event format, which chrome://tracing and Perfetto
+    display as a flame graph. If path is given, also writes it there as JSON.'''
+    global events
+    trace = {'traceEvents': events if events is not None else [], 'displayTimeUnit': 'ms'}
+    events = None
+    if path is not None:
+        with open(path, 'w') as file:
+            json.dump(trace, file)
+    return trace
+
+
+
+### DEFINING SOME TESTS ###
+
+def instrumentTest(n):
+    # Instruments a run of Grover's algorithm and checks the counts, the hooks, the trace and that disabling restores the originals.
+    original = qg.targetedApplication
+    seen = []
+    hook = addHook(lambda entry: seen.append(entry['name']))
+    reset()
+    startTrace()
+    with instrumented():
+        qa.grover(n, 1, qg.oracle(n, 1, lambda alpha: (int(alpha == n * (1,)),)))
+        qm.first(qu.uniform(n))
+    path = os.path.join(tempfile.mkdtemp(), 'trace.json')
+    stopTrace(path)
+    removeHook(hook)
+    with open(path) as file:
+        trace = json.load(file)
+    if (qg.targetedApplication is original and statistics['qGates.targetedApplication']['calls'] > 0
+            and statistics['qGates.targetedApplication']['flops'] > 0 and statistics['qAlgorithms.grover']['calls'] == 1
+            and statistics['qGates.oracle']['returned'] == 8 * (2**n + 2**(n + 1))
+            and len(seen) == sum(totals['calls'] for totals in statistics.values()) == len(trace['traceEvents'])):
+        print("passed instrumentTest")
+    else:
+        print("failed instrumentTest")
+        print(report())
+
+def kroneckerTest(n):
+    # Applies a lazy power of H on n qbits with instrumentation on. The dense gate would not fit in memory, so the estimators must not build it.
+    # Each of the n one-qbit factors costs 2 multiply-adds per amplitude, so the estimate is 8 2^n 2n, not 8 4^n. The
+    # factors are applied by nested calls to targetedApplication, which count too: 2 per amplitude for each H and 4 for
+    # the CNOT, besides the 2 + 4 of the outer call on the product of an H and a CNOT. Building lazy gates costs nothing.
+    reset()
+    with instrumented():
+        ketPsi = qg.application(qg.power(qc.h, n, lazy=True), qu.uniform(n))
+        qg.targetedApplication(qg.tensor(qc.h, qc.cnot, lazy=True), ketPsi, (0, 2, 1))
+    flops = [statistics[name]['flops'] for name in ['qGates.application', 'qGates.targetedApplication', 'qGates.power', 'qGates.tensor']]
+    if len(ketPsi) == 2**n and statistics['qGates.application']['calls'] == 1 and flops == [8 * 2**n * 2 * n, 8 * 2**n * (2 * n + 12), 0, 0]:
+        print("passed kroneckerTest")
+    else:
+        print("failed kroneckerTest")
+        print(report())
+
+def overheadTest(n, m):
+    # Prints the cost of m one-qbit gates on n qbits with instrumentation off and on.
+    ketPsi = qu.uniform(n)
+    times = []
+    for enabled in [False, True]:
+        if enabled:
+            enable()
+        start = time.perf_counter()
+        for i in range(m):
+            qg.targetedApplication(qc.h, ketPsi, (i % n,))
+        times.append(time.perf_counter() - start)
+        disable()
+    reset()
+    print("check overheadTest for small overhead")
+    print("    off = " + str(round(times[0], 4)) + "s, on = " + str(round(times[1], 4)) + "s")
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    instrumentTest(5)
+    kroneckerTest(24)
+    overheadTest(10, 1000)
+    reset()
+    with instrumented():
+        qa.grover(10, 1, qg.oracle(10, 1, lambda alpha: (int(alpha == 10 * (1,)),)), rng=358)
+    print(report())
+
+if __name__ == "__main__":
+    main()
@@ -5,28 +5,19 @@ import qConstants as qc
 import qUtilities as qu
 import qBitStrings as qb
 import qGates as qg
-import qMeasurement as qm
-import qAlgorithms as qa
 
 
 
-def first(state):
+def first(state, rng=None):
     '''Assumes n >= 1. Given an n-qbit state, measures the first qbit.
     Returns a pair (tuple of two items) consisting of a classical one-qbit state 
-    (either |0> or |1>) and an (n - 1)-qbit state.'''
-    sigmaZero = 0 
-    sigmaOne = 0
-    for i in range(len(state) // 2):
-        sigmaZero += abs(state[i])**2
-    for i in range(len(state) // 2, len(state)):
-        sigmaOne += abs(state[i])**2
-    sigmaZero = math.sqrt(sigmaZero)
-    sigmaOne = math.sqrt(sigmaOne)
-    if qu.equal(sigmaZero, qc.zero, 0.000001):   
-        ketChi = numpy.zeros(len(state) // 2, dtype=numpy.array(0 + 0j).dtype)
+    (either |0> or |1>) and an (n - 1)-qbit state. rng is as in qUtilities.draw.'''
+    sigmaZero, sigmaOne = map(math.sqrt, normSquares([state[:len(state) // 2], state[len(state) // 2:]]))
+    if qu.equal(sigmaZero, qc.zero, qc.epsilon):   
+        ketChi = numpy.zeros(len(state) // 2, dtype=qc.one.dtype)
         ketPsi = state[len(state) // 2:]
-    elif qu.equal(sigmaOne, qc.zero, 0.000001):
-        ketPsi = numpy.zeros(len(state) // 2, dtype=numpy.array(0 + 0j).dtype)
+    elif qu.equal(sigmaOne, qc.zero, qc.epsilon):
+        ketPsi = numpy.zeros(len(state) // 2, dtype=qc.one.dtype)
         ketChi = state[:len(state) // 2]
     else:
         ketChi = (1 / sigmaZero) * state[:len(state) // 2]
@@ -36,32 +27,24 @@ def first(state):
     if len(ketPsi) == 1:
         ketPsi = qc.one
     normSq = abs(sigmaZero ** 2)
-    if random.uniform(0, 1) <= normSq:
+    if qu.draw(rng) <= normSq:
         return (qc.ket0, ketChi)
     else:
         return (qc.ket1, ketPsi)
    
 
 
-def last(state):
+def last(state, rng=None):
     '''Assumes n >= 1. Given an n-qbit state, measures the last qbit. 
     Returns a pair consisting of an (n - 1)-qbit state and a classical 1-qbit state 
-    (either |0> or |1>).'''
-    sigmaZero = 0 
-    sigmaOne = 0
-    for i in range(len(state)):
-        if i % 2 == 0:
-            sigmaZero += abs(state[i])**2
-        else:
-            sigmaOne += abs(state[i])**2
-    ketChi = numpy.fromiter((state[i] for i in range(len(state)) if i % 2 == 0), dtype=numpy.array(0 + 0j).dtype)
-    ketPsi = numpy.fromiter((state[i] for i in range(len(state)) if i % 2 != 0), dtype=numpy.array(0 + 0j).dtype)
-    sigmaZero =  math.sqrt(sigmaZero)
-    sigmaOne = math.sqrt(sigmaOne)
-    if qu.equal(sigmaZero, qc.zero, 0.000001): 
-        ketChi = numpy.zeros(len(state) // 2, dtype=numpy.array(0 + 0j).dtype)
-    elif qu.equal(sigmaOne, qc.zero, 0.000001):
-        ketPsi = numpy.zeros(len(state) // 2, dtype=numpy.array(0 + 0j).dtype)
+    (either |0> or |1>). rng is as in qUtilities.draw.'''
+    ketChi = numpy.array(state[0::2], dtype=qc.one.dtype)
+    ketPsi = numpy.array(state[1::2], dtype=qc.one.dtype)
+    sigmaZero, sigmaOne = map(math.sqrt, normSquares([ketChi, ketPsi]))
+    if qu.equal(sigmaZero, qc.zero, qc.epsilon): 
+        ketChi = numpy.zeros(len(state) // 2, dtype=qc.one.dtype)
+    elif qu.equal(sigmaOne, qc.zero, qc.epsilon):
+        ketPsi = numpy.zeros(len(state) // 2, dtype=qc.one.dtype)
     else:
         ketChi = (1 / sigmaZero) * ketChi
         ketPsi = (1 / sigmaOne) * ketPsi
@@ -70,13 +53,81 @@ def last(state):
     if len(ketPsi) == 1:
         ketPsi = qc.one
     normSq = abs(sigmaZero ** 2)
-    if random.uniform(0, 1) <= normSq:
+    if qu.draw(rng) <= normSq:
         return (ketChi, qc.ket0)
     else:
         return (ketPsi, qc.ket1)
     
 
 
+def normSquares(parts):
+    '''Returns the list of the squared norms of the given arrays, which are pieces of a state.'''
+    routine = qg.handled('normSquares', parts[0])
+    if routine is not None:
+        return routine(parts)
+    return [numpy.vdot(part, part).real for part in parts]
+
+def marginal(state, qbits):
+    '''Assumes n >= 1. Given an n-qbit state and a list of k distinct qbit
+    indices (qbit 0 is the first qbit), returns the probability distribution of
+    measuring those qbits, as a NumPy array of length 2^k. Entry gamma is the
+    probability of the outcome whose bits, in the order listed, spell gamma.'''
+    routine = qg.handled('marginal', state)
+    if routine is not None:
+        return routine(state, qbits)
+    qbits = list(qbits)
+    n = len(state).bit_length() - 1
+    probs = numpy.reshape(abs(state)**2, n * (2,))
+    others = tuple(q for q in range(n) if q not in qbits)
+    # Accumulate in double precision even for single-precision states, so that the probabilities sum to 1 accurately.
+    probs = numpy.sum(probs, axis=others, dtype=numpy.float64)
+    # The remaining axes are in increasing qbit order. Put them in the order listed.
+    ordered = sorted(qbits)
+    probs = numpy.transpose(probs, [ordered.index(q) for q in qbits])
+    probs = numpy.reshape(probs, 2**len(qbits))
+    return probs / numpy.sum(probs)
+
+def collapse(state, qbits, bits):
+    '''Assumes n >= 1. Given an n-qbit state, a list of k qbit indices, and k
+    bits that were just measured on those qbits, returns the n-qbit state after
+    the measurement: the amplitudes that disagree with the bits are zeroed and
+    the rest renormalized. Unlike first and last, the measured qbits are kept.
+    A numpy.memmap state is collapsed in place.'''
+    routine = qg.handled('collapse', state)
+    if routine is not None:
+        return routine(state, qbits, bits)
+    n = len(state).bit_length() - 1
+    psi = numpy.array(numpy.reshape(state, n * (2,)))
+    for q, bit in zip(qbits, bits):
+        index = n * [slice(None)]
+        index[q] = 1 - bit
+        psi[tuple(index)] = 0
+    psi = numpy.reshape(psi, 2**n)
+    return psi / math.sqrt(numpy.vdot(psi, psi).real)
+
+def sample(state, qbits=None, shots=1, counts=False, rng=None):
+    '''Assumes n >= 1. Measures the listed qbits of the n-qbit state (by
+    default, all of them) shots times, each time starting from the same
+    pre-measurement state. The marginal distribution is computed once and all
+    shots are drawn in one call. Returns a shots x k NumPy array of bits, one row
+    per shot with the bits in the order listed. If counts is True, instead
+    returns a dictionary mapping each observed k-bit string (as in
+    qBitStrings.py) to how many times it occurred. rng is as in
+    qUtilities.generator.'''
+    if qbits is None:
+        qbits = range(len(state).bit_length() - 1)
+    qbits = list(qbits)
+    k = len(qbits)
+    probs = marginal(state, qbits)
+    outcomes = qu.generator(rng).choice(2**k, size=shots, p=probs)
+    if counts:
+        values, frequencies = numpy.unique(outcomes, return_counts=True)
+        return {qb.string(k, int(v)): int(c) for v, c in zip(values, frequencies)}
+    shifts = numpy.arange(k - 1, -1, -1)
+    return ((outcomes[:, None] >> shifts) & 1).astype(numpy.uint8)
+
+
+
 ### DEFINING SOME TESTS ###
 
 def firstTest(n):
@@ -84,7 +135,7 @@ def firstTest(n):
     ketPsi = qu.uniform(n)
     state = qg.tensor(qc.ket0, ketPsi)
     meas = first(state)
-    if qu.equal(state, qg.tensor(meas[0], meas[1]), 0.000001):
+    if qu.equal(state, qg.tensor(meas[0], meas[1]), qc.epsilon):
         print("passed firstTest first part")
     else:
         print("failed firstTest first part")
@@ -93,7 +144,7 @@ def firstTest(n):
     ketPsi = qu.uniform(n)
     state = qg.tensor(qc.ket1, ketPsi)
     meas = first(state)
-    if qu.equal(state, qg.tensor(meas[0], meas[1]), 0.000001):
+    if qu.equal(state, qg.tensor(meas[0], meas[1]), qc.epsilon):
         print("passed firstTest second part")
     else:
         print("failed firstTest second part")
@@ -123,7 +174,7 @@ def lastTest(n):
     psi = qu.uniform(n)
     state = qg.tensor(psi, qc.ket0)
     meas = last(state)
-    if qu.equal(state, qg.tensor(meas[0], meas[1]), 0.000001):
+    if qu.equal(state, qg.tensor(meas[0], meas[1]), qc.epsilon):
         print("passed lastTest first part")
     else:
         print("failed lastTest first part")
@@ -132,7 +183,7 @@ def lastTest(n):
     psi = qu.uniform(n)
     state = qg.tensor(psi, qc.ket1)
     meas = last(state)
-    if qu.equal(state, qg.tensor(meas[0], meas[1]), 0.000001):
+    if qu.equal(state, qg.tensor(meas[0], meas[1]), qc.epsilon):
         print("passed lastTest second part")
     else:
         print("failed lastTest second part")
@@ -157,6 +208,30 @@ def lastTest345(n, m):
     print("check lastTest345 for frequency near 0.64")
     print("    frequency = ", str(acc / m))
 
+def seedTest(n, m):
+    # Measures the same random state twice with the same seed, and checks that the outcomes agree.
+    ketPsi = qu.uniform(n, rng=numpy.random.default_rng(358))
+    a = sample(ketPsi, range(n), m, rng=7)
+    b = sample(qu.uniform(n, rng=numpy.random.default_rng(358)), range(n), m, rng=7)
+    c = [first(ketPsi, numpy.random.default_rng(k))[0][1] for k in range(m)]
+    d = [first(ketPsi, numpy.random.default_rng(k))[0][1] for k in range(m)]
+    if (a == b).all() and c == d:
+        print("passed seedTest")
+    else:
+        print("failed seedTest")
+
+def sampleTest(n, m):
+    # Assumes n >= 1. Like firstTest345 and lastTest345, but draws all m shots at once from the 3-4-5 state. Both frequencies should be near 0.64.
+    ketOmega = 3 / 5 * qg.tensor(qc.ket0, qu.uniform(n)) + 4 / 5 * qg.tensor(qc.ket1, qu.uniform(n))
+    bits = sample(ketOmega, [0], m)
+    print("check sampleTest for frequency near 0.64")
+    print("    frequency = ", str(numpy.mean(bits[:, 0])))
+    ketOmega = 3 / 5 * qg.tensor(qu.uniform(n), qc.ket0) + 4 / 5 * qg.tensor(qu.uniform(n), qc.ket1)
+    counts = sample(ketOmega, [n, 0], m, counts=True)
+    ones = sum(c for gamma, c in counts.items() if gamma[0] == 1)
+    print("check sampleTest for frequency near 0.64")
+    print("    frequency = ", str(ones / m))
+
 
 
 ### RUNNING THE TESTS ###
@@ -170,6 +245,8 @@ def main():
     lastTest(1)
     lastTest345(1, 10000)
     lastTest345(1, 10000)
+    sampleTest(3, 10000)
+    seedTest(3, 100)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,245 @@
+import os
+import math
+import random
+import numpy
+import qConstants as qc
+import qUtilities as qu
+import qBitStrings as qb
+import qGates as qg
+import qMeasurement as qm
+
+# Out-of-core states. A state can be a numpy.memmap backed by a file (on fast local disk, ideally), and the routines
+# here process it one chunk of consecutive amplitudes at a time, so that only a few chunks need to be in memory at
+# once. Importing this module registers a handler with qGates, so that the functions in qGates and qMeasurement hand
+# memmap states to these routines automatically, and code written for in-memory states, such as qAlgorithms, also
+# works out of core; select the 'memmap' backend in qCircuits.
+#
+# A chunk of 2^c amplitudes shares its first n - c qbits, so the last c qbits are "local" to it: a gate on local qbits
+# can be applied chunk by chunk. A gate on other qbits is handled by first swapping them with local qbits that the
+# gate does not touch, which pairs up chunks, and swapping them back afterwards.
+
+# The number of amplitudes per chunk. Must be a power of 2.
+chunk = 2**20
+# The directory for state files, or None for the system's temporary directory.
+directory = None
+
+
+def empty(n):
+    '''Returns a new uninitialized n-qbit state as a numpy.memmap on a temporary file in directory. The file is unlinked at once where the platform allows, so it disappears with the memmap.'''
+    # Imported here, so that importing qGates does not pay for it.
+    import tempfile
+    handle, path = tempfile.mkstemp(suffix='.state', dir=directory)
+    os.close(handle)
+    state = numpy.memmap(path, dtype=qc.one.dtype, mode='w+', shape=(2**n,))
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    return state
+
+def basis(n):
+    '''Returns the n-qbit state |0...0> as a numpy.memmap, written chunk by chunk.'''
+    state = empty(n)
+    for start in range(0, 2**n, chunk):
+        state[start:start + chunk] = 0
+    state[0] = 1
+    return state
+
+def copy(ketPsi):
+    '''Returns a copy of the state |psi>, in memory or not, as a numpy.memmap.'''
+    n = len(ketPsi).bit_length() - 1
+    state = empty(n)
+    for start in range(0, 2**n, chunk):
+        state[start:start + chunk] = ketPsi[start:start + chunk]
+    return state
+
+def blocks(n):
+    '''Returns the number c of local qbits and the list of (start, stop) ranges of the chunks of an n-qbit state.'''
+    c = min(n, chunk.bit_length() - 1)
+    return (c, [(start, start + 2**c) for start in range(0, 2**n, 2**c)])
+
+def extraction(indices, qbits, n):
+    '''Given an array of basis-state indices of an n-qbit state, returns the integers spelled by their bits at the listed qbits, first listed most significant.'''
+    t = numpy.zeros(len(indices), dtype=numpy.int64)
+    for q in qbits:
+        t = (t << 1) | ((indices >> (n - 1 - q)) & 1)
+    return t
+
+def deposition(t, qbits, n):
+    '''Inverse of extraction: returns the indices that have the bits of the integers t at the listed qbits, and 0 elsewhere.'''
+    indices = numpy.zeros(len(t), dtype=numpy.int64)
+    for k, q in enumerate(reversed(qbits)):
+        indices |= ((t >> k) & 1) << (n - 1 - q)
+    return indices
+
+
+def swap(state, a, b):
+    '''Swaps qbits a and b of the memmap state in place, where a is not local to a chunk and b is. Works on pairs of chunks that differ only in qbit a.'''
+    n = len(state).bit_length() - 1
+    c, ranges = blocks(n)
+    bit = n - 1 - a - c
+    axis = b - (n - c)
+    one = axis * (slice(None),) + (1,)
+    zero = axis * (slice(None),) + (0,)
+    for i, (start, stop) in enumerate(ranges):
+        if i >> bit & 1:
+            continue
+        partner = ranges[i | 1 << bit]
+        lo = numpy.reshape(state[start:stop], c * (2,))
+        hi = numpy.reshape(state[partner[0]:partner[1]], c * (2,))
+        temp = numpy.array(lo[one])
+        lo[one] = hi[zero]
+        hi[zero] = temp
+
+def local(state, targets, kernel):
+    '''Applies kernel(block, localTargets), which must return the new block, to every chunk of the memmap state in place, where localTargets are the targets numbered within the chunk. Targets that are not local are first swapped with local qbits that are not targets, and swapped back afterwards. Returns the state.'''
+    n = len(state).bit_length() - 1
+    c, ranges = blocks(n)
+    targets = list(targets)
+    spare = [q for q in range(n - 1, n - c - 1, -1) if q not in targets]
+    swaps = []
+    for k, target in enumerate(targets):
+        if target < n - c:
+            if len(spare) == 0:
+                raise ValueError("a chunk of " + str(2**c) + " amplitudes is too small for an operation on " + str(len(targets)) + " qbits")
+            swaps.append((target, spare.pop(0)))
+            targets[k] = swaps[-1][1]
+    for a, b in swaps:
+        swap(state, a, b)
+    localTargets = [target - (n - c) for target in targets]
+    for start, stop in ranges:
+        state[start:stop] = kernel(numpy.asarray(state[start:stop]), localTargets)
+    for a, b in reversed(swaps):
+        swap(state, a, b)
+    return state
+
+
+def targetedApplication(u, state, targets):
+    '''As qGates.targetedApplication, for a memmap state. Gates are applied in place; an Oracle produces a new memmap.'''
+    if isinstance(u, qg.Oracle):
+        return oracle(u, state, targets)
+    return local(state, targets, lambda block, localTargets: qg.targetedApplication(u, block, localTargets))
+
+def fourierApplication(state, targets, inverse):
+    '''As qGates.fourierApplication, in place, for a memmap state. A chunk must hold at least 2^k amplitudes.'''
+    return local(state, targets, lambda block, localTargets: qg.fourierApplication(block, localTargets, inverse))
+
+def oracle(f, state, targets):
+    '''Applies the Oracle F to the listed qbits of the memmap state, returning a new memmap. Each chunk of the result is gathered from wherever its amplitudes lie in the old state.'''
+    n = len(state).bit_length() - 1
+    targets = list(targets)
+    mask = deposition(numpy.array([2**len(targets) - 1]), targets, n)[0]
+    result = empty(n)
+    for start, stop in blocks(n)[1]:
+        indices = numpy.arange(start, stop, dtype=numpy.int64)
+        sources = (indices & ~mask) | deposition(f.indices[extraction(indices, targets, n)], targets, n)
+        result[start:stop] = state[sources]
+    return result
+
+def phase(marked, state, targets):
+    '''As qGates.phase, in place, for a memmap state.'''
+    n = len(state).bit_length() - 1
+    for start, stop in blocks(n)[1]:
+        t = extraction(numpy.arange(start, stop, dtype=numpy.int64), targets, n)
+        block = numpy.asarray(state[start:stop])
+        block[numpy.isin(t, marked)] *= -1
+    return state
+
+def diffusion(state, targets):
+    '''As qGates.diffusion, in place, for a memmap state. One pass computes the mean over the targets for each value of the other qbits, and a second pass applies 2 mean - psi.'''
+    n = len(state).bit_length() - 1
+    targets = list(targets)
+    others = [q for q in range(n) if q not in targets]
+    ranges = blocks(n)[1]
+    sums = numpy.zeros(2**len(others), dtype=numpy.complex128)
+    for start, stop in ranges:
+        rest = extraction(numpy.arange(start, stop, dtype=numpy.int64), others, n)
+        block = numpy.asarray(state[start:stop])
+        sums += numpy.bincount(rest, weights=block.real, minlength=len(sums))
+        sums += 1j * numpy.bincount(rest, weights=block.imag, minlength=len(sums))
+    means = (sums / 2**len(targets)).astype(qc.one.dtype)
+    for start, stop in ranges:
+        rest = extraction(numpy.arange(start, stop, dtype=numpy.int64), others, n)
+        state[start:stop] = 2 * means[rest] - state[start:stop]
+    return state
+
+def marginal(state, qbits):
+    '''As qMeasurement.marginal, for a memmap state, accumulating the probabilities chunk by chunk.'''
+    n = len(state).bit_length() - 1
+    qbits = list(qbits)
+    probs = numpy.zeros(2**len(qbits))
+    for start, stop in blocks(n)[1]:
+        t = extraction(numpy.arange(start, stop, dtype=numpy.int64), qbits, n)
+        probs += numpy.bincount(t, weights=abs(numpy.asarray(state[start:stop]))**2, minlength=len(probs))
+    return probs / numpy.sum(probs)
+
+def collapse(state, qbits, bits):
+    '''As qMeasurement.collapse, in place, for a memmap state.'''
+    n = len(state).bit_length() - 1
+    ranges = blocks(n)[1]
+    outcome = qb.integer(tuple(bits))
+    normSq = 0.0
+    for start, stop in ranges:
+        block = numpy.asarray(state[start:stop])
+        block[extraction(numpy.arange(start, stop, dtype=numpy.int64), qbits, n) != outcome] = 0
+        normSq += numpy.vdot(block, block).real
+    for start, stop in ranges:
+        state[start:stop] /= math.sqrt(normSq)
+    return state
+
+
+# The routines above, by the name of the qGates or qMeasurement routine they replace.
+kernels = {'oracle': oracle, 'targetedApplication': targetedApplication, 'fourierApplication': fourierApplication,
+           'phase': phase, 'diffusion': diffusion, 'marginal': marginal, 'collapse': collapse}
+
+def handler(operation, state):
+    '''The handler registered with qGates: returns the routine here for the named operation if the state is a memmap.'''
+    if isinstance(state, numpy.memmap):
+        return kernels.get(operation)
+    return None
+
+qg.handlers.append(handler)
+
+
+
+### DEFINING SOME TESTS ###
+
+def memmapTest(n, c):
+    # Assumes n > c >= 3. Runs gates on every kind of qbit, an oracle, the QFT, diffusion, a phase and a measurement on a memmap state with small chunks, and compares against the in-memory routines.
+    global chunk
+    saved = chunk
+    chunk = 2**c
+    ketPsi = qu.uniform(n)
+    state = copy(ketPsi)
+    f = qg.oracle(2, 1, [1, 0, 0, 1])
+    steps = [lambda psi: qg.targetedApplication(qc.cnot, psi, (0, n - 1)),
+             lambda psi: qg.targetedApplication(qc.h, psi, (1,)),
+             lambda psi: qg.targetedApplication(f, psi, (n - 1, 0, 2)),
+             lambda psi: qg.fourierApplication(psi, (1, 0, n - 1)),
+             lambda psi: qg.diffusion(psi, range(n - 1)),
+             lambda psi: qg.phase(numpy.array([1, 6]), psi, (0, 1, n - 2))]
+    for step in steps:
+        ketPsi = step(ketPsi)
+        state = step(state)
+    a = qm.marginal(ketPsi, [n - 1, 0])
+    b = qm.marginal(state, [n - 1, 0])
+    ketPsi = qm.collapse(ketPsi, [0, n - 1], [1, 0])
+    state = qm.collapse(state, [0, n - 1], [1, 0])
+    chunk = saved
+    if isinstance(state, numpy.memmap) and qu.equal(ketPsi, numpy.asarray(state), qc.epsilon) and qu.equal(a, b, qc.epsilon):
+        print("passed memmapTest")
+    else:
+        print("failed memmapTest")
+        print("    a = " + str(a))
+        print("    b = " + str(b))
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    memmapTest(6, 3)
+    memmapTest(10, 4)
+
+if __name__ == "__main__":
+    main()
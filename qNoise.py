@@ -0,0 +1,228 @@
+import math
+import random
+import numpy
+import qConstants as qc
+import qUtilities as qu
+import qBitStrings as qb
+import qGates as qg
+import qAlgorithms as qa
+import qCircuits as qci
+import qTrials as qtr
+
+# Noisy simulation by Monte Carlo trajectories. Instead of evolving a 4^n-entry density matrix, a batch of B ordinary
+# state vectors is evolved together, as a B x 2^n array, and after every operation each noise channel picks one of its
+# Kraus operators at random for each trajectory, with the probability that the operator would have. Averaging over
+# trajectories reproduces the density matrix's statistics, in O(B 2^n) memory. B must be a power of 2, so that the
+# batch is itself a state of log2(B) + n qbits and the kernels in qGates apply to it unchanged.
+
+
+class Channel:
+    '''A one-qbit noise channel, given by its Kraus operators: 2 x 2 matrices
+    K_i with SUM_i K_i^dagger K_i = I. If probabilities is given, the channel
+    is a mixture of unitaries, applying kraus[i] with probability
+    probabilities[i]; the operators are then not weighted, and the choice does
+    not depend on the state, which is cheaper.'''
+
+    def __init__(self, kraus, probabilities=None):
+        self.kraus = [numpy.asarray(k, dtype=qc.one.dtype) for k in kraus]
+        self.probabilities = probabilities
+
+    def apply(self, psi, target, rng):
+        '''Applies the channel to the target qbit of each row of the B x 2^n batch psi, in place.'''
+        n = psi.shape[1].bit_length() - 1
+        view = numpy.reshape(psi, (psi.shape[0], 2**target, 2, 2**(n - target - 1)))
+        if self.probabilities is not None:
+            choices = rng.choice(len(self.kraus), size=psi.shape[0], p=self.probabilities)
+            for i, k in enumerate(self.kraus):
+                rows = numpy.flatnonzero(choices == i)
+                if len(rows) > 0 and not numpy.array_equal(k, qc.i):
+                    view[rows] = numpy.einsum('ij,rajb->raib', k, view[rows])
+            return psi
+        candidates = [numpy.einsum('ij,rajb->raib', k, view) for k in self.kraus]
+        weights = numpy.array([numpy.sum(abs(c)**2, axis=(1, 2, 3)) for c in candidates])
+        cumulative = numpy.cumsum(weights, axis=0)
+        draws = rng.random(psi.shape[0]) * cumulative[-1]
+        choices = numpy.minimum(numpy.sum(cumulative <= draws, axis=0), len(self.kraus) - 1)
+        rows = numpy.arange(psi.shape[0])
+        chosen = numpy.array(candidates)[choices, rows]
+        view[...] = chosen / numpy.sqrt(weights[choices, rows])[:, None, None, None]
+        return psi
+
+
+def depolarizing(p):
+    '''Returns the channel that replaces the qbit by the maximally mixed state with probability 4 p / 3, that is,
+    applies X, Y or Z each with probability p / 3.'''
+    return Channel([qc.i, qc.x, qc.y, qc.z], [1 - p, p / 3, p / 3, p / 3])
+
+def dephasing(p):
+    '''Returns the channel that applies Z with probability p.'''
+    return Channel([qc.i, qc.z], [1 - p, p])
+
+def amplitudeDamping(gamma):
+    '''Returns the channel that decays |1> to |0> with probability gamma.'''
+    return Channel([[[1, 0], [0, math.sqrt(1 - gamma)]], [[0, math.sqrt(gamma)], [0, 0]]])
+
+
+class Trajectories(qci.StateVector):
+    '''A qCircuits backend that runs a batch of trajectories at once. The
+    state is a B x 2^n array with one trajectory per row. After every
+    operation other than a measurement, each channel in model is applied to
+    each of the operation's qbits. measure returns, for each measured qbit, a
+    NumPy array of B bits.'''
+
+    def __init__(self, rng, model, batch):
+        if batch & (batch - 1) != 0:
+            raise ValueError("the batch size must be a power of 2, not " + str(batch))
+        self.rng = rng
+        self.model = model
+        self.batch = batch
+        self.b = batch.bit_length() - 1
+
+    def start(self, n, ketPsi):
+        psi = numpy.zeros((self.batch, 2**n), dtype=qc.one.dtype)
+        if ketPsi is None:
+            psi[:, 0] = 1
+        else:
+            psi[:] = ketPsi
+        return psi
+
+    def noise(self, psi, targets):
+        for target in targets:
+            for channel in self.model:
+                channel.apply(psi, target, self.rng)
+        return psi
+
+    def shifted(self, psi, kernel, targets):
+        '''Applies kernel(state, targets) to the batch viewed as one state of b + n qbits, and then the noise.'''
+        flat = kernel(numpy.reshape(psi, -1), [target + self.b for target in targets])
+        return self.noise(numpy.reshape(flat, psi.shape), targets)
+
+    def gate(self, psi, u, targets):
+        return self.shifted(psi, lambda state, shifts: qg.targetedApplication(u, state, shifts), targets)
+
+    def oracle(self, psi, f, targets):
+        return self.shifted(psi, lambda state, shifts: qg.targetedApplication(f, state, shifts), targets)
+
+    def fourier(self, psi, inverse, targets):
+        return self.shifted(psi, lambda state, shifts: qg.fourierApplication(state, shifts, inverse), targets)
+
+    def diffusion(self, psi, payload, targets):
+        return self.shifted(psi, lambda state, shifts: qg.diffusion(state, shifts), targets)
+
+    def phase(self, psi, marked, targets):
+        return self.shifted(psi, lambda state, shifts: qg.phase(marked, state, shifts), targets)
+
+    def measure(self, psi, targets):
+        n = psi.shape[1].bit_length() - 1
+        targets = list(targets)
+        k = len(targets)
+        # Each row's marginal distribution over the targets, sampled by inverting its cumulative distribution.
+        probs = numpy.reshape(abs(psi)**2, (self.batch,) + n * (2,))
+        others = tuple(1 + q for q in range(n) if q not in targets)
+        probs = numpy.sum(probs, axis=others, dtype=numpy.float64)
+        ordered = sorted(targets)
+        probs = numpy.reshape(numpy.transpose(probs, [0] + [1 + ordered.index(q) for q in targets]), (self.batch, 2**k))
+        cumulative = numpy.cumsum(probs, axis=1)
+        draws = self.rng.random(self.batch) * cumulative[:, -1]
+        outcomes = numpy.minimum(numpy.sum(cumulative <= draws[:, None], axis=1), 2**k - 1)
+        # Collapse each row onto its outcome.
+        indices = numpy.arange(2**n)
+        spelled = numpy.zeros(2**n, dtype=numpy.int64)
+        for q in targets:
+            spelled = (spelled << 1) | ((indices >> (n - 1 - q)) & 1)
+        psi[spelled[None, :] != outcomes[:, None]] = 0
+        psi /= numpy.sqrt(numpy.sum(abs(psi)**2, axis=1))[:, None]
+        bits = [((outcomes >> (k - 1 - j)) & 1).astype(numpy.uint8) for j in range(k)]
+        return (psi, bits)
+
+
+def run(circuit, model, batch=256, ketPsi=None, rng=None):
+    '''Runs batch trajectories of the qCircuits.Circuit under the noise model, a list of Channels. Returns a pair
+    consisting of the final B x 2^n batch of states and a B x m array of the m measured bits of each trajectory. rng is
+    as in qUtilities.generator.'''
+    psi, bits = circuit.run(ketPsi, backend=lambda generator: Trajectories(generator, model, batch), rng=rng)
+    if len(bits) == 0:
+        return (psi, numpy.zeros((batch, 0), dtype=numpy.uint8))
+    return (psi, numpy.stack(bits, axis=1))
+
+def histogram(circuit, model, trajectories, batch=256, rng=None):
+    '''Runs the circuit trajectories times under the noise model, in batches, and returns a qTrials.Tally of the
+    measured bit strings, which gives their frequencies with confidence intervals.'''
+    generator = qu.generator(rng)
+    tally = qtr.Tally()
+    while tally.total < trajectories:
+        bits = run(circuit, model, batch, rng=generator)[1]
+        for row in bits[:trajectories - tally.total]:
+            tally.add(tuple(int(bit) for bit in row))
+    return tally
+
+def average(circuit, model, observable, trajectories, batch=256, rng=None):
+    '''Estimates the average of observable over the final states of trajectories noisy runs of the circuit.
+    observable maps a B x 2^n batch of states to B real numbers. Returns a pair (mean, halfWidth), where the true
+    average lies in mean +- halfWidth with about 95% confidence.'''
+    generator = qu.generator(rng)
+    values = []
+    while len(values) < trajectories:
+        psi = run(circuit, model, batch, rng=generator)[0]
+        values.extend(observable(psi)[:trajectories - len(values)])
+    values = numpy.array(values)
+    return (numpy.mean(values), 1.96 * numpy.std(values) / math.sqrt(len(values)))
+
+
+
+### DEFINING SOME TESTS ###
+
+def channelTest(trajectories):
+    # Prepares |1>, applies each channel once through the identity gate, and compares the frequency of measuring 1 with the exact value.
+    circuit = qci.Circuit(1).gate(qc.x, (0,)).gate(qc.i, (0,)).measure([0])
+    # The noise acts after both gates. Depolarizing flips the bit with probability 2 p / 3 each time.
+    flip = 2 * 0.3 / 3
+    for name, model, expected in [('depolarizing', [depolarizing(0.3)], (1 - flip)**2 + flip**2),
+                                  ('dephasing', [dephasing(0.3)], 1),
+                                  ('amplitude damping', [amplitudeDamping(0.3)], 0.7**2)]:
+        tally = histogram(circuit, model, trajectories, rng=358)
+        low, high = tally.interval((1,), z=4)
+        if low <= expected <= high:
+            print("passed channelTest for " + name)
+        else:
+            print("failed channelTest for " + name)
+            print("    frequency = " + str(tally.frequency((1,))) + ", expected = " + str(expected))
+
+def noiselessTest(n):
+    # Checks that trajectories without noise agree with the ideal simulation.
+    ketPsi = qu.uniform(n)
+    circuit = qci.Circuit(n).layer(qc.h, range(n)).gate(qc.cnot, (0, n - 1)).fourier(range(1, n)).diffusion(range(n))
+    ideal = circuit.run(ketPsi)[0]
+    psi = run(circuit, [], batch=4, ketPsi=ketPsi)[0]
+    if all(qu.equal(ideal, row, qc.epsilon) for row in psi):
+        print("passed noiselessTest")
+    else:
+        print("failed noiselessTest")
+
+def noisyGroverTest(n, k, trajectories):
+    # Estimates Grover's success probability with and without depolarizing noise. Noise should lower it.
+    table = numpy.zeros(2**n, dtype=numpy.intp)
+    table[random.sample(range(2**n), k)] = 1
+    marked = {qb.string(n, int(alpha)) for alpha in numpy.flatnonzero(table)}
+    circuit = qa.groverCircuit(n, k, qg.oracle(n, 1, table)).compile()
+    for p in [0, 0.01, 0.05]:
+        tally = histogram(circuit, [depolarizing(p)], trajectories, rng=358)
+        success = qtr.Tally()
+        for bits, count in tally.counts.items():
+            for i in range(count):
+                success.add(bits in marked)
+        low, high = success.interval(True)
+        print("check noisyGroverTest for success frequency falling as p = " + str(p) + " grows")
+        print("    success frequency = " + str(success.frequency(True)) + ", 95% interval = (" + str(round(low, 3)) + ", " + str(round(high, 3)) + ")")
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    channelTest(4096)
+    noiselessTest(4)
+    noisyGroverTest(6, 1, 1024)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import math
+import time
+import random
+import numpy
+import qConstants as qc
+import qUtilities as qu
+import qBitStrings as qb
+import qGates as qg
+import qMeasurement as qm
+import qAlgorithms as qa
+import qCircuits as qci
+
+# Simulation of Clifford circuits with the stabilizer tableau of Aaronson and Gottesman (2004). Instead of 2^n
+# amplitudes, an n-qbit state is described by the 2n Pauli operators that generate its stabilizer group and its
+# destabilizers, as bit matrices, so each gate costs O(n) and each measurement O(n^2). That covers circuits built from
+# H, S, X, Z, CNOT and SWAP, such as those of deutsch, bernsteinVazirani and simon with affine oracles, at hundreds or
+# thousands of qbits. A circuit qualifies when every operation converts to those gates; see isClifford. The backend is
+# opt-in: pass backend='stabilizer', or 'auto' to have qCircuits check each circuit first.
+
+# The phase gate S, which with H and CNOT generates the Clifford group.
+s = numpy.array([[1, 0], [0, 1j]])
+
+# The tables of one- and two-qbit Clifford gates built by cliffords, by number of qbits.
+tables = {}
+
+
+class Tableau:
+    '''The stabilizer tableau of an n-qbit state, initially |0...0>. Rows 0
+    to n - 1 are the destabilizers and rows n to 2n - 1 the stabilizers. Row
+    i stands for the Pauli operator (-1)^r[i] times the tensor product over j
+    of X^x[i, j] Z^z[i, j].'''
+
+    def __init__(self, n):
+        self.n = n
+        self.x = numpy.zeros((2 * n, n), dtype=numpy.uint8)
+        self.z = numpy.zeros((2 * n, n), dtype=numpy.uint8)
+        self.r = numpy.zeros(2 * n, dtype=numpy.uint8)
+        self.x[numpy.arange(n), numpy.arange(n)] = 1
+        self.z[n + numpy.arange(n), numpy.arange(n)] = 1
+
+    def h(self, a):
+        self.r ^= self.x[:, a] & self.z[:, a]
+        self.x[:, a], self.z[:, a] = self.z[:, a].copy(), self.x[:, a].copy()
+
+    def s(self, a):
+        self.r ^= self.x[:, a] & self.z[:, a]
+        self.z[:, a] ^= self.x[:, a]
+
+    def cnot(self, a, b):
+        self.r ^= self.x[:, a] & self.z[:, b] & (self.x[:, b] ^ self.z[:, a] ^ 1)
+        self.x[:, b] ^= self.x[:, a]
+        self.z[:, a] ^= self.z[:, b]
+
+    def pauliX(self, a):
+        self.r ^= self.z[:, a]
+
+    def pauliZ(self, a):
+        self.r ^= self.x[:, a]
+
+    def measure(self, a, rng):
+        '''Measures qbit a, updating the tableau, and returns the bit. rng is a numpy.random.Generator.'''
+        n = self.n
+        anticommuting = numpy.flatnonzero(self.x[n:, a])
+        if len(anticommuting) > 0:
+            # The outcome is random. Multiply stabilizer p into every other row that anticommutes with Z_a, then replace it with +-Z_a.
+            p = n + anticommuting[0]
+            rows = numpy.flatnonzero(self.x[:, a])
+            rows = rows[rows != p]
+            total = 2 * self.r[rows].astype(numpy.int64) + 2 * int(self.r[p]) + numpy.sum(phases(self.x[p], self.z[p], self.x[rows], self.z[rows]), axis=1)
+            self.r[rows] = (total % 4) // 2
+            self.x[rows] ^= self.x[p]
+            self.z[rows] ^= self.z[p]
+            self.x[p - n], self.z[p - n], self.r[p - n] = self.x[p], self.z[p], self.r[p]
+            self.x[p] = 0
+            self.z[p] = 0
+            self.z[p, a] = 1
+            self.r[p] = rng.integers(2)
+            return int(self.r[p])
+        # The outcome is determined: it is the sign of the product of the stabilizers whose destabilizers anticommute with Z_a.
+        rows = n + numpy.flatnonzero(self.x[:n, a])
+        xs, zs = self.x[rows], self.z[rows]
+        # The running product before each factor, computed all at once.
+        before = lambda bits: numpy.vstack([numpy.zeros((1, n), dtype=numpy.uint8), numpy.bitwise_xor.accumulate(bits, axis=0)[:-1]])
+        total = 2 * int(numpy.sum(self.r[rows])) + int(numpy.sum(phases(xs, zs, before(xs), before(zs))))
+        return (total % 4) // 2
+
+
+def phases(x1, z1, x2, z2):
+    '''Returns, elementwise, the power of i in the product of the Pauli operators X^x1 Z^z1 and X^x2 Z^z2.'''
+    x1, z1, x2, z2 = (numpy.asarray(bits, dtype=numpy.int64) for bits in (x1, z1, x2, z2))
+    return x1 * z1 * (z2 - x2) + x1 * (1 - z1) * z2 * (2 * x2 - 1) + (1 - x1) * z1 * x2 * (1 - 2 * z2)
+
+
+def key(u):
+    '''Returns a hashable key that is the same for two gates if and only if they are equal up to global phase.'''
+    u = numpy.asarray(u, dtype=numpy.complex128)
+    flat = numpy.ravel(u)
+    first = flat[numpy.argmax(abs(flat) > 0.25)]
+    return (numpy.round(u * (abs(first) / first), 4) + 0).tobytes()
+
+def cliffords(k):
+    '''Returns a dictionary mapping the key of every k-qbit Clifford gate, for k = 1 (24 gates) or k = 2 (11520), to a
+    shortest list of elementary operations, as in elementary, on qbits 0 to k - 1 that makes it. Built once by
+    breadth-first search from H, S and CNOT.'''
+    if k not in tables:
+        if k == 1:
+            generators = [(('h', 0), qc.h), (('s', 0), s)]
+        else:
+            generators = [(('h', 0), numpy.kron(qc.h, qc.i)), (('h', 1), numpy.kron(qc.i, qc.h)),
+                          (('s', 0), numpy.kron(s, qc.i)), (('s', 1), numpy.kron(qc.i, s)), (('cnot', 0, 1), qc.cnot)]
+        identity = numpy.identity(2**k, dtype=numpy.complex128)
+        table = {key(identity): []}
+        frontier = [(identity, [])]
+        while len(frontier) > 0:
+            following = []
+            for u, word in frontier:
+                for operation, g in generators:
+                    v = numpy.dot(g, u)
+                    if key(v) not in table:
+                        table[key(v)] = word + [operation]
+                        following.append((v, word + [operation]))
+            frontier = following
+        tables[k] = table
+    return tables[k]
+
+
+def affineTable(table, n, m):
+    '''Given the truth table of f : {0, 1}^n -> {0, 1}^m, as for qGates.truthTable, returns f as a qGates.Affine if it
+    is affine, and None otherwise.'''
+    table = numpy.asarray(table, dtype=numpy.int64)
+    offset = table[0]
+    columns = table[numpy.int64(1) << numpy.arange(n - 1, -1, -1, dtype=numpy.int64)] ^ offset
+    bits = qb.bitArray(numpy.arange(2**n), n).astype(numpy.int64)
+    if not numpy.array_equal(numpy.bitwise_xor.reduce(bits * columns, axis=1) ^ offset, table):
+        return None
+    return qg.Affine(numpy.transpose(qb.bitArray(columns, m)), qb.bitArray(numpy.array([offset]), m)[0])
+
+def linearization(f, k):
+    '''Given the payload of an oracle operation on k qbits --- a qGates.Affine, a qGates.Oracle or a dense gate ---
+    returns it as a qGates.Affine if it is the oracle of an affine function, and None otherwise. A dense gate is
+    tried as an oracle for every split of its k qbits into input and output qbits.'''
+    if isinstance(f, qg.Affine):
+        return f
+    if isinstance(f, qg.Oracle):
+        return affineTable(f.table, f.n, f.m)
+    u = numpy.asarray(f)
+    if u.ndim != 2 or k > 16:
+        return None
+    indices = numpy.argmax(abs(u), axis=0)
+    if not numpy.allclose(u[indices, numpy.arange(2**k)], 1, atol=qc.epsilon) or not numpy.isclose(numpy.sum(abs(u)), 2**k):
+        return None
+    for m in range(1, k):
+        table = indices[numpy.arange(2**(k - m)) << m] & (2**m - 1)
+        if numpy.array_equal(qg.Oracle(k - m, m, table).indices, indices):
+            affine = affineTable(table, k - m, m)
+            if affine is not None:
+                return affine
+    return None
+
+def elementary(operation):
+    '''Converts a circuit operation other than a measurement into a list of elementary Clifford operations ('h', a),
+    ('s', a), ('x', a), ('z', a) and ('cnot', a, b), equal to it up to global phase. Returns None if it is not a
+    Clifford operation that this module recognizes.'''
+    kind, payload, targets = operation
+    k = len(targets)
+    if kind == 'gate' or (kind == 'oracle' and k <= 2 and not isinstance(payload, (qg.Oracle, qg.Affine))):
+        if k > 2:
+            return None
+        word = cliffords(k).get(key(payload))
+        if word is None:
+            return None
+        return [(name,) + tuple(targets[q] for q in qbits) for name, *qbits in word]
+    if kind == 'oracle':
+        affine = linearization(payload, k)
+        if affine is None:
+            return None
+        inputs, outputs = targets[:affine.n], targets[affine.n:]
+        operations = [('cnot', inputs[i], outputs[j]) for j, i in zip(*numpy.nonzero(affine.matrix))]
+        return operations + [('x', outputs[j]) for j in numpy.flatnonzero(affine.offset)]
+    if kind == 'phase':
+        if k > 24:
+            return None
+        indicator = numpy.zeros(2**k, dtype=numpy.int64)
+        indicator[payload] = 1
+        affine = affineTable(indicator, k, 1)
+        if affine is None:
+            return None
+        # (-1)^(a . alpha + c) is a Z on each qbit where a is 1, times a global phase.
+        return [('z', targets[i]) for i in numpy.flatnonzero(affine.matrix[0])]
+    if kind == 'fourier' and k == 1:
+        return [('h', targets[0])]
+    if kind == 'diffusion' and k == 1:
+        return [('x', targets[0])]
+    return None
+
+def isClifford(circuit):
+    '''Returns whether every operation of the qCircuits.Circuit converts to elementary Clifford operations, so that
+    the circuit can run on the stabilizer backend.'''
+    return all(kind == 'measure' or elementary((kind, payload, targets)) is not None
+               for kind, payload, targets in circuit.operations)
+
+
+class Stabilizer:
+    '''A qCircuits backend that runs Clifford circuits on a Tableau. It can
+    only start from |0...0>, and the state that run returns is the Tableau.'''
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def start(self, n, ketPsi):
+        if ketPsi is not None:
+            raise ValueError("the stabilizer backend can only start from |0...0>")
+        return Tableau(n)
+
+    def apply(self, tableau, operation):
+        operations = elementary(operation)
+        if operations is None:
+            raise ValueError("a " + operation[0] + " on " + str(len(operation[2])) + " qbits is not a Clifford operation this backend recognizes")
+        for name, *qbits in operations:
+            if name == 'h':
+                tableau.h(*qbits)
+            elif name == 's':
+                tableau.s(*qbits)
+            elif name == 'x':
+                tableau.pauliX(*qbits)
+            elif name == 'z':
+                tableau.pauliZ(*qbits)
+            else:
+                tableau.cnot(*qbits)
+        return tableau
+
+    def gate(self, tableau, u, targets):
+        return self.apply(tableau, ('gate', u, targets))
+
+    def oracle(self, tableau, f, targets):
+        return self.apply(tableau, ('oracle', f, targets))
+
+    def fourier(self, tableau, inverse, targets):
+        return self.apply(tableau, ('fourier', inverse, targets))
+
+    def diffusion(self, tableau, payload, targets):
+        return self.apply(tableau, ('diffusion', payload, targets))
+
+    def phase(self, tableau, marked, targets):
+        return self.apply(tableau, ('phase', marked, targets))
+
+    def measure(self, tableau, targets):
+        return (tableau, [tableau.measure(target, self.rng) for target in targets])
+
+
+
+### DEFINING SOME TESTS ###
+
+def cliffordsTest():
+    # Checks the sizes of the Clifford groups on one and two qbits, modulo phase.
+    if len(cliffords(1)) == 24 and len(cliffords(2)) == 11520:
+        print("passed cliffordsTest")
+    else:
+        print("failed cliffordsTest")
+        print("    sizes = " + str(len(cliffords(1))) + ", " + str(len(cliffords(2))))
+
+def stabilizerTest(n, m, trials):
+    # Builds random circuits of m Clifford gates on n qbits, compiles them (which fuses gates), and checks that every outcome of the stabilizer backend is possible, and certain ones certain, according to the state vector.
+    gates = [(qc.h, 1), (s, 1), (qc.x, 1), (qc.y, 1), (qc.z, 1), (qc.cnot, 2), (qc.swap, 2)]
+    for trial in range(trials):
+        circuit = qci.Circuit(n)
+        for j in range(m):
+            u, k = random.choice(gates)
+            circuit.gate(u, random.sample(range(n), k))
+        if random.random() < 0.5:
+            circuit.phase([1, 2], (0, 1))
+        compiled = circuit.compile()
+        probs = qm.marginal(compiled.run()[0], range(n))
+        bits = compiled.measure(range(n)).run(backend='stabilizer', rng=trial)[1]
+        if not isClifford(compiled) or probs[qb.integer(tuple(bits))] < qc.epsilon:
+            print("failed stabilizerTest")
+            print("    bits = " + str(bits) + ", probabilities = " + str(probs))
+            return
+    print("passed stabilizerTest")
+
+def autoTest(n):
+    # Checks which circuits the auto backend sends to the stabilizer backend. run imports qStabilizers itself, so when
+    # this file is run as a script the tableau's class is not this module's Tableau; compare it by name.
+    table = numpy.zeros(2**n, dtype=numpy.intp)
+    table[3] = 1
+    grover = qa.groverCircuit(n, 1, qg.oracle(n, 1, table)).compile()
+    deltas = qb.bitArray(numpy.array([5]), n)
+    bv = qa.bernsteinVaziraniCircuit(n, qg.oracle(n, 1, lambda alpha: (qb.dot(alpha, tuple(deltas[0])),))).compile()
+    if isClifford(bv) and not isClifford(grover) and type(bv.run(backend='auto')[0]).__name__ == 'Tableau':
+        print("passed autoTest")
+    else:
+        print("failed autoTest")
+
+def bigTest(n):
+    # Runs Bernstein-Vazirani and Simon on n qbits with affine oracles, far beyond what a state vector could hold.
+    delta = numpy.array([random.randrange(2) for i in range(n)], dtype=numpy.uint8)
+    delta[0] = 1
+    start = time.perf_counter()
+    bits = tuple(map(qu.bitValue, qa.bernsteinVazirani(n, qg.Affine([delta]), backend='auto')))
+    middle = time.perf_counter()
+    # A linear map with kernel {0, delta}, as in simonTest: the identity with column 0 replaced by delta, less row 0.
+    m = numpy.identity(n, dtype=numpy.uint8)
+    m[:, 0] = delta
+    gamma = numpy.array(list(map(qu.bitValue, qa.simon(n, qg.Affine(m[1:]), backend='auto'))), dtype=numpy.uint8)
+    end = time.perf_counter()
+    if bits == tuple(delta) and numpy.dot(gamma, delta) % 2 == 0:
+        print("passed bigTest on " + str(n) + " qbits")
+        print("    seconds: bernsteinVazirani = %.3f, simon = %.3f" % (middle - start, end - middle))
+    else:
+        print("failed bigTest")
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    cliffordsTest()
+    stabilizerTest(3, 12, 50)
+    stabilizerTest(5, 30, 50)
+    autoTest(5)
+    bigTest(300)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+import os
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+import numpy
+import qConstants as qc
+import qUtilities as qu
+import qGates as qg
+import qCache as qca
+
+# A persistent, content-addressed store of gates, oracles and states on disk. An entry is named by the SHA-256 of its
+# key, which for the gate constructors in qGates is the key that qCache.gates already uses: the constructor's name and
+# arguments, including a hash of the truth table. Each array of an entry is an ordinary .npy file, loaded with
+# numpy.load(mmap_mode='r'), so a hit reads no data up front and copies none. Every process that loads the same entry
+# shares one copy of it in the operating system's page cache. Beside the arrays, a small JSON file records the
+# entry's shapes, dtypes, sizes and SHA-256 digests, and is written last, so an entry exists only once it is complete.
+# Entries that fail their checks are deleted and rebuilt. When the store grows past its budget, the least recently
+# used entries are deleted.
+
+
+class Store:
+    '''An on-disk store of NumPy arrays and qGates.Oracles in directory,
+    bounded by budget bytes. Any number of processes may share a directory.
+    The arrays it returns are read-only views of memmaps onto its files. They
+    are plain ndarrays, so qGates does not mistake them for qMemmap states.'''
+
+    def __init__(self, directory, budget=2**32):
+        self.directory = directory
+        self.budget = budget
+        os.makedirs(directory, exist_ok=True)
+        # The bytes in the directory as of the last scan, plus what this Store has written since, or None before the
+        # first scan. Other processes may have written or evicted since, so it is only used to decide when to rescan.
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.corruptions = 0
+
+    def name(self, key):
+        '''Returns the name of the entry for key, which must have a repr that is the same in every process, like the
+        tuples of strings and numbers that qGates uses.'''
+        return hashlib.sha256(repr(key).encode()).hexdigest()
+
+    def paths(self, name, count):
+        '''Returns the path of an entry's metadata and the paths of its count arrays.'''
+        base = os.path.join(self.directory, name)
+        return (base + '.json', [base + '.' + str(i) + '.npy' for i in range(count)])
+
+    def get(self, key, build, verify=False):
+        '''Returns the value stored under key. On a miss, calls build() to make
+        it, writes it to the store, and returns it as loaded back from the
+        store. Checks each array's shape, dtype and file size against the
+        metadata, and if verify is True also its SHA-256 digest, which reads
+        the whole file.'''
+        value = self.load(key, verify)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = build()
+        if self.save(key, value):
+            stored = self.load(key)
+            if stored is not None:
+                return stored
+        return value
+
+    def load(self, key, verify=False):
+        '''Returns the value stored under key, or None if there is none or it fails its checks.'''
+        name = self.name(key)
+        path = self.paths(name, 0)[0]
+        try:
+            with open(path) as file:
+                metadata = json.load(file)
+            if metadata['key'] != repr(key):
+                raise ValueError("the entry belongs to another key")
+            arrays = []
+            for record, arrayPath in zip(metadata['arrays'], self.paths(name, len(metadata['arrays']))[1]):
+                array = numpy.load(arrayPath, mmap_mode='r', allow_pickle=False)
+                if (list(array.shape) != record['shape'] or array.dtype.str != record['dtype']
+                        or os.path.getsize(arrayPath) != record['bytes']):
+                    raise ValueError("the entry does not match its metadata")
+                if verify and digest(array) != record['sha256']:
+                    raise ValueError("the entry does not match its digest")
+                arrays.append(array)
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError, OSError):
+            self.corruptions += 1
+            self.delete(name)
+            return None
+        # Mark the entry as recently used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if metadata['kind'] == 'oracle':
+            return qg.Oracle(metadata['n'], metadata['m'], arrays[0], arrays[1])
+        return numpy.asarray(arrays[0])
+
+    def save(self, key, value):
+        '''Writes value under key, replacing any existing entry, and evicts as necessary. Returns False, writing
+        nothing, if value is not an array or Oracle or if it alone exceeds the budget.'''
+        if isinstance(value, qg.Oracle):
+            arrays = [value.table, value.indices]
+            metadata = {'kind': 'oracle', 'n': value.n, 'm': value.m}
+        elif isinstance(value, numpy.ndarray) and value.dtype != object:
+            arrays = [value]
+            metadata = {'kind': 'array'}
+        else:
+            return False
+        if sum(array.nbytes for array in arrays) > self.budget:
+            return False
+        name = self.name(key)
+        path, arrayPaths = self.paths(name, len(arrays))
+        metadata['key'] = repr(key)
+        metadata['arrays'] = []
+        for array, arrayPath in zip(arrays, arrayPaths):
+            array = numpy.ascontiguousarray(array)
+            # Write to a temporary file and rename it, so that no process ever sees a partial file.
+            temporary = temporaryPath(arrayPath)
+            with open(temporary, 'wb') as file:
+                numpy.save(file, array, allow_pickle=False)
+            os.replace(temporary, arrayPath)
+            metadata['arrays'].append({'shape': list(array.shape), 'dtype': array.dtype.str,
+                                       'bytes': os.path.getsize(arrayPath), 'sha256': digest(array)})
+        temporary = temporaryPath(path)
+        with open(temporary, 'w') as file:
+            json.dump(metadata, file)
+        os.replace(temporary, path)
+        if self.size is None:
+            self.size = sum(entry[1] for entry in self.entries())
+        else:
+            self.size += sum(record['bytes'] for record in metadata['arrays'])
+        if self.size > self.budget:
+            self.evict()
+        return True
+
+    def entries(self):
+        '''Returns a list of triples (lastUsed, bytes, name) describing the entries, least recently used first.'''
+        entries = []
+        for fileName in os.listdir(self.directory):
+            if not fileName.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, fileName)
+            try:
+                with open(path) as file:
+                    metadata = json.load(file)
+                size = sum(record['bytes'] for record in metadata['arrays'])
+                entries.append((os.path.getmtime(path), size, fileName[:-len('.json')]))
+            except (ValueError, KeyError, TypeError, OSError):
+                continue
+        return sorted(entries)
+
+    def evict(self):
+        '''Deletes least recently used entries until the store fits its budget. Scans the whole directory, so save
+        calls it only when its running total of bytes goes over the budget.'''
+        entries = self.entries()
+        size = sum(entry[1] for entry in entries)
+        for lastUsed, entrySize, name in entries:
+            if size <= self.budget:
+                break
+            self.delete(name)
+            size -= entrySize
+            self.evictions += 1
+        self.size = size
+
+    def delete(self, name):
+        '''Deletes an entry, metadata first so that it stops existing at once. Processes that have its arrays mapped
+        keep them.'''
+        fileNames = [fileName for fileName in os.listdir(self.directory)
+                     if fileName.startswith(name + '.') and not fileName.endswith('.tmp')]
+        for fileName in sorted(fileNames, key=lambda fileName: not fileName.endswith('.json')):
+            try:
+                os.remove(os.path.join(self.directory, fileName))
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        '''Deletes every entry. The statistics are kept.'''
+        for lastUsed, size, name in self.entries():
+            self.delete(name)
+        self.size = 0
+
+    def statistics(self):
+        '''Returns a dictionary of hit, miss, eviction and corruption counts and current usage.'''
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'corruptions': self.corruptions,
+                'entries': len(entries), 'bytes': sum(entry[1] for entry in entries), 'budget': self.budget}
+
+
+def digest(array):
+    '''Returns the SHA-256 of the bytes of a NumPy array, as hexadecimal.'''
+    return hashlib.sha256(numpy.ascontiguousarray(array)).hexdigest()
+
+def temporaryPath(path):
+    '''Returns the name of a temporary file to be renamed to path, unique to this process and thread, so that
+    concurrent writers of the same entry never share one.'''
+    return path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+
+def enable(directory, budget=2**32):
+    '''Makes the gate constructors in qGates look in a Store in directory before building anything, and save what they
+    build there. Returns the Store.'''
+    qca.gates.store = Store(directory, budget)
+    return qca.gates.store
+
+def disable():
+    '''Stops the gate constructors from using the store. The files are kept.'''
+    qca.gates.store = None
+
+
+
+### DEFINING SOME TESTS ###
+
+def storeTest():
+    # Stores a state and an oracle, loads them in a second Store on the same directory, and checks the values, the read-only memmaps and eviction.
+    import tempfile
+    directory = tempfile.mkdtemp()
+    first = Store(directory, 5 * 2**13)
+    ketPsi = first.get(('uniform', 10), lambda: qu.uniform(10))
+    oracle = first.get(('oracle', 3), lambda: qg.Oracle(3, 2, [random.randrange(4) for alpha in range(8)]))
+    # A second Store on the same directory acts like another process. The pauses let the file times show the order of use.
+    second = Store(directory, 5 * 2**13)
+    ketChi = second.get(('uniform', 10), lambda: qu.uniform(10))
+    time.sleep(0.01)
+    again = second.get(('oracle', 3), lambda: qg.Oracle(3, 2, numpy.zeros(8)))
+    loaded = (isinstance(ketChi.base, numpy.memmap) and not ketChi.flags.writeable and qu.equal(ketPsi, ketChi, qc.epsilon)
+              and numpy.array_equal(oracle.indices, again.indices) and isinstance(again.indices.base, numpy.memmap))
+    # The budget holds about 2.5 10-qbit states, so storing a second one evicts the first, which is the least recently used.
+    time.sleep(0.01)
+    second.get(('uniform', 9), lambda: qu.uniform(9))
+    second.get(('uniform', 10, 'again'), lambda: qu.uniform(10))
+    stats = second.statistics()
+    if (loaded and first.statistics()['misses'] == 2 and stats['hits'] == 2 and stats['evictions'] == 1
+            and stats['bytes'] <= stats['budget'] and first.load(('uniform', 10)) is None):
+        print("passed storeTest")
+    else:
+        print("failed storeTest")
+        print("    loaded = " + str(loaded) + ", statistics = " + str(stats))
+
+def integrityTest():
+    # Damages stored files in two ways and checks that both are caught and the values rebuilt.
+    import tempfile
+    store = Store(tempfile.mkdtemp())
+    ketPsi = qu.uniform(6)
+    store.get('psi', lambda: ketPsi)
+    store.get('chi', lambda: ketPsi)
+    # Flip a byte of the data, which only the digest can catch.
+    path = store.paths(store.name('psi'), 1)[1][0]
+    with open(path, 'r+b') as file:
+        file.seek(-1, os.SEEK_END)
+        byte = file.read(1)
+        file.seek(-1, os.SEEK_END)
+        file.write(bytes([byte[0] ^ 1]))
+    # Truncate a file, which the size check catches.
+    path = store.paths(store.name('chi'), 1)[1][0]
+    with open(path, 'r+b') as file:
+        file.truncate(os.path.getsize(path) - 16)
+    psi = store.get('psi', lambda: ketPsi, verify=True)
+    chi = store.get('chi', lambda: ketPsi)
+    if store.corruptions == 2 and numpy.array_equal(psi, ketPsi) and numpy.array_equal(chi, ketPsi) and store.load('psi', True) is not None:
+        print("passed integrityTest")
+    else:
+        print("failed integrityTest")
+        print("    statistics = " + str(store.statistics()))
+
+def scanTest(m):
+    # Saves m entries under budget and checks that the directory was scanned only once, and then that going over budget rescans and evicts.
+    import tempfile
+    store = Store(tempfile.mkdtemp(), m * 2**12)
+    scans = []
+    entries = store.entries
+    store.entries = lambda: scans.append(1) or entries()
+    for k in range(m):
+        store.get(('zeros', k), lambda: numpy.zeros(2**8))
+    once = len(scans)
+    store.get('big', lambda: numpy.zeros(2**8 * m))
+    if once == 1 and len(scans) == 2 and store.evictions > 0 and store.size <= store.budget:
+        print("passed scanTest")
+    else:
+        print("failed scanTest")
+        print("    scans = " + str(len(scans)) + ", statistics = " + str(store.statistics()))
+
+def threadTest(k, m):
+    # Saves the same entry from k threads at once, m times each, and checks that no writer trips over another's temporary file.
+    import tempfile
+    store = Store(tempfile.mkdtemp())
+    ketPsi = qu.uniform(8)
+    errors = []
+    def work():
+        try:
+            for i in range(m):
+                store.save('psi', ketPsi)
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=work) for i in range(k)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    leftovers = [fileName for fileName in os.listdir(store.directory) if fileName.endswith('.tmp')]
+    loaded = store.load('psi', verify=True)
+    if errors == [] and leftovers == [] and loaded is not None and numpy.array_equal(loaded, ketPsi):
+        print("passed threadTest")
+    else:
+        print("failed threadTest")
+        print("    errors = " + str(errors[:3]) + ", leftovers = " + str(leftovers))
+
+def gateStoreTest(n):
+    # Builds gates with the store enabled, forgets them in memory, and checks that building them again loads them from disk.
+    import tempfile
+    store = enable(tempfile.mkdtemp())
+    qca.gates.clear()
+    a = qg.fourier(n)
+    b = qg.oracle(n, 1, lambda alpha: (alpha[0],))
+    qca.gates.clear()
+    c = qg.fourier(n)
+    d = qg.oracle(n, 1, lambda alpha: (alpha[0],))
+    # Both are mapped from the store, so they take none of the in-memory budget.
+    resident = qca.gates.statistics()['bytes']
+    disable()
+    qca.gates.clear()
+    if (store.statistics()['hits'] == 2 and resident == 0 and isinstance(c.base, numpy.memmap) and numpy.array_equal(a, c)
+            and numpy.array_equal(b.indices, d.indices) and numpy.array_equal(qg.oracle(n, 1, lambda alpha: (alpha[0],)).indices, d.indices)):
+        print("passed gateStoreTest")
+    else:
+        print("failed gateStoreTest")
+        print("    statistics = " + str(store.statistics()))
+
+def loadingTest(n):
+    # Prints the time to build an oracle and to load it from the store.
+    import tempfile
+    store = Store(tempfile.mkdtemp())
+    build = lambda: qg.oracle(n, n, lambda alpha: alpha[::-1])
+    start = time.perf_counter()
+    qca.gates.clear()
+    store.get('oracle', build)
+    built = time.perf_counter() - start
+    start = time.perf_counter()
+    store.get('oracle', build)
+    loaded = time.perf_counter() - start
+    print("check loadingTest for loading much faster than building")
+    print("    built = " + str(round(built, 4)) + "s, loaded = " + str(round(loaded, 4)) + "s")
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    storeTest()
+    integrityTest()
+    scanTest(8)
+    threadTest(4, 50)
+    gateStoreTest(6)
+    loadingTest(10)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+import os
+import math
+import time
+import random
+import threading
+import numpy
+import qConstants as qc
+import qUtilities as qu
+import qGates as qg
+import qMeasurement as qm
+
+# Multi-threaded kernels. When workers > 1, the routines in qGates and qMeasurement hand states of at least threshold
+# amplitudes to the functions here, through the handler that this module registers with qGates on import. These split
+# the states into independent blocks and process the blocks in a pool of threads. A k-qbit operation never mixes
+# amplitudes that differ in a qbit outside its targets, so fixing a few such qbits gives blocks that can be worked on
+# separately. Operations that leave too few qbits untouched to split on, such as Grover's phase and diffusion on all n
+# qbits, are split by ranges of amplitude indices instead: oracles and phases gather or negate each range, and diffusion
+# sums each range and then updates it. The work in each block or range is done by NumPy routines, which release the GIL
+# while they run, so the threads really do run in parallel.
+
+# The number of threads. 1 means the serial code paths are used. Change it with setWorkers.
+workers = 1
+# States with fewer amplitudes than this are always processed serially, because the threads would cost more than they save.
+threshold = 2**16
+# Per-thread flag marking the pool's own threads, whose calls into qGates must run serially.
+local = threading.local()
+pool = None
+
+
+def setWorkers(k=None):
+    '''Sets the number of worker threads to k, by default the number of cores. Setting it to 1 turns threading off.'''
+    global workers, pool
+    if k is None:
+        k = os.cpu_count() or 1
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+    workers = max(1, k)
+
+def executor():
+    '''Returns the thread pool, starting it if necessary.'''
+    global pool
+    if pool is None:
+        # Imported here, so that importing qGates does not pay for it.
+        import concurrent.futures
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, initializer=mark)
+    return pool
+
+def mark():
+    local.worker = True
+
+def parallel(ketPsi):
+    '''Returns whether an operation on the state |psi> should be split across threads.'''
+    return workers > 1 and len(ketPsi) >= threshold and not getattr(local, 'worker', False)
+
+def blocking(n, targets):
+    '''Chooses the qbits to split an n-qbit state on, for an operation on the listed targets: up to about twice as many
+    blocks as workers, so that the load stays balanced. Returns the list of those qbits and the targets renumbered within
+    a block.'''
+    free = [q for q in range(n) if q not in targets]
+    b = min(len(free), (2 * workers - 1).bit_length())
+    split = free[:b]
+    return (split, [target - sum(1 for q in split if q < target) for target in targets])
+
+def splittable(n, targets):
+    '''Returns whether an operation on the listed targets of an n-qbit state leaves enough other qbits to split on.'''
+    return n - len(set(targets)) >= (2 * workers - 1).bit_length()
+
+def blocks(n, split):
+    '''Yields, for every assignment of bits to the qbits listed in split, an index into the (2,) * n view of a state
+    that selects that block.'''
+    for j in range(2**len(split)):
+        index = n * [slice(None)]
+        for k, q in enumerate(split):
+            index[q] = (j >> (len(split) - 1 - k)) & 1
+        yield tuple(index)
+
+def blockwise(ketPsi, targets, kernel):
+    '''Applies kernel(block, localTargets), which maps a flattened block to a new flattened block, to every block of the
+    state |psi> in parallel, where localTargets are the targets renumbered within a block. Returns the new state.'''
+    n = len(ketPsi).bit_length() - 1
+    targets = list(targets)
+    split, localTargets = blocking(n, targets)
+    psi = numpy.reshape(numpy.asarray(ketPsi, dtype=qc.one.dtype), n * (2,))
+    out = numpy.empty_like(psi)
+    def work(index):
+        block = psi[index]
+        out[index] = numpy.reshape(kernel(numpy.ravel(block), localTargets), block.shape)
+    list(executor().map(work, blocks(n, split)))
+    return numpy.reshape(out, 2**n)
+
+def ranges(length):
+    '''Splits range(length) into about twice as many contiguous (start, stop) pieces as workers.'''
+    step = max(1, -(-length // (2 * workers)))
+    return [(start, min(start + step, length)) for start in range(0, length, step)]
+
+
+def spelled(indices, qbits, n):
+    '''Returns the integers that the listed qbits spell in each of the given amplitude indices of an n-qbit state, the
+    first listed qbit being the most significant.'''
+    k = len(qbits)
+    if list(qbits) == list(range(n - k, n)):
+        return indices & (2**k - 1)
+    alphas = numpy.zeros_like(indices)
+    for q in qbits:
+        alphas = (alphas << 1) | ((indices >> (n - 1 - q)) & 1)
+    return alphas
+
+def placed(alphas, qbits, n):
+    '''The inverse of spelled: returns the amplitude indices whose listed qbits spell the given integers and whose
+    other qbits are 0.'''
+    k = len(qbits)
+    if list(qbits) == list(range(n - k, n)):
+        return alphas
+    indices = numpy.zeros_like(alphas)
+    for j, q in enumerate(qbits):
+        indices |= ((alphas >> (k - 1 - j)) & 1) << (n - 1 - q)
+    return indices
+
+
+def targetedApplication(u, ketPsi, targets):
+    '''As qGates.targetedApplication, split across threads. An Oracle on too many of the qbits to split on is applied
+    by gathering ranges of amplitudes.'''
+    n = len(ketPsi).bit_length() - 1
+    targets = list(targets)
+    if isinstance(u, qg.Oracle) and not splittable(n, targets):
+        return oracle(u, ketPsi, targets)
+    return blockwise(ketPsi, targets, lambda block, localTargets: qg.targetedApplication(u, block, localTargets))
+
+def oracle(u, ketPsi, targets):
+    '''Applies the Oracle U to the listed qbits of |psi> by ranges of amplitude indices. The amplitude at index i of
+    the result is the one whose targets spell indices[alpha] where those of i spell alpha, the others being equal.'''
+    n = len(ketPsi).bit_length() - 1
+    targets = list(targets)
+    if targets == list(range(n)):
+        return permutation(u.indices, ketPsi)
+    others = (2**n - 1) ^ int(placed(numpy.array(2**len(targets) - 1), targets, n))
+    out = numpy.empty(2**n, dtype=ketPsi.dtype)
+    def work(piece):
+        indices = numpy.arange(piece[0], piece[1], dtype=numpy.intp)
+        sources = (indices & others) | placed(u.indices[spelled(indices, targets, n)], targets, n)
+        out[piece[0]:piece[1]] = ketPsi[sources]
+    list(executor().map(work, ranges(2**n)))
+    return out
+
+def permutation(indices, ketPsi):
+    '''Returns ketPsi[indices], gathering contiguous pieces of the result in parallel. Applies a full-width Oracle.'''
+    out = numpy.empty(len(indices), dtype=ketPsi.dtype)
+    def work(piece):
+        out[piece[0]:piece[1]] = ketPsi[indices[piece[0]:piece[1]]]
+    list(executor().map(work, ranges(len(indices))))
+    return out
+
+def fourierApplication(ketPsi, targets, inverse):
+    '''As qGates.fourierApplication, split across threads.'''
+    return blockwise(ketPsi, targets, lambda block, localTargets: qg.fourierApplication(block, localTargets, inverse))
+
+def diffusion(ketPsi, targets):
+    '''As qGates.diffusion, split across threads. With too few other qbits to split on, the mean of each slice of the
+    other qbits is summed blockwise over all qbits first, and then every block is updated to 2 mean - psi.'''
+    n = len(ketPsi).bit_length() - 1
+    targets = list(targets)
+    if splittable(n, targets):
+        return blockwise(ketPsi, targets, lambda block, localTargets: qg.diffusion(block, localTargets))
+    split = list(range(min(n, (2 * workers - 1).bit_length())))
+    psi = numpy.reshape(numpy.asarray(ketPsi, dtype=qc.one.dtype), n * (2,))
+    others = [q for q in range(n) if q not in targets]
+    rest = [q for q in range(n) if q not in split]
+    summed = tuple(i for i, q in enumerate(rest) if q in targets)
+    def partial(index):
+        return (index, numpy.sum(psi[index], axis=summed))
+    # means has an axis for each other qbit. A block fixes those that are split on.
+    means = numpy.zeros(len(others) * (2,), dtype=psi.dtype)
+    for index, total in executor().map(partial, blocks(n, split)):
+        means[tuple(index[q] for q in others)] += total
+    means /= 2**len(targets)
+    out = numpy.empty_like(psi)
+    def update(index):
+        mean = numpy.reshape(means[tuple(index[q] for q in others)], [1 if q in targets else 2 for q in rest])
+        out[index] = 2 * mean - psi[index]
+    list(executor().map(update, blocks(n, split)))
+    return numpy.reshape(out, 2**n)
+
+def phase(marked, ketPsi, targets):
+    '''As qGates.phase, split across threads. With too few other qbits to split on, each range of amplitudes is copied
+    and the marked ones in it negated.'''
+    n = len(ketPsi).bit_length() - 1
+    targets = list(targets)
+    if splittable(n, targets):
+        return blockwise(ketPsi, targets, lambda block, localTargets: qg.phase(marked, block, localTargets))
+    others = [q for q in range(n) if q not in targets]
+    # The indices of all marked amplitudes: each marked alpha, with every assignment of the other qbits.
+    negated = (placed(numpy.asarray(marked, dtype=numpy.intp), targets, n)[:, None]
+               | placed(numpy.arange(2**len(others), dtype=numpy.intp), others, n)[None, :])
+    # Each range finds its own by binary search. Repeats are harmless, since negating by fancy indexing happens once.
+    negated = numpy.ravel(negated)
+    if not numpy.all(negated[1:] >= negated[:-1]):
+        negated = numpy.sort(negated)
+    out = numpy.empty(2**n, dtype=ketPsi.dtype)
+    def work(piece):
+        out[piece[0]:piece[1]] = ketPsi[piece[0]:piece[1]]
+        inside = negated[numpy.searchsorted(negated, piece[0]):numpy.searchsorted(negated, piece[1])]
+        out[inside] *= -1
+    list(executor().map(work, ranges(2**n)))
+    return out
+
+def marginal(state, qbits):
+    '''As qMeasurement.marginal, split across threads. Each block contributes its own marginal, weighted by its squared
+    norm.'''
+    n = len(state).bit_length() - 1
+    qbits = list(qbits)
+    split, localQbits = blocking(n, qbits)
+    psi = numpy.reshape(state, n * (2,))
+    def work(index):
+        block = numpy.ravel(psi[index])
+        weight = numpy.vdot(block, block).real
+        if weight == 0:
+            return numpy.zeros(2**len(qbits))
+        return weight * qm.marginal(block, localQbits)
+    probs = sum(executor().map(work, blocks(n, split)))
+    return probs / numpy.sum(probs)
+
+def normSquares(parts):
+    '''Returns the list of squared norms <psi|psi> of the given arrays, each summed over contiguous pieces in parallel.'''
+    def work(job):
+        part, start, stop = job
+        return numpy.vdot(part[start:stop], part[start:stop]).real
+    result = []
+    for part in parts:
+        jobs = [(part, start, stop) for start, stop in ranges(len(part))]
+        result.append(math.fsum(executor().map(work, jobs)))
+    return result
+
+
+# The routines above, by the name of the qGates or qMeasurement routine they replace.
+kernels = {'oracle': oracle, 'targetedApplication': targetedApplication, 'fourierApplication': fourierApplication,
+           'phase': phase, 'diffusion': diffusion, 'marginal': marginal, 'normSquares': normSquares}
+
+def handler(operation, state):
+    '''The handler registered with qGates: returns the routine here for the named operation if the state should be
+    split across threads. Memmap states are left to qMemmap.'''
+    if parallel(state) and not isinstance(state, numpy.memmap):
+        return kernels.get(operation)
+    return None
+
+qg.handlers.append(handler)
+
+
+def speedup(n, k=None, repeats=3, names=None):
+    '''Times each kind of operation (or those named) on a random n-qbit state serially and with k threads (by default
+    the number of cores), and returns a dictionary mapping the name of each operation to a triple (serial seconds,
+    parallel seconds, speedup). The best of repeats runs is taken for each.'''
+    global threshold
+    saved = (workers, threshold)
+    ketPsi = qu.uniform(n)
+    f = qg.oracle(n - 1, 1, numpy.arange(2**(n - 1)) % 3 == 0)
+    marked = numpy.arange(0, 2**n, 7)
+    operations = {'one-qbit gate': lambda: qg.targetedApplication(qc.h, ketPsi, (0,)),
+                  'two-qbit gate': lambda: qg.targetedApplication(qc.cnot, ketPsi, (n - 1, 0)),
+                  'phase': lambda: qg.phase(numpy.arange(0, 2**(n - 1), 5), ketPsi, range(1, n)),
+                  'oracle': lambda: qg.application(f, ketPsi),
+                  'fourier': lambda: qg.fourierApplication(ketPsi, range(1, n)),
+                  'diffusion': lambda: qg.diffusion(ketPsi, range(1, n)),
+                  'marginal': lambda: qm.marginal(ketPsi, [0, n - 1]),
+                  'grover iteration': lambda: qg.diffusion(qg.phase(marked, ketPsi)),
+                  'grover iteration with ancilla': lambda: qg.diffusion(qg.targetedApplication(f, ketPsi, range(n)), range(n - 1))}
+    if names is not None:
+        operations = {name: operations[name] for name in names}
+    def best(operation):
+        times = []
+        for r in range(repeats):
+            start = time.perf_counter()
+            operation()
+            times.append(time.perf_counter() - start)
+        return min(times)
+    report = {}
+    for name, operation in operations.items():
+        setWorkers(1)
+        serial = best(operation)
+        setWorkers(k)
+        threshold = 0
+        threaded = best(operation)
+        threshold = saved[1]
+        report[name] = (serial, threaded, serial / threaded)
+    setWorkers(saved[0])
+    return report
+
+
+
+### DEFINING SOME TESTS ###
+
+def threadsTest(n, k):
+    # Assumes n >= 3. Runs every threaded kernel with k threads and compares it against the serial code path.
+    global threshold
+    saved = (workers, threshold)
+    ketPsi = qu.uniform(n)
+    f = qg.oracle(2, 1, [1, 0, 0, 1])
+    F = qg.oracle(n - 1, 1, numpy.arange(2**(n - 1)) % 3 == 0)
+    G = qg.oracle(n - 2, 1, numpy.arange(2**(n - 2)) % 3 == 1)
+    # The second group targets too many qbits to split on, so it is split by ranges of amplitudes.
+    operations = [lambda: qg.targetedApplication(qc.h, ketPsi, (1,)),
+                  lambda: qg.targetedApplication(qc.cnot, ketPsi, (n - 1, 0)),
+                  lambda: qg.targetedApplication(f, ketPsi, (2, n - 1, 0)),
+                  lambda: qg.application(F, ketPsi),
+                  lambda: qg.fourierApplication(ketPsi, range(1, n), inverse=True),
+                  lambda: qg.diffusion(ketPsi, (0, 2)),
+                  lambda: qg.phase([1, 2], ketPsi, (n - 1, 1)),
+                  lambda: qm.marginal(ketPsi, [n - 1, 0]),
+                  lambda: qg.targetedApplication(F, ketPsi, range(n)),
+                  lambda: qg.targetedApplication(F, ketPsi, range(n - 1, -1, -1)),
+                  lambda: qg.targetedApplication(G, ketPsi, range(1, n)),
+                  lambda: qg.targetedApplication(G, ketPsi, [n - 1] + list(range(n - 2))),
+                  lambda: qg.diffusion(ketPsi),
+                  lambda: qg.diffusion(ketPsi, range(n - 2, -1, -1)),
+                  lambda: qg.phase([1, 5, 6, 6], ketPsi),
+                  lambda: qg.phase([1, 2], ketPsi, range(n - 1, 0, -1))]
+    setWorkers(1)
+    serial = [operation() for operation in operations]
+    setWorkers(k)
+    threshold = 0
+    threaded = [operation() for operation in operations]
+    norms = normSquares([ketPsi[:2**(n - 1)], ketPsi[2**(n - 1):]])
+    threshold = saved[1]
+    setWorkers(saved[0])
+    if all(qu.equal(a, b, qc.epsilon) for a, b in zip(serial, threaded)) and abs(sum(norms) - 1) < qc.epsilon:
+        print("passed threadsTest")
+    else:
+        print("failed threadsTest")
+        print("    agreement = " + str([qu.equal(a, b, qc.epsilon) for a, b in zip(serial, threaded)]))
+
+def groverSpeedTest(n):
+    # Times one Grover iteration on all n qbits, with and without the ancilla. These target too many qbits to split into blocks.
+    for name, (serial, threaded, ratio) in speedup(n, names=['grover iteration', 'grover iteration with ancilla']).items():
+        print("check groverSpeedTest for " + name + " speedup above 1")
+        print("    serial = " + str(round(serial, 4)) + "s, threaded = " + str(round(threaded, 4)) + "s, speedup = " + str(round(ratio, 2)))
+
+def speedupTest(n):
+    # Prints how much faster each kind of operation runs with one thread per core. Expect little on small machines.
+    for name, (serial, threaded, ratio) in speedup(n).items():
+        print("check speedupTest for " + name + " speedup above 1")
+        print("    serial = " + str(round(serial, 4)) + "s, threaded = " + str(round(threaded, 4)) + "s, speedup = " + str(round(ratio, 2)))
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    threadsTest(5, 2)
+    threadsTest(8, 3)
+    speedupTest(22)
+    groverSpeedTest(22)
+
+if __name__ == "__main__":
+    main()
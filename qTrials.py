@@ -0,0 +1,167 @@
+import os
+import math
+import random
+import collections
+import multiprocessing
+import numpy
+import qUtilities as qu
+import qBitStrings as qb
+import qGates as qg
+import qAlgorithms as qa
+
+# Runs many independent trials of an algorithm in a pool of processes. Trial i always gets the same Generator, spawned
+# from the master seed, whichever process runs it, so the results do not depend on the number of processes. Each
+# process calls the setup function once, to build oracles and other arguments, and reuses what it builds for all of its
+# trials. Outcomes stream back as batches of trials finish.
+
+# The arguments of the entry point in this process, built once by initialize.
+context = None
+
+
+class Tally:
+    '''Counts the outcomes of trials as they come in.'''
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.total = 0
+
+    def add(self, outcome):
+        self.counts[outcome] += 1
+        self.total += 1
+
+    def frequency(self, outcome):
+        '''Returns the fraction of the trials so far that had the given outcome, or 0.0 if there have been none.'''
+        if self.total == 0:
+            return 0.0
+        return self.counts[outcome] / self.total
+
+    def interval(self, outcome, z=1.96):
+        '''Returns the Wilson score interval (low, high) for the probability of the given outcome, by default at 95%
+        confidence. With no trials yet, returns the uninformative interval (0, 1).'''
+        if self.total == 0:
+            return (0.0, 1.0)
+        p = self.frequency(outcome)
+        center = (p + z**2 / (2 * self.total)) / (1 + z**2 / self.total)
+        spread = z * math.sqrt(p * (1 - p) / self.total + z**2 / (4 * self.total**2)) / (1 + z**2 / self.total)
+        return (center - spread, center + spread)
+
+
+def outcome(result):
+    '''Converts the result of an algorithm into a hashable outcome: classical one-qbit states become bits, and lists
+    and tuples become tuples.'''
+    if isinstance(result, (list, tuple)):
+        return tuple(outcome(item) for item in result)
+    if isinstance(result, numpy.ndarray) and result.shape == (2,):
+        return qu.bitValue(result)
+    return result
+
+def initialize(entry, args, setup):
+    '''Builds the context of the trials in this process.'''
+    global context
+    if setup is not None:
+        args = setup(*args)
+    context = (entry, tuple(args))
+
+def work(job):
+    '''Runs the trials whose indices start at the given one, each with the Generator of its SeedSequence. Returns a
+    list of pairs (index, outcome).'''
+    start, seeds = job
+    entry, args = context
+    return [(start + i, outcome(entry(*args, rng=numpy.random.default_rng(seed)))) for i, seed in enumerate(seeds)]
+
+def stream(entry, trials, args=(), setup=None, processes=None, seed=None, chunk=None):
+    '''Runs entry(*args, rng=rng) trials times, each time with its own Generator rng, and yields pairs (index, outcome)
+    in the order in which the trials finish. If setup is given, each process instead runs entry(*setup(*args), rng=rng),
+    calling setup only once. entry and setup must be module-level functions, so that they can be sent to the processes.
+    processes defaults to the number of cores; 1 runs everything in this process. seed is the master seed, by default
+    drawn from the random module. Trials are sent to the processes chunk at a time.'''
+    if seed is None:
+        seed = random.getrandbits(64)
+    seeds = numpy.random.SeedSequence(seed).spawn(trials)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if chunk is None:
+        chunk = max(1, min(64, trials // (4 * processes)))
+    jobs = [(start, seeds[start:start + chunk]) for start in range(0, trials, chunk)]
+    if processes == 1:
+        initialize(entry, args, setup)
+        for job in jobs:
+            yield from work(job)
+        return
+    with multiprocessing.Pool(processes, initializer=initialize, initargs=(entry, args, setup)) as pool:
+        for results in pool.imap_unordered(work, jobs):
+            yield from results
+
+def run(entry, trials, args=(), setup=None, processes=None, seed=None, chunk=None, progress=None):
+    '''As stream, but returns a Tally of the outcomes. If progress is given, it is called with the Tally after each
+    trial comes in, so that long runs can report as they go.'''
+    tally = Tally()
+    for index, result in stream(entry, trials, args, setup, processes, seed, chunk):
+        tally.add(result)
+        if progress is not None:
+            progress(tally)
+    return tally
+
+
+
+### DEFINING SOME TESTS ###
+
+def groverSetup(n, deltas):
+    # Builds the arguments of qAlgorithms.grover for a function marking the given deltas. Runs once per process.
+    table = numpy.zeros(2**n, dtype=numpy.intp)
+    table[[qb.integer(delta) for delta in deltas]] = 1
+    return (n, len(deltas), qg.oracle(n, 1, table))
+
+def tallyTest():
+    # Checks the frequency and interval of an empty Tally, and that the interval of a full one contains its frequency.
+    tally = Tally()
+    empty = (tally.frequency(1), tally.interval(1))
+    for k in range(100):
+        tally.add(k % 4 == 0)
+    low, high = tally.interval(True)
+    if empty == (0.0, (0.0, 1.0)) and tally.frequency(True) == 0.25 and low < 0.25 < high:
+        print("passed tallyTest")
+    else:
+        print("failed tallyTest")
+        print("    empty = " + str(empty) + ", frequency = " + str(tally.frequency(True)) + ", interval = " + str((low, high)))
+
+def groverTrialTest(n, k, trials):
+    # Runs Grover's algorithm trials times in one process and in several, and checks that the outcomes are the same and usually marked.
+    deltas = []
+    while len(deltas) < k:
+        delta = qb.string(n, random.randrange(0, 2**n))
+        if not delta in deltas:
+            deltas.append(delta)
+    serial = run(qa.grover, trials, (n, deltas), setup=groverSetup, processes=1, seed=358)
+    pooled = run(qa.grover, trials, (n, deltas), setup=groverSetup, processes=3, seed=358, chunk=7)
+    successes = Tally()
+    for delta, count in serial.counts.items():
+        for i in range(count):
+            successes.add(delta in deltas)
+    if serial.counts == pooled.counts:
+        print("passed groverTrialTest")
+    else:
+        print("failed groverTrialTest")
+        print("    serial = " + str(serial.counts))
+        print("    pooled = " + str(pooled.counts))
+    print("check groverTrialTest for success frequency near 1")
+    print("    success frequency = " + str(successes.frequency(True)) + ", 95% interval = " + str(successes.interval(True)))
+
+def bennettTrialTest(trials):
+    # Runs Bennett's core algorithm in a pool and reports the frequency of gamma = 1 with alpha != beta.
+    tally = run(qa.bennett, trials, seed=358)
+    trueSucc = tally.counts[(0, 1, 1)] + tally.counts[(1, 0, 1)]
+    print("check bennettTrialTest for true success frequency about 0.25")
+    print("    true success frequency = " + str(trueSucc / tally.total))
+
+
+
+### RUNNING THE TESTS ###
+
+def main():
+    tallyTest()
+    groverTrialTest(6, 2, 200)
+    bennettTrialTest(20000)
+
+if __name__ == "__main__":
+    main()
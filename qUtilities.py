@@ -2,11 +2,6 @@ import math
 import random
 import numpy
 import qConstants as qc
-import qUtilities as qu
-import qBitStrings as qb
-import qGates as qg
-import qMeasurement as qm
-import qAlgorithms as qa
 
 
 def equal(a, b, epsilon):
@@ -22,21 +17,37 @@ def equal(a, b, epsilon):
         # a and b are gates.
         return sum(sum(abs(diff))) < epsilon
 
-def uniform(n):
-    '''Assumes n >= 0. Returns a uniformly random n-qbit state.'''
+def generator(rng=None):
+    '''Returns a numpy.random.Generator to draw random numbers from. rng may be
+    a Generator, which is returned as is, or a seed for a new one. If rng is
+    None, the new Generator is seeded from the random module, so that
+    random.seed still makes runs repeatable. Pass each thread its own Generator.'''
+    if isinstance(rng, numpy.random.Generator):
+        return rng
+    if rng is None:
+        rng = random.getrandbits(64)
+    return numpy.random.default_rng(rng)
+
+def draw(rng=None):
+    '''Returns a uniformly random float in [0, 1), from the Generator rng if given and otherwise from the random module. Cheap enough to call once per measurement. rng should be a Generator: an integer seed makes a new Generator on every call, so every draw with the same seed gives the same number. A function that draws more than once should convert its rng with generator first.'''
+    if rng is None:
+        return random.random()
+    return generator(rng).random()
+
+def uniform(n, batch=None, rng=None):
+    '''Assumes n >= 0. Returns a uniformly random n-qbit state. If batch is given, returns that many independent states as the rows of a batch x 2^n array. rng is as in generator.'''
+    shape = (2**n,) if batch is None else (batch, 2**n)
     if n == 0:
-        return qc.one
-    else:
-        psiNormSq = 0
-        while psiNormSq == 0:
-            reals = numpy.array(
-                [random.normalvariate(0, 1) for i in range(2**n)])
-            imags = numpy.array(
-                [random.normalvariate(0, 1) for i in range(2**n)])
-            psi = numpy.array([reals[i] + imags[i] * 1j for i in range(2**n)])
-            psiNormSq = numpy.dot(numpy.conj(psi), psi).real
-        psiNorm = math.sqrt(psiNormSq)
-        return psi / psiNorm
+        return qc.one if batch is None else numpy.ones(shape, dtype=qc.one.dtype)
+    rng = generator(rng)
+    norms = numpy.zeros(1)
+    while (norms == 0).any():
+        # View pairs of Gaussians as the real and imaginary parts of complex numbers, without copying.
+        real = numpy.finfo(qc.one.dtype).dtype
+        psi = rng.standard_normal(shape + (2,), dtype=real).view(qc.one.dtype)[..., 0]
+        norms = numpy.linalg.norm(psi, axis=-1, keepdims=True)
+    psi /= norms
+    return psi
 
 def bitValue(state):
     '''Given a one-qbit state assumed to be exactly classical --- usually because a classical state was just explicitly assigned to it --- returns the corresponding bit value 0 or 1.'''
@@ -57,3 +68,17 @@ def powerMod(k, l, m):
     return kToTheL
 
 
+
+def continuedFraction(b, q, bound):
+    '''Given integers b >= 0 and q, bound >= 1. Returns the list of denominators, in increasing order and without repeats, of the convergents of the continued fraction of b / q that do not exceed bound. In Shor's algorithm, b is a measurement of the n-qbit input register, q is 2^n, and the period is usually among these denominators.'''
+    denominators = []
+    previous, current = 1, 0
+    while q != 0:
+        a = b // q
+        previous, current = current, a * current + previous
+        if current > bound:
+            break
+        if current not in denominators:
+            denominators.append(current)
+        b, q = q, b - a * q
+    return denominators